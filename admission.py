@@ -0,0 +1,183 @@
+"""
+Admission control for chat turns that call the LLM.
+
+A class sending messages at the same moment would otherwise hit the
+provider all at once and come back as a wave of 429s and timeouts. Each
+turn has to be admitted before it runs:
+
+- at most LLM_MAX_CONCURRENT_TURNS turns run at once (per process);
+- a user has at most one turn in flight, a second one waits for the first;
+- waiting turns are admitted first come, first served, skipping users that
+  already have a turn running, so one busy user cannot starve the others;
+- a turn waits at most ADMISSION_MAX_WAIT seconds and the queue holds at
+  most ADMISSION_MAX_QUEUE turns. Beyond that the turn is rejected with
+  AdmissionRejected, which the routes turn into a 429 with Retry-After.
+
+A turn keeps its slot for all its completions, so it is never stuck in the
+queue halfway. Queue depth (seen by each arriving turn) and wait time are
+kept as histograms for the admin debug page.
+"""
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import Histogram, register_stats
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_CONCURRENT_TURNS = int(os.getenv('LLM_MAX_CONCURRENT_TURNS', '32'))
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '15'))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '200'))
+
+# Used for Retry-After until real turn durations have been seen
+DEFAULT_TURN_SECONDS = 5.0
+MAX_RETRY_AFTER = 60
+
+QUEUE_DEPTH_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 200, 500)
+WAIT_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+
+class AdmissionRejected(Exception):
+    """The turn could not be admitted; retry_after is a hint in seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class Ticket:
+    """A turn waiting for, or holding, an admission slot"""
+
+    def __init__(self, user_id, wake):
+        self.user_id = user_id
+        self.wake = wake
+        self.enqueued_at = time.monotonic()
+        self.admitted_at = None
+        self.released = False
+
+class AdmissionController:
+    """Global concurrency cap with one in-flight turn per user and a bounded FIFO queue"""
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENT_TURNS, max_wait=ADMISSION_MAX_WAIT,
+                 max_queue=ADMISSION_MAX_QUEUE):
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._waiting = deque()
+        self._active_users = set()
+        self._in_flight = 0
+        self._turn_seconds = None
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.queue_depth = Histogram(QUEUE_DEPTH_BUCKETS)
+        self.wait_seconds = Histogram(WAIT_SECONDS_BUCKETS)
+
+    def admit(self, user_id):
+        """Block until the turn may run and return its ticket (sync routes)"""
+        admitted = threading.Event()
+        ticket = self._enqueue(user_id, admitted.set)
+        if not admitted.wait(self.max_wait):
+            self._give_up(ticket)
+        return ticket
+
+    async def admit_async(self, user_id):
+        """Async counterpart of admit; the event loop is not blocked while waiting"""
+        loop = asyncio.get_running_loop()
+        admitted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: admitted.done() or admitted.set_result(True))
+
+        ticket = self._enqueue(user_id, wake)
+        try:
+            await asyncio.wait_for(asyncio.shield(admitted), self.max_wait)
+        except asyncio.TimeoutError:
+            self._give_up(ticket)
+        except asyncio.CancelledError:
+            # Client went away while queued (or just after being admitted)
+            self._give_up(ticket, cancelled=True)
+            raise
+        return ticket
+
+    def release(self, ticket):
+        """Free the slot of a finished turn (safe to call more than once)"""
+        with self._lock:
+            if ticket.released or ticket.admitted_at is None:
+                return
+            ticket.released = True
+            self._in_flight -= 1
+            self._active_users.discard(ticket.user_id)
+            elapsed = time.monotonic() - ticket.admitted_at
+            # Moving average of turn duration, for Retry-After
+            self._turn_seconds = elapsed if self._turn_seconds is None else 0.9 * self._turn_seconds + 0.1 * elapsed
+            self._dispatch()
+
+    def retry_after(self):
+        """Seconds until a new turn would likely be admitted"""
+        turn_seconds = self._turn_seconds or DEFAULT_TURN_SECONDS
+        estimate = turn_seconds * (len(self._waiting) / max(self.max_concurrency, 1) + 1)
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(estimate)))
+
+    def _enqueue(self, user_id, wake):
+        with self._lock:
+            self.queue_depth.observe(len(self._waiting))
+            if len(self._waiting) >= self.max_queue:
+                self.rejected_queue_full += 1
+                logger.warning(f"Admission queue full ({len(self._waiting)}), rejecting turn of user {user_id}")
+                raise AdmissionRejected("queue_full", self.retry_after())
+            ticket = Ticket(user_id, wake)
+            self._waiting.append(ticket)
+            self._dispatch()
+            return ticket
+
+    def _give_up(self, ticket, cancelled=False):
+        with self._lock:
+            if ticket.admitted_at is None:
+                self._waiting.remove(ticket)
+                if cancelled:
+                    return
+                self.rejected_timeout += 1
+                logger.warning(f"Turn of user {ticket.user_id} not admitted within {self.max_wait}s")
+                raise AdmissionRejected("timeout", self.retry_after())
+        # Admitted at the last moment: keep the slot, unless the caller is gone
+        if cancelled:
+            self.release(ticket)
+
+    def _dispatch(self):
+        """Admit waiting turns in arrival order while slots are free (lock held)"""
+        for ticket in list(self._waiting):
+            if self._in_flight >= self.max_concurrency:
+                break
+            if ticket.user_id in self._active_users:
+                continue
+            self._waiting.remove(ticket)
+            self._in_flight += 1
+            self._active_users.add(ticket.user_id)
+            ticket.admitted_at = time.monotonic()
+            self.admitted += 1
+            self.wait_seconds.observe(ticket.admitted_at - ticket.enqueued_at)
+            ticket.wake()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "waiting": len(self._waiting),
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_timeout": self.rejected_timeout,
+                "max_concurrency": self.max_concurrency,
+                "max_wait_s": self.max_wait,
+                "max_queue": self.max_queue,
+                "avg_turn_s": round(self._turn_seconds, 3) if self._turn_seconds is not None else None,
+                "queue_depth": self.queue_depth.snapshot(),
+                "wait_seconds": self.wait_seconds.snapshot()
+            }
+
+admission = AdmissionController()
+register_stats("admission", admission.stats)
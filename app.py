@@ -2,15 +2,23 @@ from flask import Flask, render_template, session, redirect, url_for, request, j
 from datetime import datetime, timedelta
 import pytz
 import json
-from openai import OpenAI
 import logging
 from dotenv import load_dotenv
 import os
+import atexit
 from functools import wraps
 from routes.admin import admin_bp
 from routes.upload import create_upload_routes
-from database import users_collection, sessions_collection, messages_collection
+from database import users_collection, sessions_collection, messages_collection, prompts_collection
 from utils import get_topic_name
+from summarizer import SessionSummarizer
+from llm_transport import create_openai_client
+from prompt_registry import PromptRegistry
+from user_loader import get_request_user_query_count
+from work_queue import work_queue
+from metrics import instrument_app
+from mongo_monitor import monitor_requests
+from index_migrations import migrate_indexes
 
 # Load environment variables first
 load_dotenv()
@@ -19,6 +27,8 @@ load_dotenv()
 gmt8 = pytz.timezone('Asia/Singapore')  
 client = None
 logger = None
+summarizer = None
+prompt_registry = None
 
 # authentication decorator
 def login_required(f):
@@ -29,28 +39,11 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Load system prompt
-import json
-
-def load_system_message(file_path="rule.md"):
-    """Load system message from rule.md."""
-    with open(file_path, "r", encoding="utf-8") as file:
-        data = file.read()
-    return {"role": "system", "content": data}
-
 # Ensure indexes for performance
 def setup_indexes():
+    """Create or drop only the indexes that changed since the last boot (see index_migrations)"""
     try:
-        # Delete old indexes
-        messages_collection.drop_indexes()
-        sessions_collection.drop_indexes()
-        
-        # Create new indexes
-        sessions_collection.create_index([("session_id", 1)], unique=True)
-        sessions_collection.create_index([("updated_at", -1)])
-        messages_collection.create_index([("session_id", 1)])
-        messages_collection.create_index([("sequence", 1)])
-        
+        migrate_indexes()
         logger.info("Database indexes setup completed successfully")
     except Exception as e:
         logger.error(f"Error setting up indexes: {str(e)}")
@@ -61,7 +54,7 @@ def generate_secret_key():
     return secrets.token_hex(32)
 
 def create_app():
-    global users_collection, sessions_collection, messages_collection, client, logger
+    global users_collection, sessions_collection, messages_collection, client, logger, summarizer, prompt_registry
     
     # Create Flask application
     app = Flask(__name__)
@@ -102,11 +95,18 @@ def create_app():
     # Load environment variables
     load_dotenv()
 
-    # OpenAI API settings
-    client = OpenAI(
-        api_key=os.getenv('OPENAI_API_KEY'),
-        base_url=os.getenv('OPENAI_BASE_URL')
-    )
+    # OpenAI API settings (pool, timeouts, retries and hedging: see llm_transport)
+    client = create_openai_client()
+
+    # Background compaction of long sessions into rolling summaries
+    summarizer = SessionSummarizer(client, sessions_collection, messages_collection)
+
+    # System prompts are stored once and referenced by sessions (rule.md is hot-reloaded)
+    prompt_registry = PromptRegistry(prompts_collection)
+    app.extensions['prompt_registry'] = prompt_registry
+    
+    # Indexes (unique email/username among them) before any route runs; one read when up to date
+    setup_indexes()
     
     # Create blueprints
     from routes.auth import create_auth_routes
@@ -116,7 +116,7 @@ def create_app():
     reset_tokens_collection = users_collection.database.get_collection('reset_tokens')
     
     auth_bp = create_auth_routes(users_collection, gmt8, reset_tokens_collection)
-    chat_bp = create_chat_routes(sessions_collection, messages_collection, client, gmt8, load_system_message)
+    chat_bp = create_chat_routes(sessions_collection, messages_collection, client, gmt8, prompt_registry, summarizer)
     upload_bp = create_upload_routes()
     
     # Register blueprints
@@ -124,6 +124,16 @@ def create_app():
     app.register_blueprint(chat_bp)
     app.register_blueprint(admin_bp)
     app.register_blueprint(upload_bp)
+
+    # Per-route request histograms and mongo/llm/tool/json spans (see /admin/metrics)
+    instrument_app(app)
+
+    # MongoDB commands per (sampled) request, checked against the query budgets
+    monitor_requests(app)
+
+    # Background writes: retry what an earlier run spooled, drain the queue on exit
+    work_queue.replay_spool()
+    atexit.register(work_queue.shutdown)
     
     # API endpoint to get math topics in specified language
     @app.route('/api/math_topics/<lang_code>', methods=['GET'])
@@ -131,6 +141,16 @@ def create_app():
         math_topics = get_topic_name(None, lang_code)
         return jsonify(math_topics)
     
+    # Report how many user documents each request fetched (request-scoped loader)
+    @app.after_request
+    def report_user_queries(response):
+        user_queries = get_request_user_query_count()
+        if user_queries:
+            logger.info(f"{request.method} {request.path}: {user_queries} user document queries")
+            if app.debug or app.testing:
+                response.headers['X-User-Queries'] = str(user_queries)
+        return response
+
     # add 404 error handler
     @app.errorhandler(404)
     def page_not_found(e):
@@ -173,12 +193,10 @@ def create_app():
 
 if __name__ == '__main__':
     app = create_app()
-    setup_indexes()
     app.run(debug=True, threaded=False, use_reloader=True, host='0.0.0.0')
     
 #for replit
 # if __name__ == '__main__':
 #     app = create_app()
-#     setup_indexes()
 #     port = int(os.environ.get('PORT', 5000))
 #     app.run(debug=False, threaded=True, use_reloader=False, host='0.0.0.0', port=port)
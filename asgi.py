@@ -0,0 +1,61 @@
+"""
+ASGI entry point.
+
+The chat routes run natively async (routes/chat_async.py) on the async OpenAI
+client and motor, so one process can hold many in-flight tutoring turns.
+Everything else (auth, admin, upload, pages) is the unchanged Flask app,
+adapted to ASGI. Both share the Flask server-side session.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import session as flask_session
+from quart import Quart
+
+import app as app_module
+from database import get_async_collections
+from llm_transport import create_async_openai_client
+from metrics import instrument_quart_app
+from routes.chat_async import create_async_chat_routes
+from work_queue import work_queue
+
+flask_app = app_module.create_app()
+
+def get_session_user_id(cookie_header):
+    """Read user_id from the Flask server-side session named in the cookie header"""
+    with flask_app.test_request_context(headers={"Cookie": cookie_header}):
+        return flask_session.get("user_id")
+
+async_users_collection, async_messages_collection, async_sessions_collection = get_async_collections()
+
+async_client = create_async_openai_client()
+
+quart_app = Quart(__name__)
+quart_app.register_blueprint(create_async_chat_routes(
+    async_sessions_collection,
+    async_messages_collection,
+    async_users_collection,
+    async_client,
+    app_module.gmt8,
+    app_module.prompt_registry,
+    get_session_user_id,
+    app_module.summarizer
+))
+instrument_quart_app(quart_app)
+
+@quart_app.after_serving
+async def drain_work_queue():
+    await asyncio.to_thread(work_queue.shutdown)
+
+# Paths served by the async chat routes; every other request goes to Flask
+ASYNC_PATHS = {rule.rule for rule in quart_app.url_map.iter_rules() if rule.endpoint != "static"}
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan" or (scope["type"] == "http" and scope["path"] in ASYNC_PATHS):
+        await quart_app(scope, receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
@@ -0,0 +1 @@
+"""Offline benchmarks of the Flask app (see benchmarks/run.py)."""
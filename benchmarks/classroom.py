@@ -0,0 +1,398 @@
+"""
+Classroom load test against a running deployment.
+
+Replays a class of students over HTTP. Each student:
+
+1. logs in through /api/login;
+2. opens a topic session from a topic card: /api/new-session with a
+   topic_id, the page loads (newest /api/history page, /api/sessions,
+   /api/math_topics) and the auto-sent "I would like to learn <topic>";
+3. chats at human pacing (log-normal think time around --think-seconds);
+4. now and then switches to another topic (a new session) or reloads the
+   page (history and sessions again).
+
+Students arrive following --arrival:
+
+- burst: all at once, like a class told to start now;
+- ramp: evenly spread over --ramp-seconds;
+- poisson: random arrivals at a constant average rate over --ramp-seconds;
+- waves: --waves equal groups spread over --ramp-seconds.
+
+Accounts loadtest-<n>@example.com are registered before the run, unless
+--no-register is given. To load the server without OpenAI, start the
+deployment with OPENAI_BASE_URL pointing at the stub
+(python -m benchmarks.stub_openai --latency-ms 800 --jitter-ms 400).
+
+The report gives count, errors, status codes and p50/p95/p99 per request
+type, plus overall throughput. It also gives a timeline in --window
+second buckets: throughput, active students, in-flight chats, chat p95
+and error rate. The saturation point is the first window in which chat
+p95 exceeds --slo-ms or the error rate exceeds --max-error-rate. The
+report gives the load at that point and the highest chat throughput
+sustained before it.
+
+Usage:
+
+    python -m benchmarks.classroom --base-url http://localhost:5000 --students 200 --arrival burst \\
+        [--turns 8] [--stream] [--label "gunicorn -w 4 --threads 8"] [--json classroom.json]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.run import percentile
+
+CARD_MESSAGE = {"en": "I would like to learn", "zh": "我想学习", "ms": "Saya ingin belajar"}
+
+STUDENT_MESSAGES = [
+    "Can you give me an example?",
+    "I don't understand this step, can you explain it again?",
+    "Is the answer x = 4?",
+    "I think I solved it: the answer is 12.",
+    "Why do we divide both sides?",
+    "Can I try a harder question?",
+    "What is the formula for this?",
+    "I got 3/4, is that right?",
+]
+
+CHAT_LABELS = ("chat", "topic_card_chat")
+# The chat page loads the newest history page (static/js/chat.js)
+HISTORY_PAGE_SIZE = 30
+
+class Recorder:
+    """Request samples and load gauges of one run"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.samples = []
+        self.gauges = []
+        self.active_students = 0
+        self.in_flight_chats = 0
+
+    def now(self):
+        return time.monotonic() - self.started
+
+    def record(self, label, start, status):
+        end = self.now()
+        self.samples.append({"label": label, "start": start, "end": end, "ms": (end - start) * 1000, "status": status})
+
+    async def sample_gauges(self, interval=1.0):
+        while True:
+            self.gauges.append((self.now(), self.active_students, self.in_flight_chats))
+            await asyncio.sleep(interval)
+
+def is_error(status):
+    return not isinstance(status, int) or status >= 400
+
+async def call(http, recorder, label, method, path, stream=False, **kwargs):
+    """Send one request and record it; returns (response or None, body)"""
+    start = recorder.now()
+    chat = label in CHAT_LABELS
+    if chat:
+        recorder.in_flight_chats += 1
+    status, response, body = None, None, None
+    try:
+        if stream:
+            body = []
+            async with http.stream(method, path, **kwargs) as response:
+                first = None
+                async for line in response.aiter_lines():
+                    if first is None and line.startswith("data:"):
+                        first = recorder.now()
+                        recorder.samples.append({
+                            "label": f"{label}_first_event", "start": start, "end": first,
+                            "ms": (first - start) * 1000, "status": response.status_code
+                        })
+                    if line.startswith("data:"):
+                        body.append(json.loads(line[5:]))
+                status = response.status_code
+                if any(event.get("type") == "error" for event in body):
+                    status = "stream_error"
+        else:
+            response = await http.request(method, path, **kwargs)
+            status = response.status_code
+            body = response.json() if response.headers.get("content-type", "").startswith("application/json") else None
+    except (httpx.HTTPError, ValueError) as e:
+        status = type(e).__name__
+    finally:
+        if chat:
+            recorder.in_flight_chats -= 1
+        recorder.record(label, start, status)
+    return response, body
+
+def think_time(rng, median_seconds):
+    if median_seconds <= 0:
+        return 0
+    return rng.lognormvariate(math.log(median_seconds), 0.5)
+
+def arrival_offsets(args, rng):
+    """Start time (seconds from the beginning of the run) of each student"""
+    n = args.students
+    if args.arrival == "burst" or n == 1:
+        return [0.0] * n
+    if args.arrival == "ramp":
+        return [args.ramp_seconds * i / (n - 1) for i in range(n)]
+    if args.arrival == "poisson":
+        rate = n / args.ramp_seconds
+        offsets, t = [], 0.0
+        for _ in range(n):
+            offsets.append(t)
+            t += rng.expovariate(rate)
+        return offsets
+    # waves
+    waves = max(1, args.waves)
+    spacing = args.ramp_seconds / max(1, waves - 1)
+    return [spacing * min(waves - 1, i * waves // n) for i in range(n)]
+
+def student_account(index):
+    return {
+        "email": f"loadtest-{index}@example.com",
+        "username": f"loadtest{index}",
+        "password": "loadtest-password",
+        "language": "en"
+    }
+
+class Student:
+    def __init__(self, index, args, recorder):
+        self.index = index
+        self.args = args
+        self.recorder = recorder
+        self.rng = random.Random(f"{args.seed}-{index}")
+        self.topics = {}
+        self.session_id = None
+
+    async def chat(self, http, message, label="chat"):
+        path = "/api/chat/stream" if self.args.stream else "/api/chat"
+        await call(http, self.recorder, label, "POST", path, stream=self.args.stream, json={
+            "session_id": self.session_id,
+            "message": message,
+            "user_preferences": {"language": self.args.language}
+        })
+
+    async def reload_page(self, http):
+        await call(http, self.recorder, "history", "GET", "/api/history",
+                   params={"session_id": self.session_id, "limit": HISTORY_PAGE_SIZE})
+        await call(http, self.recorder, "sessions", "GET", "/api/sessions")
+
+    async def open_topic_session(self, http, topic_id):
+        """Click a topic card: new session, page load, auto-sent topic message"""
+        _, body = await call(http, self.recorder, "new_session", "POST", "/api/new-session", json={"topic_id": topic_id})
+        if not body or not body.get("session_id"):
+            return False
+        self.session_id = body["session_id"]
+        await self.reload_page(http)
+        _, topics = await call(http, self.recorder, "math_topics", "GET", f"/api/math_topics/{self.args.language}")
+        if topics:
+            self.topics = {k: v for k, v in topics.items() if k != "other"}
+        topic_name = self.topics.get(topic_id, topic_id)
+        await self.chat(http, f"{CARD_MESSAGE.get(self.args.language, CARD_MESSAGE['en'])} {topic_name}", "topic_card_chat")
+        return True
+
+    async def run(self, start_at):
+        await asyncio.sleep(start_at)
+        self.recorder.active_students += 1
+        try:
+            async with httpx.AsyncClient(base_url=self.args.base_url, timeout=self.args.timeout) as http:
+                account = student_account(self.index)
+                response, _ = await call(http, self.recorder, "login", "POST", "/api/login", json={
+                    "email": account["email"], "password": account["password"]
+                })
+                if response is None or response.status_code != 200:
+                    return
+
+                # Topic ids come from the same endpoint the topic cards use
+                _, topics = await call(http, self.recorder, "math_topics", "GET", f"/api/math_topics/{self.args.language}")
+                self.topics = {k: v for k, v in (topics or {"algebra": "algebra"}).items() if k != "other"}
+                topic_id = self.rng.choice(sorted(self.topics))
+                if not await self.open_topic_session(http, topic_id):
+                    return
+
+                for _ in range(self.args.turns):
+                    await asyncio.sleep(think_time(self.rng, self.args.think_seconds))
+                    roll = self.rng.random()
+                    if roll < self.args.switch_probability:
+                        topic_id = self.rng.choice(sorted(set(self.topics) - {topic_id}) or [topic_id])
+                        if not await self.open_topic_session(http, topic_id):
+                            return
+                        continue
+                    if roll < self.args.switch_probability + self.args.reload_probability:
+                        await self.reload_page(http)
+                    await self.chat(http, self.rng.choice(STUDENT_MESSAGES))
+        finally:
+            self.recorder.active_students -= 1
+
+async def register_students(args):
+    """Create the accounts (existing ones are left as they are)"""
+    semaphore = asyncio.Semaphore(20)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as http:
+        async def register(index):
+            async with semaphore:
+                await http.post("/api/register", json=student_account(index))
+        await asyncio.gather(*(register(i) for i in range(args.students)))
+
+def summarize(samples):
+    latencies = [s["ms"] for s in samples]
+    errors = sum(1 for s in samples if is_error(s["status"]))
+    return {
+        "count": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "statuses": dict(Counter(str(s["status"]) for s in samples)),
+        "p50_ms": round(percentile(latencies, 0.50), 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95), 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99), 1) if latencies else None,
+    }
+
+def build_timeline(recorder, window):
+    buckets = defaultdict(list)
+    for sample in recorder.samples:
+        if not sample["label"].endswith("_first_event"):
+            buckets[int(sample["end"] // window)].append(sample)
+    gauges = defaultdict(list)
+    for t, active, in_flight in recorder.gauges:
+        gauges[int(t // window)].append((active, in_flight))
+
+    timeline = []
+    for index in range(max(list(buckets) + list(gauges) + [0]) + 1):
+        samples = buckets.get(index, [])
+        chats = [s for s in samples if s["label"] in CHAT_LABELS]
+        errors = sum(1 for s in samples if is_error(s["status"]))
+        load = gauges.get(index, [(0, 0)])
+        timeline.append({
+            "t": index * window,
+            "requests_per_s": round(len(samples) / window, 2),
+            "chats_per_s": round(len(chats) / window, 2),
+            "active_students": round(sum(a for a, _ in load) / len(load), 1),
+            "max_in_flight_chats": max(f for _, f in load),
+            "chat_p95_ms": round(percentile([s["ms"] for s in chats], 0.95), 1) if chats else None,
+            "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        })
+    return timeline
+
+def find_saturation(timeline, slo_ms, max_error_rate):
+    """First window breaking the SLO, and the best chat throughput before it"""
+    best = 0.0
+    for window in timeline:
+        breached = (window["chat_p95_ms"] or 0) > slo_ms or window["error_rate"] > max_error_rate
+        if breached and window["chats_per_s"] + window["requests_per_s"] > 0:
+            return {
+                "saturated": True,
+                "at_s": window["t"],
+                "active_students": window["active_students"],
+                "in_flight_chats": window["max_in_flight_chats"],
+                "chat_p95_ms": window["chat_p95_ms"],
+                "error_rate": window["error_rate"],
+                "max_sustained_chats_per_s": best,
+            }
+        best = max(best, window["chats_per_s"])
+    return {
+        "saturated": False,
+        "peak_active_students": max((w["active_students"] for w in timeline), default=0),
+        "peak_in_flight_chats": max((w["max_in_flight_chats"] for w in timeline), default=0),
+        "max_sustained_chats_per_s": best,
+    }
+
+def print_report(report):
+    meta = report["meta"]
+    print(f"Classroom load test: {meta['students']} students, {meta['arrival']} arrival, "
+          f"{meta['duration_s']}s{' — ' + meta['label'] if meta['label'] else ''}")
+    print(f"\n{'request':<26}{'count':>8}{'errors':>8}{'p50_ms':>10}{'p95_ms':>10}{'p99_ms':>10}  statuses")
+    for label, row in report["requests"].items():
+        print(f"{label:<26}{row['count']:>8}{row['errors']:>8}{row['p50_ms'] or '':>10}{row['p95_ms'] or '':>10}"
+              f"{row['p99_ms'] or '':>10}  {row['statuses']}")
+    print(f"\nThroughput: {report['throughput']['requests_per_s']} req/s, {report['throughput']['chats_per_s']} chats/s")
+
+    print(f"\n{'t_s':>6}{'req/s':>9}{'chats/s':>9}{'students':>10}{'in_flight':>11}{'chat_p95':>10}{'err_rate':>10}")
+    for w in report["timeline"]:
+        print(f"{w['t']:>6}{w['requests_per_s']:>9}{w['chats_per_s']:>9}{w['active_students']:>10}"
+              f"{w['max_in_flight_chats']:>11}{w['chat_p95_ms'] or '':>10}{w['error_rate']:>10}")
+
+    saturation = report["saturation"]
+    if saturation["saturated"]:
+        print(f"\nSaturated at t={saturation['at_s']}s: {saturation['active_students']} active students, "
+              f"{saturation['in_flight_chats']} chats in flight, chat p95 {saturation['chat_p95_ms'] or 'n/a'} ms, "
+              f"error rate {saturation['error_rate']:.1%}. "
+              f"Best sustained before that: {saturation['max_sustained_chats_per_s']} chats/s.")
+    else:
+        print(f"\nNot saturated: up to {saturation['peak_active_students']} active students and "
+              f"{saturation['peak_in_flight_chats']} chats in flight, {saturation['max_sustained_chats_per_s']} chats/s "
+              f"within the SLO.")
+
+async def run(args):
+    if args.register:
+        await register_students(args)
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    sampler = asyncio.ensure_future(recorder.sample_gauges())
+    students = [Student(i, args, recorder) for i in range(args.students)]
+    try:
+        await asyncio.gather(*(s.run(offset) for s, offset in zip(students, arrival_offsets(args, rng))))
+    finally:
+        sampler.cancel()
+    return recorder
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a class of students against a deployment")
+    parser.add_argument('--base-url', default="http://localhost:5000")
+    parser.add_argument('--students', type=int, default=30)
+    parser.add_argument('--arrival', choices=("burst", "ramp", "poisson", "waves"), default="ramp")
+    parser.add_argument('--ramp-seconds', type=float, default=60, help="spread of arrivals (ramp, poisson, waves)")
+    parser.add_argument('--waves', type=int, default=3)
+    parser.add_argument('--turns', type=int, default=8, help="chat turns per student after the topic card")
+    parser.add_argument('--think-seconds', type=float, default=15, help="median pause between turns")
+    parser.add_argument('--switch-probability', type=float, default=0.1, help="chance a turn switches topic")
+    parser.add_argument('--reload-probability', type=float, default=0.1, help="chance a turn reloads the page first")
+    parser.add_argument('--language', default="en", choices=("en", "zh", "ms"))
+    parser.add_argument('--stream', action='store_true', help="use /api/chat/stream")
+    parser.add_argument('--timeout', type=float, default=120, help="per request, seconds")
+    parser.add_argument('--no-register', dest='register', action='store_false')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--window', type=float, default=10, help="timeline bucket, seconds")
+    parser.add_argument('--slo-ms', type=float, default=10000, help="chat p95 above this counts as saturated")
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--label', default="", help="describes the deployment (workers, threads, ...)")
+    parser.add_argument('--json', help="write the report to this file")
+    args = parser.parse_args()
+
+    recorder = asyncio.run(run(args))
+    duration = recorder.now()
+    by_label = defaultdict(list)
+    for sample in recorder.samples:
+        by_label[sample["label"]].append(sample)
+    timeline = build_timeline(recorder, args.window)
+    report = {
+        "meta": {
+            "base_url": args.base_url,
+            "students": args.students,
+            "arrival": args.arrival,
+            "turns": args.turns,
+            "stream": args.stream,
+            "label": args.label,
+            "slo_ms": args.slo_ms,
+            "duration_s": round(duration, 1),
+        },
+        "requests": {label: summarize(samples) for label, samples in sorted(by_label.items())},
+        "throughput": {
+            "requests_per_s": round(sum(1 for s in recorder.samples if not s["label"].endswith("_first_event")) / duration, 2),
+            "chats_per_s": round(sum(1 for s in recorder.samples if s["label"] in CHAT_LABELS) / duration, 2),
+        },
+        "timeline": timeline,
+        "saturation": find_saturation(timeline, args.slo_ms, args.max_error_rate),
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Query plan check of the hot MongoDB queries against index_migrations.INDEX_SPEC.
+
+Creates a throwaway database on a real MongoDB (mongomock has no explain),
+applies the index migrations, seeds a few users, sessions and messages and
+runs explain() on every query in HOT_QUERIES: the reads, updates and
+deletes issued per request by routes/chat.py, routes/admin.py and the
+helpers they call. A winning plan with a COLLSCAN (no index used) or a
+SORT stage (sorted in memory instead of read in index order) fails the
+check, and the script exits non-zero.
+
+Keep HOT_QUERIES in step with the routes: a new query, or a changed
+filter or sort, belongs here together with the index it needs.
+
+Usage:
+
+    python -m benchmarks.query_plans [--mongo-uri mongodb://localhost:27017] [--db-name mathmentor_query_plans]
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Plan stages that fail the check
+FAILING_STAGES = {"COLLSCAN": "collection scan", "SORT": "in-memory sort"}
+
+SEED_USERS = 3
+SEED_SESSIONS_PER_USER = 4
+SEED_MESSAGES_PER_SESSION = 12
+
+def hot_queries(user_id, session_id):
+    """(label, collection, filter, sort) of every hot query; user_id is an ObjectId"""
+    from routes.chat import history_page_filter
+    from sequence_allocator import reservation_filter
+    from summarizer import get_history_filter
+    from token_usage import daily_usage_id, usage_day
+
+    now = datetime.now()
+    summarized = {"summary": "...", "summary_upto": 4}
+    return [
+        # routes/chat.py
+        ("chat: session by id", "sessions", {"session_id": session_id}, None),
+        ("chat: reserve sequences", "sessions", reservation_filter(session_id, str(user_id)), None),
+        ("chat: session list", "sessions", {"user_id": str(user_id)}, [("updated_at", -1)]),
+        ("chat: transcript", "messages", {"session_id": session_id}, [("sequence", 1)]),
+        ("chat: unsummarized history", "messages", get_history_filter(session_id, summarized), [("sequence", 1)]),
+        ("chat: history page", "messages", history_page_filter(session_id, 9), [("sequence", -1)]),
+        ("chat: highest sequence", "messages", {"session_id": session_id}, [("sequence", -1)]),
+        ("chat: message by sequence", "messages", {"session_id": session_id, "sequence": 3}, None),
+        ("chat: user", "users", {"_id": user_id}, None),
+        ("chat: topic progression", "users", {"_id": user_id, "progression.topics.id": "algebra"}, None),
+        ("chat: prompt version", "prompts", {"version": "v1"}, None),
+        ("chat: daily token usage", "token_usage", {"_id": daily_usage_id(str(user_id), usage_day())}, None),
+        ("summarizer: messages to fold", "messages",
+         {"session_id": session_id, "role": {"$in": ["user", "assistant"]}, "sequence": {"$gt": 2, "$lte": 8}},
+         [("sequence", 1)]),
+        # routes/admin.py
+        ("admin: user sessions", "sessions", {"user_id": {"$in": [str(user_id), user_id]}}, [("updated_at", -1)]),
+        ("admin: session messages", "messages", {"session_id": session_id}, [("sequence", 1)]),
+        # routes/auth.py
+        ("auth: login", "users", {"email": "student-1@example.com"}, None),
+        ("auth: register pre-check", "users",
+         {"$or": [{"email": "student-1@example.com"}, {"username": "student-1"}]}, None),
+        ("auth: reset token", "reset_tokens", {"token": "token", "expiry": {"$gt": now}}, None),
+    ]
+
+def seed(collections):
+    """A few users with sessions and messages, so the planner has indexes and data to choose from"""
+    from bson import ObjectId
+
+    now = datetime.now()
+    user_ids = [ObjectId() for _ in range(SEED_USERS)]
+    collections["users"].insert_many([
+        {"_id": user_id, "email": f"student-{n}@example.com", "username": f"student-{n}"}
+        for n, user_id in enumerate(user_ids)
+    ])
+    sessions, messages = [], []
+    for user_id in user_ids:
+        for n in range(SEED_SESSIONS_PER_USER):
+            session_id = f"{user_id}-{n}"
+            sessions.append({
+                "session_id": session_id, "user_id": str(user_id), "updated_at": now - timedelta(hours=n),
+                "message_count": SEED_MESSAGES_PER_SESSION - 1,
+                "settled_sequence": SEED_MESSAGES_PER_SESSION, "last_sequence": SEED_MESSAGES_PER_SESSION
+            })
+            messages.extend(
+                {"session_id": session_id, "sequence": sequence, "role": "user" if sequence % 2 else "assistant",
+                 "content": "..."}
+                for sequence in range(2, SEED_MESSAGES_PER_SESSION + 1)
+            )
+    collections["sessions"].insert_many(sessions)
+    collections["messages"].insert_many(messages)
+    return user_ids[0], sessions[0]["session_id"]
+
+def plan_stages(plan):
+    """(stage, index name) of every stage in a winning plan, classic or slot-based engine"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append((plan["stage"], plan.get("indexName")))
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(plan_stages(item))
+    return stages
+
+def check_query(collection, query, sort):
+    cursor = collection.find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    stages = plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+    problems = [FAILING_STAGES[stage] for stage, _ in stages if stage in FAILING_STAGES]
+    indexes = sorted({index for _, index in stages if index})
+    return problems, indexes
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail on hot MongoDB queries without a usable index")
+    parser.add_argument('--mongo-uri', default="mongodb://localhost:27017")
+    parser.add_argument('--db-name', default="mathmentor_query_plans", help="database created and dropped for the run")
+    args = parser.parse_args()
+
+    from pymongo import MongoClient
+    from index_migrations import migrate_indexes
+
+    client = MongoClient(args.mongo_uri)
+    db = client[args.db_name]
+    collections = {name: db[name] for name in ("sessions", "messages", "prompts", "users", "reset_tokens", "token_usage")}
+    try:
+        migrate_indexes(collections, db["schema_migrations"], force=True)
+        user_id, session_id = seed(collections)
+        failures = 0
+        for label, name, query, sort in hot_queries(user_id, session_id):
+            problems, indexes = check_query(collections[name], query, sort)
+            status = "FAIL " + ", ".join(problems) if problems else "ok"
+            print(f"{label:<32} {status:<28} {', '.join(indexes) or '_id'}")
+            failures += bool(problems)
+    finally:
+        client.drop_database(args.db_name)
+
+    if failures:
+        sys.exit(f"{failures} queries without a usable index (see index_migrations.INDEX_SPEC)")
+    print("All hot queries use an index")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+"""
+End-to-end latency benchmark of the Flask app, without OpenAI.
+
+Boots create_app() against mongomock (default) or a local MongoDB
+(--mongo-uri; a throwaway database that is dropped afterwards) and the stub
+OpenAI server (benchmarks/stub_openai.py), which runs in a subprocess so it
+shares neither the GIL nor the allocation counts. Requests go through the
+Flask test client, so what is measured is the app itself: routing, MongoDB,
+prompt building and the HTTP round trip to the stub.
+
+Scenarios: new_session, chat_plain (no tool call), chat_tools
+(set_current_topic, then the follow-up completion), history and sessions.
+For each one the report gives:
+
+- latency p50/p95/p99 and the median time spent waiting on the LLM;
+- MongoDB operations per request, including the background writes the
+  request queued;
+- peak memory allocated while handling one request (a separate pass under
+  tracemalloc, which slows requests down).
+
+Against a real MongoDB every request also goes through mongo_monitor: the
+requests over the MongoDB query budgets and the slow command shapes are
+logged (mongomock issues no command events).
+
+Save a run with --json and compare a later one against it with --baseline.
+Changes beyond --threshold, and any extra MongoDB operation, are flagged;
+--fail-on-regression makes them exit non-zero.
+
+Usage:
+
+    python -m benchmarks.run [--iterations 200] [--latency-ms 0] [--mongo-uri mongodb://localhost:27017]
+                             [--json results.json] [--baseline results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Collection methods counted as one MongoDB operation when running on mongomock
+MONGOMOCK_OPERATIONS = (
+    "find", "find_one", "find_one_and_update", "find_one_and_delete", "insert_one", "insert_many",
+    "update_one", "update_many", "replace_one", "delete_one", "delete_many", "count_documents",
+    "aggregate", "bulk_write",
+)
+# Connection housekeeping, not issued by the app
+IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "endSessions", "saslStart", "saslContinue", "buildInfo"}
+
+COMPARED_METRICS = ("p50_ms", "p95_ms", "mongo_ops", "alloc_peak_kb")
+
+BENCHMARK_USER = {"email": "benchmark@example.com", "username": "benchmark", "password": "benchmark", "language": "en"}
+
+class Counter:
+    """Thread-safe counter that can be reset between requests"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def add(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def reset(self):
+        with self._lock:
+            self.value = 0
+
+def count_pymongo_commands(counter):
+    from pymongo import monitoring
+
+    class CommandCounter(monitoring.CommandListener):
+        def started(self, event):
+            if event.command_name not in IGNORED_COMMANDS:
+                counter.add()
+
+        def succeeded(self, event):
+            pass
+
+        def failed(self, event):
+            pass
+
+    monitoring.register(CommandCounter())
+
+def count_mongomock_operations(counter):
+    from mongomock.collection import Collection
+    # mongomock implements some operations with others (find_one_and_update calls find_one)
+    depth = threading.local()
+
+    def counted(method):
+        def wrapper(*args, **kwargs):
+            if getattr(depth, "value", 0) == 0:
+                counter.add()
+            depth.value = getattr(depth, "value", 0) + 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                depth.value -= 1
+        return wrapper
+
+    for name in MONGOMOCK_OPERATIONS:
+        setattr(Collection, name, counted(getattr(Collection, name)))
+
+def time_llm_calls(llm_seconds):
+    """Accumulate the time the app spends inside chat.completions.create"""
+    from llm_transport import ChatTransport
+    original = ChatTransport.create
+
+    def create(self, **params):
+        start = time.perf_counter()
+        try:
+            return original(self, **params)
+        finally:
+            llm_seconds.add(time.perf_counter() - start)
+
+    ChatTransport.create = create
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_stub(args):
+    port = free_port()
+    command = [
+        sys.executable, "-m", "benchmarks.stub_openai", "--port", str(port),
+        "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms)
+    ]
+    if args.script:
+        command += ["--script", os.path.abspath(args.script)]
+    process = subprocess.Popen(command, cwd=REPO_ROOT, stdout=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}/v1"
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"{base_url}/health", timeout=1).read()
+            return process, base_url
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    sys.exit("Stub OpenAI server did not start")
+
+def boot_app(args, base_url, workdir):
+    """Configure the environment, patch in the counters and create the app"""
+    os.environ.update({
+        "MONGODB_URI": args.mongo_uri or "mongodb://localhost:27017",
+        "MONGODB_DB_NAME": args.db_name,
+        "MONGODB_COLLECTION_USERS": "users",
+        "MONGODB_COLLECTION_MESSAGES": "messages",
+        "MONGODB_COLLECTION_SESSIONS": "sessions",
+        "MONGODB_COLLECTION_PROMPTS": "prompts",
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": base_url,
+        "FLASK_SECRET_KEY": "benchmark",
+        "SYSTEM_PROMPT_FILE": os.path.join(REPO_ROOT, "rule.md"),
+        "WORK_QUEUE_SPOOL": os.path.join(workdir, "work_queue_spool.jsonl"),
+        # Attribute every request's MongoDB commands and log the ones over budget
+        "MONGO_MONITOR_SAMPLE_RATE": "1",
+    })
+    mongo_ops = Counter()
+    if args.mongo_uri:
+        count_pymongo_commands(mongo_ops)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is not installed (pip install -r benchmarks/requirements.txt), or pass --mongo-uri")
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        count_mongomock_operations(mongo_ops)
+
+    llm_seconds = Counter()
+    time_llm_calls(llm_seconds)
+
+    # create_app() resets ./flask_session, so run it from the scratch directory
+    os.chdir(workdir)
+    import app as app_module
+    app = app_module.create_app()
+    return app_module, app, mongo_ops, llm_seconds
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))]
+
+class Bench:
+    """Runs the scenarios against one logged-in test client"""
+
+    def __init__(self, app, mongo_ops, llm_seconds):
+        from work_queue import work_queue
+        self.work_queue = work_queue
+        self.client = app.test_client()
+        self.mongo_ops = mongo_ops
+        self.llm_seconds = llm_seconds
+        self.user_id = self.login()
+        self._plain_session = None
+        self._plain_turns = 0
+        self._history_session = None
+
+    def login(self):
+        response = self.client.post('/api/register', json=BENCHMARK_USER)
+        if response.status_code != 200:
+            response = self.client.post('/api/login', json=BENCHMARK_USER)
+        if response.status_code != 200:
+            sys.exit(f"Could not log in the benchmark user: {response.get_data(as_text=True)}")
+        with self.client.session_transaction() as flask_session:
+            return flask_session["user_id"]
+
+    def new_session(self):
+        return self.client.post('/api/new-session', json={}).get_json()["session_id"]
+
+    def chat(self, session_id, message):
+        return self.client.post('/api/chat', json={
+            "session_id": session_id, "message": message, "user_preferences": {"language": "en"}
+        })
+
+    def plain_session(self):
+        """A session that grows for 10 turns before a new one is started"""
+        if self._plain_session is None or self._plain_turns >= 10:
+            self._plain_session, self._plain_turns = self.new_session(), 0
+        self._plain_turns += 1
+        return self._plain_session
+
+    def history_session(self):
+        """A session with 10 turns, built once"""
+        if self._history_session is None:
+            self._history_session = self.new_session()
+            for i in range(10):
+                self.chat(self._history_session, f"What is {i} + {i}?")
+            self.settle()
+        return self._history_session
+
+    def scenarios(self):
+        """(name, setup returning the request argument, timed request)"""
+        return [
+            ("new_session", None, lambda _: self.client.post('/api/new-session', json={})),
+            ("chat_plain", self.plain_session, lambda sid: self.chat(sid, "What is 2 + 2?")),
+            ("chat_tools", self.new_session, lambda sid: self.chat(sid, "Teach me algebra")),
+            ("history", self.history_session, lambda sid: self.client.get(f'/api/history?session_id={sid}')),
+            ("sessions", None, lambda _: self.client.get('/api/sessions')),
+        ]
+
+    def settle(self):
+        """Wait for the background writes queued so far"""
+        self.work_queue.flush(self.user_id)
+
+    def measure(self, setup, request):
+        """One timed request: (seconds, llm seconds, mongo ops, ok)"""
+        argument = setup() if setup else None
+        self.settle()
+        self.mongo_ops.reset()
+        self.llm_seconds.reset()
+        start = time.perf_counter()
+        response = request(argument)
+        elapsed = time.perf_counter() - start
+        self.settle()
+        return elapsed, self.llm_seconds.value, self.mongo_ops.value, response.status_code == 200
+
+    def measure_allocations(self, setup, request):
+        """Peak bytes allocated while handling one request (tracemalloc must be running)"""
+        argument = setup() if setup else None
+        self.settle()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        request(argument)
+        peak = tracemalloc.get_traced_memory()[1]
+        self.settle()
+        return max(0, peak - before)
+
+    def run(self, iterations, warmup, alloc_iterations):
+        results = {}
+        for name, setup, request in self.scenarios():
+            for _ in range(warmup):
+                self.measure(setup, request)
+            samples = [self.measure(setup, request) for _ in range(iterations)]
+            latencies = [s[0] * 1000 for s in samples]
+            results[name] = {
+                "n": iterations,
+                "errors": sum(1 for s in samples if not s[3]),
+                "p50_ms": round(percentile(latencies, 0.50), 2),
+                "p95_ms": round(percentile(latencies, 0.95), 2),
+                "p99_ms": round(percentile(latencies, 0.99), 2),
+                "llm_p50_ms": round(percentile([s[1] * 1000 for s in samples], 0.50), 2),
+                "mongo_ops": round(statistics.mean(s[2] for s in samples), 2),
+            }
+
+        tracemalloc.start()
+        try:
+            for name, setup, request in self.scenarios():
+                peaks = [self.measure_allocations(setup, request) for _ in range(alloc_iterations)]
+                results[name]["alloc_peak_kb"] = round(statistics.median(peaks) / 1024, 1)
+        finally:
+            tracemalloc.stop()
+        return results
+
+def print_report(results):
+    columns = ("n", "errors", "p50_ms", "p95_ms", "p99_ms", "llm_p50_ms", "mongo_ops", "alloc_peak_kb")
+    print(f"{'scenario':<14}" + "".join(f"{c:>14}" for c in columns))
+    for name, row in results.items():
+        print(f"{name:<14}" + "".join(f"{row.get(c, ''):>14}" for c in columns))
+
+def compare(results, baseline, threshold):
+    """Print changes against a saved run; returns the regressions"""
+    regressions = []
+    print(f"\nAgainst baseline (threshold {threshold:.0%}):")
+    for name, row in results.items():
+        old_row = baseline.get("results", {}).get(name)
+        if not old_row:
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = old_row.get(metric), row.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else (0.0 if new == old else float("inf"))
+            # MongoDB operation counts are deterministic, any increase is a regression
+            regressed = new > old if metric == "mongo_ops" else change > threshold
+            if regressed:
+                regressions.append((name, metric, old, new))
+            marker = "  REGRESSION" if regressed else ""
+            print(f"  {name:<14}{metric:<15}{old:>10} -> {new:<10} ({change:+.1%}){marker}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency benchmark of the chat routes")
+    parser.add_argument('--iterations', type=int, default=200, help="timed requests per scenario")
+    parser.add_argument('--warmup', type=int, default=10, help="untimed requests per scenario first")
+    parser.add_argument('--alloc-iterations', type=int, default=20, help="requests per scenario under tracemalloc")
+    parser.add_argument('--latency-ms', type=float, default=0, help="stub LLM delay per completion")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="random +/- on the stub delay")
+    parser.add_argument('--script', help="reply rules for the stub (see benchmarks/stub_openai.py)")
+    parser.add_argument('--mongo-uri', help="local MongoDB to use instead of mongomock")
+    parser.add_argument('--db-name', default="mathmentor_benchmark", help="database created and dropped for the run")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results file of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.15, help="relative change flagged as a regression")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="mathmentor-bench-")
+    stub, base_url = start_stub(args)
+    cwd = os.getcwd()
+    app_module = None
+    try:
+        app_module, app, mongo_ops, llm_seconds = boot_app(args, base_url, workdir)
+        results = Bench(app, mongo_ops, llm_seconds).run(args.iterations, args.warmup, args.alloc_iterations)
+    finally:
+        stub.terminate()
+        os.chdir(cwd)
+        if app_module is not None:
+            from work_queue import work_queue
+            work_queue.shutdown()
+            if args.mongo_uri:
+                import database
+                database.client.drop_database(args.db_name)
+
+    report = {
+        "meta": {
+            "iterations": args.iterations,
+            "latency_ms": args.latency_ms,
+            "mongo": "mongodb" if args.mongo_uri else "mongomock",
+            "python": platform.python_version(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results
+    }
+    print_report(results)
+    if args.mongo_uri:
+        from mongo_monitor import mongo_monitor
+        monitor = mongo_monitor.stats()
+        print(f"\nMongoDB budget: {monitor['over_budget']} of {monitor['requests_monitored']} requests over, "
+              f"{monitor['slow_commands']} slow commands (see the warnings above)")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
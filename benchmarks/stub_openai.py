@@ -0,0 +1,211 @@
+"""
+Stub OpenAI-compatible server for benchmarks and load tests.
+
+Serves POST /v1/chat/completions (plain and streamed, with usage) after a
+configurable delay, so the app's own overhead can be measured without
+calling OpenAI. Replies follow a script: a JSON list of rules, the first
+rule whose "match" substring is in the last user message wins:
+
+    [
+        {"match": "teach me algebra", "tool_calls": [
+            {"name": "set_current_topic", "arguments": {"topic_id": "algebra"}}
+        ]},
+        {"match": "", "content": "Let's look at an example."}
+    ]
+
+Tool-call rules only apply when the request offers those tools and its last
+message is from the user, so the follow-up call after tool results always
+gets text. GET /health answers 200 once the server is up.
+
+Usage:
+
+    python -m benchmarks.stub_openai [--port 8001] [--latency-ms 300] [--jitter-ms 100] [--script rules.json]
+"""
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_SCRIPT = [
+    {"match": "teach me algebra", "tool_calls": [
+        {"name": "set_current_topic", "arguments": {"topic_id": "algebra"}}
+    ]},
+    {"match": "i solved it", "tool_calls": [
+        {"name": "update_user_progression", "arguments": {"topic_id": "algebra", "progress": 30, "notes": "solved"}}
+    ]},
+    {"match": "", "content": (
+        "Let's look at an example. If 2x + 3 = 7, subtract 3 from both sides to get 2x = 4, "
+        "then divide by 2 to get x = 2. Can you try solving 3x - 5 = 10?"
+    )},
+]
+
+FOLLOW_UP_CONTENT = "Great, let's start with a simple example. What do you already know about this topic?"
+
+def approximate_tokens(value):
+    return max(1, len(json.dumps(value, ensure_ascii=False)) // 4)
+
+def last_user_message(messages):
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return message.get("content") or ""
+    return ""
+
+def pick_reply(script, request):
+    """(content, tool_calls) for a chat completion request"""
+    messages = request.get("messages", [])
+    offered = {tool["function"]["name"] for tool in request.get("tools") or []}
+    user_turn = bool(messages) and messages[-1].get("role") == "user"
+    text = last_user_message(messages).lower()
+    for rule in script:
+        if rule.get("match", "").lower() not in text:
+            continue
+        tool_calls = rule.get("tool_calls") or []
+        if tool_calls:
+            if not user_turn or not all(call["name"] in offered for call in tool_calls):
+                continue
+            return rule.get("content"), tool_calls
+        return rule.get("content") or FOLLOW_UP_CONTENT, []
+    return FOLLOW_UP_CONTENT, []
+
+def tool_call_payload(index, call):
+    return {
+        "id": f"call_{index}_{uuid.uuid4().hex[:8]}",
+        "type": "function",
+        "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments", {}))}
+    }
+
+def usage_payload(request, content, tool_calls):
+    prompt_tokens = approximate_tokens(request.get("messages", []))
+    completion_tokens = approximate_tokens([content, tool_calls])
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0}
+    }
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately; do not let Nagle delay the body
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/health"):
+            self._send_json(200, {"status": "ok", "calls": self.server.calls})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        with self.server.lock:
+            self.server.calls += 1
+
+        time.sleep(self.server.delay())
+        content, tool_calls = pick_reply(self.server.script, request)
+        payloads = [tool_call_payload(i, call) for i, call in enumerate(tool_calls)]
+        if request.get("stream"):
+            self._stream(request, content, payloads)
+        else:
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "gpt-4o"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content, "tool_calls": payloads or None},
+                    "finish_reason": "tool_calls" if payloads else "stop"
+                }],
+                "usage": usage_payload(request, content, tool_calls)
+            })
+
+    def _stream(self, request, content, tool_calls):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+        def send(choices, usage=None):
+            chunk = {
+                "id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": request.get("model", "gpt-4o"), "choices": choices
+            }
+            if usage is not None:
+                chunk["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        if content:
+            for word in content.split(" "):
+                send([{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}])
+        for index, call in enumerate(tool_calls):
+            send([{"index": 0, "delta": {"tool_calls": [{"index": index, **call}]}, "finish_reason": None}])
+        send([{"index": 0, "delta": {}, "finish_reason": "tool_calls" if tool_calls else "stop"}])
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send([], usage_payload(request, content, tool_calls))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StubOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency_ms=0, jitter_ms=0, script=None):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.script = script or DEFAULT_SCRIPT
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def delay(self):
+        return max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+def load_script(path):
+    if not path:
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stub OpenAI-compatible chat completions server")
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency-ms', type=float, default=0, help="delay before each reply")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="random +/- added to the delay")
+    parser.add_argument('--script', help="JSON file of reply rules (default: built-in script)")
+    args = parser.parse_args()
+
+    server = StubOpenAIServer(args.port, args.latency_ms, args.jitter_ms, load_script(args.script))
+    print(f"Stub OpenAI server on {server.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
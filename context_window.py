@@ -0,0 +1,116 @@
+"""
+Token-budgeted conversation window.
+
+Keeps system messages (system prompt, progression context, tool
+instructions) and the most recent turns, then fills the remaining budget
+with older history, newest first. Tokens are estimated locally so no
+tokenizer dependency or network call is needed on the request path.
+"""
+import logging
+import os
+import re
+import threading
+
+from metrics import register_stats
+
+logger = logging.getLogger(__name__)
+
+# Default budget for prompt tokens; per-model overrides as "model=tokens,model=tokens"
+DEFAULT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '12000'))
+KEEP_RECENT_MESSAGES = int(os.getenv('CONTEXT_KEEP_RECENT_MESSAGES', '6'))
+
+# Fixed per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+def _parse_model_budgets(value):
+    budgets = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            model, tokens = item.split("=", 1)
+            budgets[model.strip()] = int(tokens)
+    return budgets
+
+MODEL_TOKEN_BUDGETS = _parse_model_budgets(os.getenv('CONTEXT_TOKEN_BUDGETS'))
+
+_stats_lock = threading.Lock()
+_stats = {"turns": 0, "trimmed_turns": 0, "dropped_messages": 0, "dropped_tokens": 0}
+
+def estimate_tokens(text):
+    """Rough token count: ~1 token per CJK character, ~4 characters per token otherwise"""
+    if not text:
+        return 0
+    cjk_chars = len(_CJK_PATTERN.findall(text))
+    other_chars = len(text) - cjk_chars
+    return cjk_chars + (other_chars + 3) // 4
+
+def estimate_message_tokens(message):
+    """Estimate the prompt tokens one chat message costs"""
+    tokens = MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.get("content") or "")
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call["function"] if isinstance(tool_call, dict) else tool_call.function
+        arguments = function["arguments"] if isinstance(function, dict) else function.arguments
+        tokens += estimate_tokens(arguments)
+    return tokens
+
+def get_token_budget(model):
+    """Prompt token budget configured for a model"""
+    return MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+
+def fit_to_budget(messages, model, keep_recent=KEEP_RECENT_MESSAGES):
+    """Trim older history so the messages fit the model's token budget.
+
+    System messages and the last keep_recent conversation messages are always
+    kept. Older messages are kept newest first until the budget runs out; the
+    dropped ones are always the oldest contiguous part of the conversation.
+
+    Returns (messages, report) where report has the token estimate and how
+    many messages/tokens were dropped.
+    """
+    budget = get_token_budget(model)
+    costs = [estimate_message_tokens(m) for m in messages]
+
+    conversation = [i for i, m in enumerate(messages) if m.get("role") != "system"]
+    pinned = set(i for i, m in enumerate(messages) if m.get("role") == "system")
+    pinned.update(conversation[-keep_recent:] if keep_recent > 0 else [])
+
+    used = sum(costs[i] for i in pinned)
+    dropped = set()
+    optional = [i for i in conversation if i not in pinned]
+    for position, index in enumerate(reversed(optional)):
+        if used + costs[index] > budget:
+            dropped.update(optional[:len(optional) - position])
+            break
+        used += costs[index]
+
+    window = [m for i, m in enumerate(messages) if i not in dropped]
+    report = {
+        "budget": budget,
+        "estimated_tokens": used,
+        "dropped_messages": len(dropped),
+        "dropped_tokens": sum(costs[i] for i in dropped)
+    }
+
+    with _stats_lock:
+        _stats["turns"] += 1
+        if dropped:
+            _stats["trimmed_turns"] += 1
+            _stats["dropped_messages"] += report["dropped_messages"]
+            _stats["dropped_tokens"] += report["dropped_tokens"]
+
+    if dropped:
+        logger.info(
+            f"Context window for {model}: dropped {report['dropped_messages']} messages "
+            f"(~{report['dropped_tokens']} tokens), kept ~{used}/{budget} tokens"
+        )
+    if used > budget:
+        logger.warning(f"Pinned messages alone (~{used} tokens) exceed the {model} budget of {budget}")
+    return window, report
+
+def get_window_stats():
+    """Totals since process start, for tuning the budget"""
+    with _stats_lock:
+        return dict(_stats)
+
+register_stats("context_window", get_window_stats)
@@ -1,13 +1,34 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 import os
 from dotenv import load_dotenv
+from metrics import mongo_listener
+from mongo_monitor import mongo_monitor
 
 # Load environment variables
 load_dotenv()
 
+# Time every command and attribute it to its request (sync and motor clients created after this)
+monitoring.register(mongo_listener)
+monitoring.register(mongo_monitor)
+
 # MongoDB connection
 client = MongoClient(os.getenv('MONGODB_URI'))
 db = client[os.getenv('MONGODB_DB_NAME')]
 users_collection = db[os.getenv('MONGODB_COLLECTION_USERS')]
 messages_collection = db[os.getenv('MONGODB_COLLECTION_MESSAGES')]
-sessions_collection = db[os.getenv('MONGODB_COLLECTION_SESSIONS')] 
\ No newline at end of file
+sessions_collection = db[os.getenv('MONGODB_COLLECTION_SESSIONS')]
+prompts_collection = db[os.getenv('MONGODB_COLLECTION_PROMPTS', 'prompts')]
+token_usage_collection = db[os.getenv('MONGODB_COLLECTION_TOKEN_USAGE', 'token_usage')]
+
+
+def get_async_collections():
+    """Create motor (async) handles for the same collections, used by the ASGI chat routes."""
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    async_client = AsyncIOMotorClient(os.getenv('MONGODB_URI'))
+    async_db = async_client[os.getenv('MONGODB_DB_NAME')]
+    return (
+        async_db[os.getenv('MONGODB_COLLECTION_USERS')],
+        async_db[os.getenv('MONGODB_COLLECTION_MESSAGES')],
+        async_db[os.getenv('MONGODB_COLLECTION_SESSIONS')],
+    )
@@ -0,0 +1,191 @@
+"""
+Write-through cache of session transcripts, keyed by session_id.
+
+The chat routes (sync and async) populate it when they read a transcript
+and keep it up to date on every write, so the next turn of a session does
+not re-read the whole transcript from MongoDB. Entries carry the sequence
+of each message; callers compare the last sequence with the session's
+settled_sequence to detect entries made stale by another process, and
+bypass the cache while a session has a turn in flight (see
+sequence_allocator). Messages are kept
+in sequence order even when concurrent turns append out of order.
+
+By default the cache is an in-process LRU bounded by an approximate memory
+budget (HISTORY_CACHE_MAX_BYTES). Set HISTORY_CACHE_REDIS_URL to share it
+between workers, sync and async, instead (needs the redis package).
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+HISTORY_CACHE_MAX_BYTES = int(os.getenv('HISTORY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+HISTORY_CACHE_REDIS_URL = os.getenv('HISTORY_CACHE_REDIS_URL')
+HISTORY_CACHE_TTL = int(os.getenv('HISTORY_CACHE_TTL', '86400'))
+
+# Rough per-message overhead of the dict, keys and datetime
+MESSAGE_OVERHEAD_BYTES = 300
+
+def estimate_transcript_bytes(messages):
+    """Approximate memory held by a cached transcript"""
+    return sum(MESSAGE_OVERHEAD_BYTES + len(m.get("content") or "") * 2 for m in messages)
+
+def last_sequence(messages):
+    return messages[-1].get("sequence", 0) if messages else 0
+
+def with_message(messages, message):
+    """messages plus a new one, in sequence order (a concurrent turn may have appended a later one)"""
+    message = dict(message)
+    if not messages or message.get("sequence", 0) >= last_sequence(messages):
+        return messages + [message]
+    return sorted(messages + [message], key=lambda m: m.get("sequence", 0))
+
+class TranscriptCache:
+    """In-process LRU of session transcripts with memory-bounded eviction"""
+
+    def __init__(self, max_bytes=HISTORY_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_id, expected_sequence=None):
+        """Return a copy of the cached transcript, or None on a miss.
+
+        When expected_sequence is given, an entry whose last message has a
+        different sequence is stale and counts as a miss.
+        """
+        with self._lock:
+            messages = self._entries.get(session_id)
+            if messages is not None and expected_sequence is not None and last_sequence(messages) != expected_sequence:
+                self._discard(session_id)
+                messages = None
+            if messages is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return [dict(m) for m in messages]
+
+    def set(self, session_id, messages):
+        with self._lock:
+            self._discard(session_id)
+            self._store(session_id, [dict(m) for m in messages])
+
+    def append(self, session_id, message):
+        """Add a newly written message to a cached transcript (no-op if not cached)"""
+        with self._lock:
+            messages = self._entries.get(session_id)
+            if messages is None:
+                return
+            self._discard(session_id)
+            self._store(session_id, with_message(messages, message))
+
+    def remove_message(self, session_id, sequence):
+        """Drop a message that was rolled back"""
+        with self._lock:
+            messages = self._entries.get(session_id)
+            if messages is None:
+                return
+            self._discard(session_id)
+            self._store(session_id, [m for m in messages if m.get("sequence") != sequence])
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._discard(session_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes
+            }
+
+    def _store(self, session_id, messages):
+        size = estimate_transcript_bytes(messages)
+        if size > self.max_bytes:
+            return
+        self._entries[session_id] = messages
+        self._sizes[session_id] = size
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            evicted_id, _ = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(evicted_id)
+            self.evictions += 1
+
+    def _discard(self, session_id):
+        if session_id in self._entries:
+            del self._entries[session_id]
+            self._bytes -= self._sizes.pop(session_id)
+
+class SharedTranscriptCache:
+    """Same interface backed by a cachelib cache (e.g. Redis) shared by all workers"""
+
+    def __init__(self, backend, timeout=HISTORY_CACHE_TTL):
+        self.backend = backend
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id, expected_sequence=None):
+        messages = self.backend.get(session_id)
+        if messages is not None and expected_sequence is not None and last_sequence(messages) != expected_sequence:
+            self.backend.delete(session_id)
+            messages = None
+        with self._lock:
+            if messages is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return messages
+
+    def set(self, session_id, messages):
+        self.backend.set(session_id, list(messages), timeout=self.timeout)
+
+    def append(self, session_id, message):
+        messages = self.backend.get(session_id)
+        if messages is not None:
+            self.set(session_id, with_message(messages, message))
+
+    def remove_message(self, session_id, sequence):
+        messages = self.backend.get(session_id)
+        if messages is not None:
+            self.set(session_id, [m for m in messages if m.get("sequence") != sequence])
+
+    def invalidate(self, session_id):
+        self.backend.delete(session_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "redis",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+def create_transcript_cache():
+    if HISTORY_CACHE_REDIS_URL:
+        import redis
+        from cachelib.redis import RedisCache
+        backend = RedisCache(redis.from_url(HISTORY_CACHE_REDIS_URL), key_prefix='mathmentor_transcript_')
+        logger.info("Using shared Redis transcript cache")
+        return SharedTranscriptCache(backend)
+    return TranscriptCache()
+
+transcript_cache = create_transcript_cache()
@@ -0,0 +1,180 @@
+"""
+Declarative MongoDB indexes, applied as versioned, idempotent migrations.
+
+INDEX_SPEC lists the indexes each collection should have, by name, chosen
+from the queries the routes actually run (see benchmarks/query_plans.py,
+which checks their plans). A migration compares it with list_indexes() and
+only creates the missing indexes (or rebuilds one whose keys or options
+changed) and drops the RETIRED_INDEXES still present. Indexes that are
+neither in the spec nor retired (added by hand, e.g. a text index) are left
+alone. New indexes are built before retired ones are dropped, so the
+queries keep an index throughout.
+
+Bump INDEX_SPEC_VERSION with every change to the spec. The applied version
+is stored in the schema_migrations collection; create_app() runs
+setup_indexes(), which only reads that one document when the database is
+up to date, and otherwise migrates. Several workers migrating at once is harmless: creating an
+existing index is a no-op and a drop that lost the race is ignored.
+
+If the unique (session_id, sequence) index cannot be built because stored
+messages share a sequence, a non-unique index of the same name is built
+instead and the migration is recorded as degraded; remove the duplicates
+and run this script again. Usage:
+
+    python index_migrations.py [--dry-run]
+"""
+import argparse
+import logging
+from datetime import datetime, timezone
+
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# 1: indexes match the queries (user_id + updated_at for the session list,
+#    (session_id, sequence) for transcripts); the per-field indexes the old
+#    drop-and-recreate setup built are retired.
+INDEX_SPEC_VERSION = 1
+
+INDEX_SPEC = {
+    "sessions": {
+        "session_id_1": {"key": [("session_id", 1)], "unique": True},
+        # /api/sessions and the admin session list: a user's sessions, latest first
+        "user_id_1_updated_at_-1": {"key": [("user_id", 1), ("updated_at", -1)]},
+    },
+    "messages": {
+        # Transcripts, summaries and the sequence allocator (see sequence_allocator)
+        "session_id_1_sequence_1": {"key": [("session_id", 1), ("sequence", 1)], "unique": True},
+    },
+    "prompts": {
+        "version_1": {"key": [("version", 1)], "unique": True},
+    },
+    "users": {
+        "email_1": {"key": [("email", 1)], "unique": True},
+        "username_1": {"key": [("username", 1)], "unique": True},
+    },
+    "reset_tokens": {
+        "token_1": {"key": [("token", 1)]},
+    },
+}
+
+# Indexes built by earlier setups that no query needs any more
+RETIRED_INDEXES = {
+    "sessions": ("updated_at_-1",),
+    "messages": ("session_id_1", "sequence_1"),
+}
+
+MIGRATION_ID = "indexes"
+
+# Error code of a drop that another worker already did
+INDEX_NOT_FOUND = 27
+
+def default_collections():
+    from database import db, users_collection, sessions_collection, messages_collection, prompts_collection
+    return {
+        "sessions": sessions_collection,
+        "messages": messages_collection,
+        "prompts": prompts_collection,
+        "users": users_collection,
+        "reset_tokens": db.get_collection('reset_tokens'),
+    }
+
+def index_matches(index, spec):
+    key = [(field, int(direction)) for field, direction in index["key"].items()]
+    return key == spec["key"] and bool(index.get("unique")) == spec.get("unique", False)
+
+def plan_changes(collection, wanted, retired):
+    """(names to create, names to drop) to bring one collection to the spec"""
+    existing = {index["name"]: index for index in collection.list_indexes()}
+    create, drop = [], []
+    for name, spec in wanted.items():
+        if name not in existing:
+            create.append(name)
+        elif not index_matches(existing[name], spec):
+            # Same name, other keys or options: rebuild
+            drop.append(name)
+            create.append(name)
+    drop.extend(name for name in retired if name in existing)
+    return create, drop
+
+def drop_index(collection, name):
+    try:
+        collection.drop_index(name)
+    except OperationFailure as e:
+        if e.code != INDEX_NOT_FOUND:
+            raise
+
+def create_index(collection, name, spec):
+    """Build one index; returns False when a unique index had to be built non-unique"""
+    # background only matters before MongoDB 4.2, later builds never block the collection
+    try:
+        collection.create_index(spec["key"], name=name, unique=spec.get("unique", False), background=True)
+        return True
+    except DuplicateKeyError as e:
+        logger.error(f"{collection.name} has duplicate {name} keys, built the index non-unique: {str(e)}")
+        collection.create_index(spec["key"], name=name, background=True)
+        return False
+
+def apply_changes(collection, wanted, create, drop):
+    """Rebuilds are dropped first; everything else is built before the retired indexes go"""
+    degraded = []
+    rebuilt = [name for name in drop if name in create]
+    for name in rebuilt:
+        drop_index(collection, name)
+    for name in create:
+        if not create_index(collection, name, wanted[name]):
+            degraded.append(f"{collection.name}.{name}")
+    for name in drop:
+        if name not in rebuilt:
+            drop_index(collection, name)
+    return degraded
+
+def migrate_indexes(collections=None, migrations_collection=None, force=False, dry_run=False):
+    """Bring every collection's indexes to INDEX_SPEC; returns the changes made (or planned)
+
+    Without force nothing is checked when the recorded version is current.
+    """
+    collections = collections or default_collections()
+    if migrations_collection is None:
+        migrations_collection = collections["sessions"].database["schema_migrations"]
+
+    record = migrations_collection.find_one({"_id": MIGRATION_ID}) or {}
+    if not force and record.get("version", 0) >= INDEX_SPEC_VERSION:
+        if record.get("degraded"):
+            logger.warning(f"Indexes built non-unique: {', '.join(record['degraded'])}; run python index_migrations.py once fixed")
+        return []
+
+    changes, degraded = [], []
+    for name, wanted in INDEX_SPEC.items():
+        collection = collections[name]
+        create, drop = plan_changes(collection, wanted, RETIRED_INDEXES.get(name, ()))
+        changes.extend(f"{'rebuild' if index in drop else 'create'} {collection.name}.{index}" for index in create)
+        changes.extend(f"drop {collection.name}.{index}" for index in drop if index not in create)
+        if not dry_run:
+            degraded.extend(apply_changes(collection, wanted, create, drop))
+
+    for change in changes:
+        logger.info(f"{'Would ' + change if dry_run else change.capitalize()}")
+    if dry_run:
+        return changes
+
+    migrations_collection.update_one(
+        {"_id": MIGRATION_ID},
+        {"$set": {
+            "version": INDEX_SPEC_VERSION,
+            "applied_at": datetime.now(timezone.utc),
+            "changes": changes,
+            "degraded": degraded
+        }},
+        upsert=True
+    )
+    logger.info(f"Indexes at version {INDEX_SPEC_VERSION}: {len(changes)} changes")
+    return changes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create and drop MongoDB indexes to match INDEX_SPEC")
+    parser.add_argument('--dry-run', action='store_true', help="report what would change without writing")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    migrate_indexes(force=True, dry_run=args.dry_run)
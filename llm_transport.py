@@ -0,0 +1,287 @@
+"""
+HTTP transport for the OpenAI clients: connection pool, timeouts, retries
+and hedged requests.
+
+create_openai_client() / create_async_openai_client() return a wrapper
+exposing chat.completions.create like the SDK client, so callers do not
+change. Every call:
+
+- goes through one httpx pool per process (LLM_MAX_CONNECTIONS,
+  LLM_MAX_KEEPALIVE_CONNECTIONS, LLM_KEEPALIVE_EXPIRY) with explicit
+  connect/read/write/pool timeouts (LLM_*_TIMEOUT, seconds);
+- is retried on 429, 5xx, timeouts and connection errors, up to
+  LLM_MAX_RETRIES times with exponential backoff and full jitter
+  (LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY), honouring Retry-After;
+- when LLM_HEDGE_AFTER_MS is set (a number of ms, or "p95" for the rolling
+  p95 latency), fires a second identical request if the first has not
+  returned by then and uses whichever finishes first. Hedging costs
+  tokens and only applies to non-streamed calls.
+
+Attempts, retries, hedges and latency percentiles are kept for the admin
+debug page.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+import openai
+
+from metrics import observe_span, register_stats
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '50'))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('LLM_MAX_KEEPALIVE_CONNECTIONS', '20'))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv('LLM_KEEPALIVE_EXPIRY', '30'))
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', '5'))
+LLM_READ_TIMEOUT = float(os.getenv('LLM_READ_TIMEOUT', '60'))
+LLM_WRITE_TIMEOUT = float(os.getenv('LLM_WRITE_TIMEOUT', '10'))
+LLM_POOL_TIMEOUT = float(os.getenv('LLM_POOL_TIMEOUT', '5'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '2'))
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', '0.5'))
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', '8'))
+LLM_HEDGE_AFTER_MS = os.getenv('LLM_HEDGE_AFTER_MS', '')
+
+# Rolling latency window, and how many samples a "p95" hedge delay needs
+LATENCY_WINDOW = 500
+HEDGE_MIN_SAMPLES = 20
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+)
+
+def http_limits():
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+def http_timeout():
+    return httpx.Timeout(
+        connect=LLM_CONNECT_TIMEOUT,
+        read=LLM_READ_TIMEOUT,
+        write=LLM_WRITE_TIMEOUT,
+        pool=LLM_POOL_TIMEOUT,
+    )
+
+def retry_delay(attempt, error):
+    """Backoff before retry number `attempt` (1-based): Retry-After if given, else full jitter"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+class TransportStats:
+    """Counters and a rolling latency window shared by the sync and async transports"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def record(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def record_latency(self, elapsed):
+        with self._lock:
+            self._latencies.append(elapsed)
+
+    def percentile(self, fraction, min_samples=1):
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging, or None when hedging is off (or p95 is not known yet)"""
+        if not LLM_HEDGE_AFTER_MS:
+            return None
+        if LLM_HEDGE_AFTER_MS == "p95":
+            return self.percentile(0.95, HEDGE_MIN_SAMPLES)
+        return float(LLM_HEDGE_AFTER_MS) / 1000
+
+    def snapshot(self):
+        p50, p95, p99 = (self.percentile(f) for f in (0.5, 0.95, 0.99))
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "failures": self.failures,
+                "hedges": self.hedges,
+                "hedges_won": self.hedges_won,
+                "p50_ms": round(p50 * 1000) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000) if p95 is not None else None,
+                "p99_ms": round(p99 * 1000) if p99 is not None else None,
+                "hedge_after_ms": LLM_HEDGE_AFTER_MS or "off",
+                "max_retries": LLM_MAX_RETRIES,
+                "max_connections": LLM_MAX_CONNECTIONS
+            }
+
+transport_stats = TransportStats()
+register_stats("llm_transport", transport_stats.snapshot)
+
+class _Chat:
+    def __init__(self, completions):
+        self.completions = completions
+
+class ChatTransport:
+    """chat.completions.create with retries and hedging, over a sync OpenAI client"""
+
+    def __init__(self, client, hedge_workers=8):
+        self.client = client
+        self.chat = _Chat(self)
+        self._hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="llm-hedge")
+
+    def create(self, **params):
+        transport_stats.record("calls")
+        start = time.perf_counter()
+        hedge_delay = None if params.get("stream") else transport_stats.hedge_delay()
+        if hedge_delay is None:
+            result = self._with_retries(params)
+        else:
+            result = self._hedged(params, hedge_delay)
+        elapsed = time.perf_counter() - start
+        if params.get("stream"):
+            observe_span("llm", "chat.completions.stream", elapsed)
+        else:
+            # Streamed calls return at the first byte, so they would skew the window
+            transport_stats.record_latency(elapsed)
+            observe_span("llm", "chat.completions", elapsed)
+        return result
+
+    def _with_retries(self, params):
+        attempt = 0
+        while True:
+            transport_stats.record("attempts")
+            try:
+                return self.client.chat.completions.create(**params)
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > LLM_MAX_RETRIES:
+                    transport_stats.record("failures")
+                    raise
+                delay = retry_delay(attempt, e)
+                transport_stats.record("retries")
+                logger.warning(f"LLM call failed ({type(e).__name__}), retry {attempt}/{LLM_MAX_RETRIES} in {delay:.2f}s")
+                time.sleep(delay)
+
+    def _hedged(self, params, hedge_delay):
+        first = self._hedge_executor.submit(self._with_retries, params)
+        done, _ = wait([first], timeout=hedge_delay)
+        if done:
+            return first.result()
+
+        transport_stats.record("hedges")
+        logger.info(f"LLM call slower than {hedge_delay * 1000:.0f} ms, sending a hedged request")
+        second = self._hedge_executor.submit(self._with_retries, params)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    if future is second and future.exception() is None:
+                        transport_stats.record("hedges_won")
+                    return future.result()
+
+class AsyncChatTransport:
+    """Async counterpart of ChatTransport over an AsyncOpenAI client"""
+
+    def __init__(self, client):
+        self.client = client
+        self.chat = _Chat(self)
+
+    async def create(self, **params):
+        transport_stats.record("calls")
+        start = time.perf_counter()
+        hedge_delay = None if params.get("stream") else transport_stats.hedge_delay()
+        if hedge_delay is None:
+            result = await self._with_retries(params)
+        else:
+            result = await self._hedged(params, hedge_delay)
+        elapsed = time.perf_counter() - start
+        if params.get("stream"):
+            observe_span("llm", "chat.completions.stream", elapsed)
+        else:
+            # Streamed calls return at the first byte, so they would skew the window
+            transport_stats.record_latency(elapsed)
+            observe_span("llm", "chat.completions", elapsed)
+        return result
+
+    async def _with_retries(self, params):
+        attempt = 0
+        while True:
+            transport_stats.record("attempts")
+            try:
+                return await self.client.chat.completions.create(**params)
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > LLM_MAX_RETRIES:
+                    transport_stats.record("failures")
+                    raise
+                delay = retry_delay(attempt, e)
+                transport_stats.record("retries")
+                logger.warning(f"LLM call failed ({type(e).__name__}), retry {attempt}/{LLM_MAX_RETRIES} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def _hedged(self, params, hedge_delay):
+        first = asyncio.ensure_future(self._with_retries(params))
+        done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+        if done:
+            return first.result()
+
+        transport_stats.record("hedges")
+        logger.info(f"LLM call slower than {hedge_delay * 1000:.0f} ms, sending a hedged request")
+        second = asyncio.ensure_future(self._with_retries(params))
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    for other in pending:
+                        other.cancel()
+                    if future is second and future.exception() is None:
+                        transport_stats.record("hedges_won")
+                    return future.result()
+
+def create_openai_client():
+    """Sync OpenAI client with the pooled transport (retries are done here, not by the SDK)"""
+    client = openai.OpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        base_url=os.getenv('OPENAI_BASE_URL'),
+        http_client=httpx.Client(limits=http_limits(), timeout=http_timeout()),
+        timeout=http_timeout(),
+        max_retries=0,
+    )
+    return ChatTransport(client)
+
+def create_async_openai_client():
+    client = openai.AsyncOpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        base_url=os.getenv('OPENAI_BASE_URL'),
+        http_client=httpx.AsyncClient(limits=http_limits(), timeout=http_timeout()),
+        timeout=http_timeout(),
+        max_retries=0,
+    )
+    return AsyncChatTransport(client)
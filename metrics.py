@@ -0,0 +1,272 @@
+"""
+Request timing and span metrics, exported in the Prometheus text format.
+
+Every request to the Flask app (and the async chat app) is timed per route
+template, method and status. Inside a request, timed spans are recorded
+per kind and name:
+
+- mongo: each MongoDB command, via a pymongo command listener
+  (e.g. "find sessions");
+- llm: each chat.completions call made through llm_transport;
+- tool: each tool handler run by tool_registry;
+- json: JSON serialization of API responses (jsonify).
+
+Spans are also summed per request, through a contextvar. Commands of the
+motor client run on motor's executor threads, outside that context, so
+they only reach the span histograms, not the async app's request totals.
+The totals are sent back in a Server-Timing header when
+METRICS_SERVER_TIMING is set (or the app runs in debug mode), and a
+request slower than METRICS_SLOW_REQUEST_MS is logged as a warning with
+its breakdown. For a streamed response the request time stops when the
+headers are sent; spans of the stream body still count toward the span
+histograms.
+
+Other modules register their stats dicts with register_stats(); numeric
+values are exported as gauges and histogram snapshots as histograms.
+render_prometheus() builds the text served by /admin/metrics.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from flask.json.provider import DefaultJSONProvider
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+METRICS_SERVER_TIMING = os.getenv('METRICS_SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+METRICS_SLOW_REQUEST_MS = float(os.getenv('METRICS_SLOW_REQUEST_MS', '10000'))
+
+PREFIX = "mathmentor"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REQUEST_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+SPAN_SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Spans of the current request: {kind: [count, seconds]}, shared with the
+# threads and tasks the request starts (they copy the context)
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+class Histogram:
+    """Cumulative bucket counts, sum and count (Prometheus style)"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def snapshot(self):
+        buckets = {f"le_{bound}": count for bound, count in zip(self.buckets, self.counts)}
+        buckets["le_inf"] = self.count
+        return {"count": self.count, "sum": round(self.sum, 6), "buckets": buckets}
+
+class HistogramFamily:
+    """Histograms of one metric, one per combination of label values"""
+
+    def __init__(self, name, help, labelnames, buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            child = self._children.get(labels)
+            if child is None:
+                child = self._children[labels] = Histogram(self.buckets)
+            child.observe(value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            children = [(labels, child.snapshot()) for labels, child in sorted(self._children.items())]
+        for labels, snapshot in children:
+            lines.extend(histogram_lines(self.name, dict(zip(self.labelnames, labels)), snapshot))
+        return lines
+
+request_seconds = HistogramFamily(
+    f"{PREFIX}_request_duration_seconds", "Request duration by route template, method and status",
+    ("route", "method", "status"), REQUEST_SECONDS_BUCKETS
+)
+span_seconds = HistogramFamily(
+    f"{PREFIX}_span_duration_seconds", "Duration of timed spans (mongo, llm, tool, json) by kind and name",
+    ("kind", "name"), SPAN_SECONDS_BUCKETS
+)
+
+_stats_sources = {}
+
+def register_stats(name, stats_fn):
+    """Export a stats() dict: numbers as gauges, histogram snapshots as histograms"""
+    _stats_sources[name] = stats_fn
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + "}"
+
+def histogram_lines(name, labels, snapshot):
+    """Sample lines of one histogram from a Histogram.snapshot()"""
+    lines = []
+    for key, count in snapshot["buckets"].items():
+        bound = "+Inf" if key == "le_inf" else key[3:]
+        lines.append(f"{name}_bucket{format_labels({**labels, 'le': bound})} {count}")
+    lines.append(f"{name}_sum{format_labels(labels)} {snapshot['sum']}")
+    lines.append(f"{name}_count{format_labels(labels)} {snapshot['count']}")
+    return lines
+
+def stats_lines(source, stats):
+    lines = []
+    for key, value in stats.items():
+        name = f"{PREFIX}_{source}_{key}"
+        if isinstance(value, dict) and "buckets" in value:
+            lines.append(f"# TYPE {name} histogram")
+            lines.extend(histogram_lines(name, {}, value))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return lines
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format"""
+    lines = request_seconds.render() + span_seconds.render()
+    for source, stats_fn in sorted(_stats_sources.items()):
+        try:
+            lines.extend(stats_lines(source, stats_fn()))
+        except Exception as e:
+            logger.error(f"Error collecting {source} metrics: {str(e)}")
+    return "\n".join(lines) + "\n"
+
+def observe_span(kind, name, seconds):
+    """Record a span in the histograms and in the current request's totals"""
+    span_seconds.observe((kind, name), seconds)
+    spans = _request_spans.get()
+    if spans is not None:
+        totals = spans.setdefault(kind, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+@contextmanager
+def span(kind, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_span(kind, name, time.perf_counter() - start)
+
+def begin_request():
+    _request_spans.set({})
+    return time.perf_counter()
+
+def finish_request(route, method, status, start):
+    """Record the request and return its span totals ({kind: [count, seconds]})"""
+    elapsed = time.perf_counter() - start
+    spans = _request_spans.get() or {}
+    request_seconds.observe((route, method, str(status)), elapsed)
+    if METRICS_SLOW_REQUEST_MS and elapsed * 1000 >= METRICS_SLOW_REQUEST_MS:
+        breakdown = ", ".join(f"{kind} {count}x {seconds * 1000:.0f} ms" for kind, (count, seconds) in sorted(spans.items()))
+        logger.warning(f"Slow request {method} {route} ({status}): {elapsed * 1000:.0f} ms [{breakdown or 'no spans'}]")
+    return elapsed, spans
+
+def end_request():
+    _request_spans.set(None)
+
+def server_timing(elapsed, spans):
+    entries = [f"{kind};dur={seconds * 1000:.1f};desc=\"{count}x\"" for kind, (count, seconds) in sorted(spans.items())]
+    entries.append(f"total;dur={elapsed * 1000:.1f}")
+    return ", ".join(entries)
+
+def route_label(request):
+    """Route template (bounded cardinality), not the raw path"""
+    return request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+
+def instrument_app(app):
+    """Time every request of a Flask app and its JSON serialization"""
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = begin_request()
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            elapsed, spans = finish_request(route_label(request), request.method, response.status_code, start)
+            if METRICS_SERVER_TIMING or app.debug:
+                response.headers['Server-Timing'] = server_timing(elapsed, spans)
+        return response
+
+    @app.teardown_request
+    def clear_request_metrics(error=None):
+        end_request()
+
+def instrument_quart_app(app):
+    """Same as instrument_app for the async (Quart) chat app"""
+    from quart import g as quart_g, request as quart_request
+
+    @app.before_request
+    async def start_request_metrics():
+        quart_g.metrics_start = begin_request()
+
+    @app.after_request
+    async def record_request_metrics(response):
+        start = quart_g.pop("metrics_start", None)
+        if start is not None:
+            elapsed, spans = finish_request(route_label(quart_request), quart_request.method, response.status_code, start)
+            if METRICS_SERVER_TIMING:
+                response.headers['Server-Timing'] = server_timing(elapsed, spans)
+        return response
+
+    @app.teardown_request
+    async def clear_request_metrics(error=None):
+        end_request()
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that records a json span per serialization"""
+
+    def dumps(self, obj, **kwargs):
+        with span("json", "dumps"):
+            return super().dumps(obj, **kwargs)
+
+class MongoSpanListener(monitoring.CommandListener):
+    """Times every MongoDB command as a mongo span named "<command> <collection>" """
+
+    def __init__(self):
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        name = f"{event.command_name} {target}" if isinstance(target, str) else event.command_name
+        with self._lock:
+            self._started[(event.connection_id, event.request_id)] = name
+
+    def _finish(self, event):
+        with self._lock:
+            name = self._started.pop((event.connection_id, event.request_id), event.command_name)
+        observe_span("mongo", name, event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+mongo_listener = MongoSpanListener()
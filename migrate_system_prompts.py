@@ -0,0 +1,73 @@
+"""
+Move the system prompt copies of existing sessions into the prompts collection.
+
+Each session created before prompts were stored by reference has a system
+message at sequence 1 holding rule.md plus a language line (and optionally a
+topic line). This script registers the base prompt as a version, sets
+`prompt_version` and `language` on the session and deletes the copy.
+Sessions whose prompt cannot be split that way are left untouched.
+
+It is safe to run more than once. Usage:
+
+    python migrate_system_prompts.py [--dry-run]
+"""
+import argparse
+import logging
+import re
+
+from database import sessions_collection, messages_collection, prompts_collection
+from history_cache import transcript_cache
+from prompt_registry import PromptRegistry, LANGUAGE_CODES
+from utils import get_language_name
+
+logger = logging.getLogger(__name__)
+
+TOPIC_LINE = re.compile(r"\nThe user has selected the topic: .*\. Focus your assistance on this mathematical area\.$")
+
+def split_system_prompt(content):
+    """Return (base prompt, language code) of a stored system prompt, or None if it does not match"""
+    content = TOPIC_LINE.sub("", content)
+    for language in LANGUAGE_CODES:
+        suffix = f"\n\n{get_language_name(language)}."
+        if content.endswith(suffix):
+            return content[:-len(suffix)], language
+    return None
+
+def migrate(dry_run=False):
+    registry = PromptRegistry(prompts_collection)
+    migrated = skipped = 0
+
+    for system_doc in messages_collection.find({"role": "system", "sequence": 1}):
+        session_id = system_doc["session_id"]
+        parsed = split_system_prompt(system_doc.get("content") or "")
+        if not parsed:
+            logger.warning(f"Skipping session {session_id}: system prompt has no recognised language line")
+            skipped += 1
+            continue
+
+        base, language = parsed
+        if dry_run:
+            logger.info(f"Would migrate session {session_id} (language {language})")
+            migrated += 1
+            continue
+
+        version = registry.register(base, source="migration")
+        # Reference first, then delete the copy: an interrupted run is completed by the next one
+        sessions_collection.update_one(
+            {"session_id": session_id, "prompt_version": {"$exists": False}},
+            {"$set": {"prompt_version": version, "language": language}}
+        )
+        messages_collection.delete_one({"_id": system_doc["_id"]})
+        transcript_cache.invalidate(session_id)
+        migrated += 1
+
+    logger.info(f"{'Would migrate' if dry_run else 'Migrated'} {migrated} sessions, skipped {skipped}")
+    return migrated, skipped
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Store session system prompts by reference")
+    parser.add_argument('--dry-run', action='store_true', help="report what would change without writing")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    migrate(dry_run=args.dry_run)
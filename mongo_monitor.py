@@ -0,0 +1,233 @@
+"""
+Per-request MongoDB command monitoring and query budgets.
+
+A pymongo command listener attributes every command, with its duration, to
+the Flask request that issued it (including the tool threads the request
+starts; background writes are not counted). The async chat app is not
+monitored: motor runs its commands on executor threads that do not carry
+the request's context. When the request ends:
+
+- a request over MONGO_QUERY_BUDGET commands or MONGO_TIME_BUDGET_MS of
+  MongoDB time is logged as a warning, with its repeated command shapes
+  first since those are usually an N+1 loop;
+- in debug/testing the command count so far is sent back in
+  X-Mongo-Commands.
+
+A command slower than MONGO_SLOW_COMMAND_MS is logged with its shape: the
+command, collection and filter/update/pipeline structure with every value
+replaced by "?", so no user data reaches the logs. The slowest shapes are
+kept for the admin debug page.
+
+Only a fraction of requests is monitored (MONGO_MONITOR_SAMPLE_RATE,
+0 turns it off). The benchmark harness monitors every request.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+
+from flask import g, request
+from pymongo import monitoring
+
+from metrics import register_stats
+
+logger = logging.getLogger(__name__)
+
+MONGO_MONITOR_SAMPLE_RATE = float(os.getenv('MONGO_MONITOR_SAMPLE_RATE', '0.1'))
+MONGO_QUERY_BUDGET = int(os.getenv('MONGO_QUERY_BUDGET', '20'))
+MONGO_TIME_BUDGET_MS = float(os.getenv('MONGO_TIME_BUDGET_MS', '250'))
+MONGO_SLOW_COMMAND_MS = float(os.getenv('MONGO_SLOW_COMMAND_MS', '50'))
+
+# How many of the slowest shapes the admin page keeps
+SLOW_SHAPES_KEPT = 20
+
+# Connection housekeeping, not issued by the app
+IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "endSessions", "saslStart", "saslContinue", "buildInfo"}
+
+# Parts of each command that make up its shape; sort and projection keep their values
+SHAPE_FIELDS = {
+    "find": ("filter", "sort", "projection"),
+    "findAndModify": ("query", "sort", "update", "fields"),
+    "aggregate": ("pipeline",),
+    "count": ("query",),
+    "distinct": ("key", "query"),
+    "update": ("updates",),
+    "delete": ("deletes",),
+}
+UNREDACTED_FIELDS = {"sort", "projection", "fields", "key"}
+
+_request_commands = contextvars.ContextVar("request_commands", default=None)
+
+def redact(value):
+    """Keep the structure (keys, operators), replace every value with "?" """
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        # One element is enough to show the shape of a list
+        return [redact(value[0]), "..."] if len(value) > 1 else [redact(item) for item in value]
+    return "?"
+
+def command_shape(command_name, command):
+    """'find users {"filter": {"_id": "?"}, ...}' for a command document"""
+    collection = command.get(command_name)
+    parts = {}
+    for field in SHAPE_FIELDS.get(command_name, ()):
+        if field not in command:
+            continue
+        value = command[field]
+        if field in ("updates", "deletes"):
+            # Bulk statements: the first one, with q/u redacted
+            value = {key: redact(item) for key, item in value[0].items() if key in ("q", "u")} if value else {}
+        elif field == "pipeline":
+            # Every stage is structure, not data
+            value = [redact(stage) for stage in value]
+        elif field not in UNREDACTED_FIELDS:
+            value = redact(value)
+        parts[field] = value
+    shape = f"{command_name} {collection}" if isinstance(collection, str) else command_name
+    if parts:
+        shape += " " + json.dumps(parts, sort_keys=True, default=str)
+    return shape
+
+class RequestCommands:
+    """MongoDB commands issued by one request, grouped by shape"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = {}
+
+    def record(self, shape, seconds):
+        with self._lock:
+            self.count += 1
+            self.seconds += seconds
+            totals = self.shapes.setdefault(shape, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def over_budget(self):
+        return self.count > MONGO_QUERY_BUDGET or self.seconds * 1000 > MONGO_TIME_BUDGET_MS
+
+    def summary(self, limit=5):
+        """Repeated shapes first (most repeated), then the slowest"""
+        with self._lock:
+            ranked = sorted(self.shapes.items(), key=lambda item: (-item[1][0], -item[1][1]))
+        return "; ".join(f"{count}x {seconds * 1000:.1f} ms {shape}" for shape, (count, seconds) in ranked[:limit])
+
+class MongoMonitor(monitoring.CommandListener):
+    """Attributes commands to the monitored request and keeps the slowest shapes"""
+
+    def __init__(self):
+        self._started = {}
+        self._lock = threading.Lock()
+        self._slow_shapes = {}
+        self.requests_monitored = 0
+        self.commands = 0
+        self.over_budget = 0
+        self.slow_commands = 0
+
+    def started(self, event):
+        commands = _request_commands.get()
+        if commands is None or event.command_name in IGNORED_COMMANDS:
+            return
+        shape = command_shape(event.command_name, event.command)
+        with self._lock:
+            self._started[(event.connection_id, event.request_id)] = (commands, shape)
+
+    def _finish(self, event):
+        with self._lock:
+            started = self._started.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        commands, shape = started
+        seconds = event.duration_micros / 1e6
+        commands.record(shape, seconds)
+        with self._lock:
+            self.commands += 1
+            if seconds * 1000 >= MONGO_SLOW_COMMAND_MS:
+                self.slow_commands += 1
+                self._remember_slow(shape, seconds)
+        if seconds * 1000 >= MONGO_SLOW_COMMAND_MS:
+            logger.warning(f"Slow MongoDB command ({seconds * 1000:.0f} ms): {shape}")
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def _remember_slow(self, shape, seconds):
+        entry = self._slow_shapes.setdefault(shape, {"count": 0, "max_ms": 0.0})
+        entry["count"] += 1
+        entry["max_ms"] = max(entry["max_ms"], round(seconds * 1000, 1))
+        if len(self._slow_shapes) > SLOW_SHAPES_KEPT:
+            fastest = min(self._slow_shapes, key=lambda key: self._slow_shapes[key]["max_ms"])
+            del self._slow_shapes[fastest]
+
+    def begin_request(self):
+        """Start monitoring the current request if it is sampled"""
+        if MONGO_MONITOR_SAMPLE_RATE <= 0 or random.random() >= MONGO_MONITOR_SAMPLE_RATE:
+            return None
+        commands = RequestCommands()
+        _request_commands.set(commands)
+        with self._lock:
+            self.requests_monitored += 1
+        return commands
+
+    def end_request(self, label, commands):
+        """Check the budgets of a monitored request"""
+        _request_commands.set(None)
+        if not commands.over_budget():
+            return
+        with self._lock:
+            self.over_budget += 1
+        logger.warning(
+            f"{label} over MongoDB budget: {commands.count} commands, {commands.seconds * 1000:.0f} ms "
+            f"(budget {MONGO_QUERY_BUDGET} commands, {MONGO_TIME_BUDGET_MS:.0f} ms): {commands.summary()}"
+        )
+
+    def slowest_shapes(self):
+        with self._lock:
+            return sorted(self._slow_shapes.items(), key=lambda item: -item[1]["max_ms"])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sample_rate": MONGO_MONITOR_SAMPLE_RATE,
+                "requests_monitored": self.requests_monitored,
+                "commands": self.commands,
+                "avg_commands_per_request": round(self.commands / self.requests_monitored, 2) if self.requests_monitored else None,
+                "over_budget": self.over_budget,
+                "slow_commands": self.slow_commands,
+                "query_budget": MONGO_QUERY_BUDGET,
+                "time_budget_ms": MONGO_TIME_BUDGET_MS,
+                "slow_command_ms": MONGO_SLOW_COMMAND_MS
+            }
+
+mongo_monitor = MongoMonitor()
+register_stats("mongo_monitor", mongo_monitor.stats)
+
+def monitor_requests(app):
+    """Attribute MongoDB commands to the app's (sampled) requests"""
+
+    @app.before_request
+    def start_mongo_monitor():
+        g.mongo_commands = mongo_monitor.begin_request()
+
+    @app.after_request
+    def report_mongo_commands(response):
+        commands = g.get("mongo_commands")
+        if commands is not None and (app.debug or app.testing):
+            response.headers['X-Mongo-Commands'] = str(commands.count)
+        return response
+
+    # Teardown runs after a streamed body is done, so its commands count too
+    @app.teardown_request
+    def check_mongo_budget(error=None):
+        commands = g.pop("mongo_commands", None)
+        if commands is not None:
+            mongo_monitor.end_request(f"{request.method} {request.path}", commands)
+        _request_commands.set(None)
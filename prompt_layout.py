@@ -0,0 +1,80 @@
+"""
+Message assembly for chat completions.
+
+Providers cache the longest previously seen prompt prefix, so the order of
+messages decides how much of each request is billed and processed again.
+
+- "legacy": per-user progression context first, then the system prompt and
+  history, with the topic and its tool instruction at the end (original order).
+- "cache_friendly": most static to most dynamic. System prompt (rule.md),
+  then the stable tool schemas, then history, then the per-turn context.
+  Tool schemas do not embed the current topic in this mode.
+
+In both layouts the system prompt is the same for the whole session: the
+session's topic, which can be set mid-session, is per-turn context.
+
+Select with PROMPT_LAYOUT. Cached token counts reported by the API are
+logged and totalled so the savings can be checked.
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+LEGACY_LAYOUT = "legacy"
+CACHE_FRIENDLY_LAYOUT = "cache_friendly"
+
+PROMPT_LAYOUT = os.getenv('PROMPT_LAYOUT', LEGACY_LAYOUT)
+
+_stats_lock = threading.Lock()
+_stats = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0}
+_stats_by_version = {}
+
+def is_cache_friendly(layout=None):
+    return (layout or PROMPT_LAYOUT) == CACHE_FRIENDLY_LAYOUT
+
+def assemble_messages(history, progression_context=None, tool_instruction=None, layout=None, topic_context=None):
+    """Order the messages of one turn.
+
+    history is the stored conversation (system prompt, summary, past turns
+    and the new user message); the others are per-turn system messages.
+    """
+    if is_cache_friendly(layout):
+        context = [m for m in (progression_context, topic_context, tool_instruction) if m]
+        return history + context
+
+    messages = list(history)
+    if progression_context:
+        messages.insert(0, progression_context)
+    messages.extend(m for m in (topic_context, tool_instruction) if m)
+    return messages
+
+def record_prompt_cache_usage(usage, label="chat", prompt_version=None):
+    """Log and total the cached prompt tokens reported for one completion, per system prompt version"""
+    if not usage:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+    with _stats_lock:
+        _stats["calls"] += 1
+        _stats["prompt_tokens"] += prompt_tokens
+        _stats["cached_tokens"] += cached_tokens
+        version_stats = _stats_by_version.setdefault(prompt_version or "legacy", {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        version_stats["calls"] += 1
+        version_stats["prompt_tokens"] += prompt_tokens
+        version_stats["cached_tokens"] += cached_tokens
+
+    ratio = cached_tokens / prompt_tokens if prompt_tokens else 0
+    logger.info(f"Prompt cache ({label}, layout={PROMPT_LAYOUT}, prompt={prompt_version or 'legacy'}): {cached_tokens}/{prompt_tokens} prompt tokens cached ({ratio:.0%})")
+
+def get_prompt_cache_stats():
+    """Totals since process start"""
+    with _stats_lock:
+        stats = dict(_stats)
+        stats["by_prompt_version"] = {version: dict(totals) for version, totals in _stats_by_version.items()}
+    stats["layout"] = PROMPT_LAYOUT
+    stats["cached_ratio"] = round(stats["cached_tokens"] / stats["prompt_tokens"], 4) if stats["prompt_tokens"] else 0.0
+    return stats
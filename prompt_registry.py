@@ -0,0 +1,151 @@
+"""
+Versioned system prompts, stored once and referenced by sessions.
+
+Sessions used to copy rule.md (plus a language line) into their first
+message. Prompts now live in the prompts collection, keyed by a version id
+derived from their content, and a session only keeps `prompt_version` and
+`language`. The system message is rendered in memory when a turn needs it.
+
+rule.md is read once and its per-language variants are precomputed. The
+file is only read again when its mtime changes (checked at most every
+PROMPT_RELOAD_CHECK_SECONDS), and a new version becomes active only when
+the content hash changes, so editing rule.md rolls out without a restart.
+
+Sessions created before prompts were stored by reference still carry their
+own system message at sequence 1 until migrate_system_prompts.py has been
+run; they have no prompt_version and are served as before.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import pytz
+
+from utils import get_language_name, get_topic_name
+
+logger = logging.getLogger(__name__)
+
+PROMPT_FILE = os.getenv('SYSTEM_PROMPT_FILE', 'rule.md')
+PROMPT_RELOAD_CHECK_SECONDS = float(os.getenv('PROMPT_RELOAD_CHECK_SECONDS', '2'))
+
+LANGUAGE_CODES = ('en', 'zh', 'ms')
+
+def prompt_version_id(content):
+    """Stable version id of a prompt text"""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+def language_variant(base, language):
+    return base + f"\n\n{get_language_name(language)}."
+
+def topic_line(topic_id, language):
+    topic_name = get_topic_name(topic_id, language)
+    return f"\nThe user has selected the topic: {topic_name}. Focus your assistance on this mathematical area."
+
+def topic_message(topic_id, language):
+    """Per-turn system message naming the session's topic.
+
+    It is not part of the system prompt: the topic is often set mid-session,
+    and the system prompt has to stay the same prefix for the whole session.
+    """
+    return {"role": "system", "content": topic_line(topic_id, language).strip()}
+
+class PromptRegistry:
+    """Prompt versions by id, read from MongoDB once per process, with rule.md hot reload"""
+
+    def __init__(self, prompts_collection, prompt_file=PROMPT_FILE):
+        self.prompts_collection = prompts_collection
+        self.prompt_file = prompt_file
+        self._variants = {}
+        self._lock = threading.Lock()
+        self._active_version = None
+        self._file_mtime = None
+        self._next_check = 0.0
+        self.loaded_at = None
+        self.reloads = 0
+
+    def register(self, content, source="rule.md"):
+        """Store a prompt text if it is new and return its version id"""
+        version = prompt_version_id(content)
+        if version in self._variants:
+            return version
+        self.prompts_collection.update_one(
+            {"version": version},
+            {"$setOnInsert": {
+                "version": version,
+                "content": content,
+                "source": source,
+                "created_at": datetime.now(pytz.timezone('Asia/Singapore'))
+            }},
+            upsert=True
+        )
+        self._cache(version, content)
+        logger.info(f"Registered system prompt version {version} from {source}")
+        return version
+
+    def current_version(self):
+        """Active version id (that of rule.md), used for new sessions"""
+        now = time.monotonic()
+        if self._active_version is None or now >= self._next_check:
+            with self._lock:
+                if self._active_version is None or now >= self._next_check:
+                    self._next_check = now + PROMPT_RELOAD_CHECK_SECONDS
+                    self._reload_if_changed()
+        return self._active_version
+
+    def is_cached(self, version):
+        return not version or version in self._variants
+
+    def system_message(self, session_data):
+        """Rendered system message of a session (prompt and language line, the same all session long),
+        or None if the session still stores its own"""
+        version = session_data.get("prompt_version")
+        if not version:
+            return None
+        variants = self._get_variants(version)
+        language = session_data.get("language", "en")
+        content = variants.get(language) or language_variant(variants["base"], language)
+        return {"role": "system", "content": content}
+
+    def stats(self):
+        return {
+            "active_version": self._active_version,
+            "prompt_file": self.prompt_file,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "reloads": self.reloads,
+            "versions_cached": len(self._variants)
+        }
+
+    def _reload_if_changed(self):
+        """Read rule.md again if its mtime changed; switch versions only if the content did"""
+        mtime = os.stat(self.prompt_file).st_mtime
+        if self._active_version is not None and mtime == self._file_mtime:
+            return
+        with open(self.prompt_file, "r", encoding="utf-8") as file:
+            content = file.read()
+        self._file_mtime = mtime
+        version = self.register(content, source=self.prompt_file)
+        if version != self._active_version:
+            if self._active_version is not None:
+                self.reloads += 1
+                logger.warning(f"System prompt changed: version {self._active_version} -> {version}")
+            self._active_version = version
+            self.loaded_at = datetime.now(pytz.timezone('Asia/Singapore'))
+
+    def _get_variants(self, version):
+        variants = self._variants.get(version)
+        if variants is None:
+            prompt_doc = self.prompts_collection.find_one({"version": version}, {"content": 1})
+            if not prompt_doc:
+                raise KeyError(f"Unknown system prompt version: {version}")
+            variants = self._cache(version, prompt_doc["content"])
+        return variants
+
+    def _cache(self, version, content):
+        """Keep the base text and its precomputed per-language variants"""
+        variants = {language: language_variant(content, language) for language in LANGUAGE_CODES}
+        variants["base"] = content
+        self._variants[version] = variants
+        return variants
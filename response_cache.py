@@ -0,0 +1,124 @@
+"""
+Exact-match cache of model replies for the first turns of a session.
+
+Many sessions open with the same request per topic and language ("teach me
+algebra"). When RESPONSE_CACHE_ENABLED is set, such turns are keyed on a
+hash of (prompt version, language, topic, normalized user input, history
+length) and answered from the cache instead of calling the model.
+
+Only turns with at most RESPONSE_CACHE_MAX_HISTORY earlier messages are
+eligible, and any turn whose context carries the user's own progression or
+interests bypasses the cache. A cached reply keeps the session-scoped tool
+calls the model made (e.g. set_current_topic) so they are applied again on
+a hit; a turn that called a tool in USER_SCOPED_TOOLS is not cached at all,
+since its arguments (a progress value) were derived for that user.
+Entries expire after RESPONSE_CACHE_TTL seconds and the least recently
+used entries are evicted beyond RESPONSE_CACHE_MAX_ENTRIES.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+RESPONSE_CACHE_MAX_HISTORY = 2
+
+# Tools whose effect belongs to the user who triggered them; never replayed for another user
+USER_SCOPED_TOOLS = ("update_user_progression",)
+
+def normalize_user_input(text):
+    """Case, whitespace and trailing punctuation do not change the request"""
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    return text.rstrip(" .!?。！？")
+
+class ResponseCache:
+    """TTL + LRU cache of replies keyed by request hash"""
+
+    def __init__(self, enabled=RESPONSE_CACHE_ENABLED, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.saved_tokens = 0
+
+    def make_key(self, prompt_version, language, topic_id, user_input, history_length, personalized):
+        """Cache key of a turn, or None if the turn may not use the cache"""
+        if not self.enabled:
+            return None
+        if personalized or not prompt_version or history_length > RESPONSE_CACHE_MAX_HISTORY:
+            with self._lock:
+                self.bypassed += 1
+            return None
+        payload = json.dumps(
+            [prompt_version, language, topic_id, normalize_user_input(user_input), history_length],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Cached entry ({"reply", "tool_calls", "tokens"}) or None"""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires_at"] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_tokens += entry["tokens"]
+        logger.info(f"Response cache hit, saved {entry['tokens']} tokens")
+        return entry
+
+    def put(self, key, reply, tool_calls=None, tokens=0):
+        """Store the reply of a turn that missed, unless it has no key or called a user-scoped tool"""
+        if key is None:
+            return
+        if any(tc["function"]["name"] in USER_SCOPED_TOOLS for tc in tool_calls or []):
+            with self._lock:
+                self.bypassed += 1
+            return
+        with self._lock:
+            self._entries[key] = {
+                "reply": reply,
+                "tool_calls": tool_calls or [],
+                "tokens": tokens,
+                "expires_at": time.monotonic() + self.ttl
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bypassed": self.bypassed,
+                "saved_tokens": self.saved_tokens,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries
+            }
+
+response_cache = ResponseCache()
@@ -1,10 +1,24 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, current_app, Response
 from functools import wraps
 import os
+import hmac
 import json
 from datetime import datetime
 from bson import ObjectId, json_util
 from database import users_collection, messages_collection, sessions_collection
+from history_cache import transcript_cache
+from context_window import get_window_stats
+from prompt_layout import get_prompt_cache_stats
+from tool_registry import get_tool_stats
+from turn_mode import get_turn_stats
+from response_cache import response_cache
+from llm_transport import transport_stats
+from topic_classifier import get_classifier_stats
+from admission import admission
+from work_queue import work_queue
+from mongo_monitor import mongo_monitor
+from token_usage import get_token_usage_stats
+from metrics import render_prometheus, PROMETHEUS_CONTENT_TYPE
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -78,7 +92,24 @@ def admin_debug():
     context = {
         'users_count': users_collection.count_documents({}),
         'messages_count': messages_collection.count_documents({}),
-        'sessions_count': sessions_collection.count_documents({})
+        'sessions_count': sessions_collection.count_documents({}),
+        # (title, stats, text when empty) of each stats card
+        'stat_cards': [
+            ('Transcript Cache', transcript_cache.stats(), None),
+            ('Prompt Cache', get_prompt_cache_stats(), None),
+            ('Context Window', get_window_stats(), None),
+            ('System Prompt', current_app.extensions['prompt_registry'].stats(), None),
+            ('Tool Calls', get_tool_stats(), 'No tool calls yet'),
+            ('Chat Turns', get_turn_stats(), None),
+            ('Response Cache', response_cache.stats(), None),
+            ('LLM Transport', transport_stats.snapshot(), None),
+            ('Topic Classifier', get_classifier_stats(), None),
+            ('LLM Admission', admission.stats(), None),
+            ('Background Writes', work_queue.stats(), None),
+            ('MongoDB Commands', mongo_monitor.stats(), None),
+            ('Token Usage', get_token_usage_stats(), None),
+        ],
+        'mongo_slow_shapes': mongo_monitor.slowest_shapes()
     }
     
     try:
@@ -102,6 +133,16 @@ def admin_debug():
     
     return render_template('admin/debug.html', **context)
 
+# Prometheus metrics: admin session, or "Authorization: Bearer <METRICS_TOKEN>" for scrapers
+@admin_bp.route('/admin/metrics')
+def admin_metrics():
+    token = os.getenv('METRICS_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    scraper = bool(token) and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+    if 'admin_logged_in' not in session and not scraper:
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    return Response(render_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
+
 # View user sessions list
 @admin_bp.route('/admin/chat_history/<user_id>')
 @admin_required
@@ -111,21 +152,14 @@ def admin_view_chat_history(user_id):
         flash('User not found', 'error')
         return redirect(url_for('admin.admin_users'))
     
-    # Find all sessions for this user
-    user_sessions = list(sessions_collection.find({'user_id': str(user_id)}))
-    
-    # If no sessions found, try with ObjectId
-    if len(user_sessions) == 0:
-        try:
-            user_sessions = list(sessions_collection.find({'user_id': ObjectId(user_id)}))
-        except Exception as e:
-            print(f"Error querying with ObjectId: {str(e)}")
+    # Find all sessions for this user (stored as a string or, in older sessions, an ObjectId),
+    # latest first: one query on the user_id + updated_at index
+    user_sessions = list(sessions_collection.find(
+        {'user_id': {'$in': [str(user_id), ObjectId(user_id)]}}
+    ).sort('updated_at', -1))
     
     print(f"Found {len(user_sessions)} sessions for user {user_id}")
     
-    # Sort sessions by updated_at, latest first
-    user_sessions.sort(key=lambda x: x.get('updated_at', datetime.min), reverse=True)
-    
     return render_template('admin/sessions.html', 
                          username=user.get('username', 'Unknown'),
                          user_id=user_id,
@@ -153,6 +187,12 @@ def admin_view_session(user_id, session_id):
             {'session_id': session_id}
         ).sort('sequence', 1))
         
+        # Show the system prompt the session references (not stored with its messages)
+        system_message = current_app.extensions['prompt_registry'].system_message(session_doc)
+        if system_message:
+            system_message.update({'sequence': 1, 'created_at': session_doc.get('created_at')})
+            session_messages.insert(0, system_message)
+        
         print(f"Found {len(session_messages)} messages in session {session_id}")
     except Exception as e:
         print(f"Error getting messages for session {session_id}: {str(e)}")
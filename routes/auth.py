@@ -12,18 +12,7 @@ logger = logging.getLogger(__name__)
 def create_auth_routes(users_collection, gmt8, reset_tokens_collection):
     from routes import create_auth_blueprint
     auth_bp = create_auth_blueprint()
-    
-    # 确保创建唯一索引
-    def ensure_indexes():
-        try:
-            users_collection.create_index("email", unique=True)
-            users_collection.create_index("username", unique=True)
-            logger.info("Unique indexes created for email and username")
-        except Exception as e:
-            logger.error(f"Error creating indexes: {str(e)}")
-    
-    # 创建索引
-    ensure_indexes()
+    # The unique email and username indexes are built by create_app (index_migrations.INDEX_SPEC)
     
     @auth_bp.route('/auth')
     def auth_page():
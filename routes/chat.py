@@ -1,11 +1,30 @@
-from flask import jsonify, request, session
+from flask import jsonify, request, session, g, Response, stream_with_context
 from datetime import datetime
+import json
 import logging
 import pytz
 from pymongo.mongo_client import MongoClient
+from pymongo.errors import DuplicateKeyError
 from pymongo.collection import ObjectId
 from functools import wraps
-from utils import get_language_name, get_topic_name, get_welcome_message, get_available_topics, get_topic_confirmation_message, get_new_topic_suggestion_message
+from context_window import fit_to_budget
+from summarizer import select_unsummarized, add_summary_context
+from history_cache import transcript_cache
+from user_loader import get_user_loader
+from tool_registry import ToolRegistry
+from turn_mode import SINGLE_PASS_INSTRUCTION, is_single_pass, single_pass_reply, record_turn
+from response_cache import response_cache
+from topic_classifier import detect_topic, should_apply, log_agreement
+from admission import admission, AdmissionRejected
+from work_queue import work_queue, applied_job_filter, applied_job_push
+from sequence_allocator import reserve_sequences, settle_sequences, settled_sequence, turn_in_flight
+from prompt_registry import topic_message
+from prompt_layout import assemble_messages, is_cache_friendly, record_prompt_cache_usage
+from token_usage import (
+    add_usage, message_usage, turn_total_tokens, quota_exceeded, record_usage_stats,
+    usage_day, session_usage_filter, session_usage_update, daily_usage_filter, daily_usage_update
+)
+from utils import get_topic_name, get_welcome_message, get_available_topics, get_topic_confirmation_message, get_new_topic_suggestion_message
 
 logger = logging.getLogger(__name__)
 
@@ -34,111 +53,304 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def create_chat_routes(sessions_collection, messages_collection, client, gmt8, load_system_message):
+def admission_required(f):
+    """Queue the turn behind the LLM admission controller; 429 with Retry-After when it cannot run"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        try:
+            ticket = admission.admit(session.get("user_id"))
+        except AdmissionRejected as rejected:
+            return admission_rejected_response(rejected)
+
+        g.admission_ticket = ticket
+        try:
+            return f(*args, **kwargs)
+        finally:
+            # A streamed reply takes over the ticket and releases it when the stream ends
+            if g.get("admission_ticket") is ticket:
+                admission.release(ticket)
+    return decorated_function
+
+def release_when_done(events, ticket):
+    """Pass a reply stream through and free its admission slot as soon as it ends"""
+    try:
+        yield from events
+    finally:
+        admission.release(ticket)
+
+def streamed_reply(events, ticket):
+    """SSE response of a streamed turn holding an admission slot.
+
+    The generator frees the slot when the stream ends; call_on_close also
+    frees it when the response is closed before the generator ever started
+    (client gone), where its finally would never run. release() is idempotent.
+    """
+    response = Response(
+        stream_with_context(release_when_done(events, ticket)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    response.call_on_close(lambda: admission.release(ticket))
+    return response
+
+def admission_rejected_response(rejected):
+    response = jsonify({
+        "error": "Too many requests right now, please try again shortly",
+        "retry_after": rejected.retry_after
+    })
+    response.headers["Retry-After"] = str(rejected.retry_after)
+    return response, 429
+
+QUOTA_EXCEEDED_ERROR = "You have reached today's usage limit, please come back tomorrow"
+
+def quota_exceeded_response():
+    return jsonify({"error": QUOTA_EXCEEDED_ERROR}), 429
+
+# Largest /api/history page; without limit and before_sequence the whole transcript is returned
+HISTORY_PAGE_MAX = 100
+HISTORY_PAGE_ERROR = f"limit must be 1-{HISTORY_PAGE_MAX} and before_sequence a positive number"
+TRANSCRIPT_FIELDS = {"_id": 0, "role": 1, "content": 1, "created_at": 1, "sequence": 1}
+
+def parse_history_page(args):
+    """(limit, before_sequence) of a paged history request, or None for the whole transcript.
+
+    Raises ValueError on an invalid value.
+    """
+    limit, before_sequence = args.get('limit'), args.get('before_sequence')
+    if limit is None and before_sequence is None:
+        return None
+    limit = int(limit) if limit is not None else HISTORY_PAGE_MAX
+    before_sequence = int(before_sequence) if before_sequence is not None else None
+    if not 1 <= limit <= HISTORY_PAGE_MAX or (before_sequence is not None and before_sequence < 1):
+        raise ValueError(HISTORY_PAGE_ERROR)
+    return limit, before_sequence
+
+def history_page_filter(session_id, before_sequence):
+    """Keyset filter on the (session_id, sequence) index"""
+    query = {"session_id": session_id}
+    if before_sequence is not None:
+        query["sequence"] = {"$lt": before_sequence}
+    return query
+
+def page_from_newest(messages, limit):
+    """(page oldest first, has_more) from up to limit + 1 messages read newest first"""
+    return messages[:limit][::-1], len(messages) > limit
+
+def page_of_transcript(transcript, limit, before_sequence):
+    """The same page cut from a full transcript (oldest first)"""
+    if before_sequence is not None:
+        transcript = [m for m in transcript if m.get("sequence", 0) < before_sequence]
+    return transcript[-limit:], len(transcript) > limit
+
+def history_page_body(messages, has_more):
+    """Paged /api/history response; next_before_sequence asks for the page before this one"""
+    return {
+        "messages": messages,
+        "has_more": has_more,
+        "next_before_sequence": messages[0]["sequence"] if has_more else None
+    }
+
+def create_chat_routes(sessions_collection, messages_collection, client, gmt8, prompt_registry, summarizer=None):
     from routes import create_chat_blueprint
     chat_bp = create_chat_blueprint()
+
+    # Writes that the reply does not wait on run on the background work queue
+    from database import users_collection, token_usage_collection
+    register_background_jobs(sessions_collection, messages_collection, users_collection, token_usage_collection)
     
-    def add_progression_context(messages, user_id, topic_id, preferred_language, users_collection):
-        """Add progression context as sequence 0 (dynamic, not saved to DB)"""
-        # Get user data for preferences
-        user_data = users_collection.find_one({"_id": ObjectId(user_id)})
-        user_preferences = user_data.get("preferences", {}) if user_data else {}
-        
-        if topic_id:
-            # Specific topic - provide progression for this topic
-            progression_data = get_user_topic_progression(user_id, topic_id, users_collection)
-            if progression_data:
-                progress_message = {
-                    "role": "system", 
-                    "content": (
-                        f"User has previously studied topic '{topic_id}' with progress {progression_data['progress']}%. "
-                        f"{'They have completed this topic. So can focus on revision.' if progression_data.get('revision', False) else 'The topic is not yet complete.'} "
-                        f"Last studied at {progression_data['last_study_time']}. "
-                        f"Notes: {progression_data.get('notes', 'None')}."
-                    )
-                }
-                messages.insert(0, progress_message)
-                logger.info(f"Added progression context for topic {topic_id}")
-            else:
-                # User has no previous progression for this topic - first time learning
-                topic_name = get_topic_name(topic_id, preferred_language)
-                progress_message = {
-                    "role": "system",
-                    "content": (
-                        f"This is the user's first time studying the topic '{topic_name}' (ID: {topic_id}). "
-                        f"Start with fundamental concepts and build up gradually. "
-                        f"Assess their current understanding before diving into advanced topics."
-                    )
-                }
-                messages.insert(0, progress_message)
-                logger.info(f"Added first-time learning context for topic {topic_id}")
-        else:
-            # No topic - provide both progression history and preferences for comprehensive context
-            all_progressions = get_all_user_progressions(user_id, users_collection)
-            math_topics = user_preferences.get("math_topics", [])
-            
-            context_parts = []
-            
-            if all_progressions:
-                progression_summary = "User's mathematics learning history:\n"
-                for prog in all_progressions:
-                    topic_name = get_topic_name(prog.get('id'), preferred_language)
-                    if prog.get('revision', False):
-                        status = "Mastered (excellent for revision!)"
-                    else:
-                        status = f"{prog.get('progress', 0)}% progress"
-                    progression_summary += f"• {topic_name}: {status}\n"
-                context_parts.append(progression_summary)
-            
-            if math_topics:
-                preferences_summary = "User's selected mathematical interests:\n"
-                for topic_id in math_topics:
-                    topic_name = get_topic_name(topic_id, preferred_language)
-                    preferences_summary += f"• {topic_name}\n"
-                context_parts.append(preferences_summary)
-            
-            if context_parts:
-                # User has progression history and/or preferences
-                combined_context = "\n".join(context_parts)
-                combined_context += "\nWhen the user asks for topic recommendations, provide them with MULTIPLE options (at least 3-5 choices) rather than just one. "
-                combined_context += "Based on their learning history and interests, suggest several logical next topics, review areas, or related topics they might find interesting. "
-                combined_context += "Present the options in a clear, organized way so they can choose what appeals to them most. "
-                combined_context += "\n🔄 IMPORTANT FOR REVISION REQUESTS: If the user specifically asks about revision, review, or revisiting previous topics, "
-                combined_context += "prioritize and prominently suggest topics marked as 'Mastered' - these are completed topics perfect for revision! "
-                combined_context += "Include these mastered topics in your recommendations alongside other options. "
-                combined_context += "Consider prerequisite relationships between topics and identify knowledge gaps. "
-                combined_context += "Remember: Guidelines contain template examples (like quadratic equations) - adapt all teaching to the recommended topic."
-                
-                progress_message = {
-                    "role": "system",
-                    "content": combined_context
-                }
-                messages.insert(0, progress_message)
-                logger.info(f"Added combined progression and preferences context (progressions: {len(all_progressions)}, preferences: {len(math_topics)})")
-            else:
-                # No history or preferences - provide all available topics for reference
-                all_topics = get_available_topics()
-                topics_summary = "Available mathematics topics for new learner (no history or preferences):\n"
-                for topic_id in all_topics:
-                    topic_name = get_topic_name(topic_id, preferred_language)
-                    topics_summary += f"• {topic_name}\n"
-                
-                progress_message = {
-                    "role": "system",
-                    "content": (
-                        topics_summary + 
-                        "When the user asks for topic recommendations, provide them with MULTIPLE options (at least 3-5 choices) from the available topics. "
-                        "Assess user's mathematical background and suggest several appropriate starting topics based on their goals and current knowledge. "
-                        "Present the options in a clear, organized way (such as by difficulty level or subject area) so they can choose what interests them most. "
-                        "Key reminder: All teaching examples in guidelines (like quadratic equations) are templates only - "
-                        "create topic-specific examples and explanations relevant to whatever subject you're teaching."
-                    )
-                }
-                messages.insert(0, progress_message)
-                logger.info("Added all available topics for recommendation")
+    def get_progression_context(user_id, topic_id, preferred_language, users_collection):
+        """Progression context system message (dynamic, not saved to DB)"""
+        # User document shared with the other helpers of this request
+        user_data = get_user_loader(users_collection).get(user_id)
+        return user_progression_context(user_data, topic_id, preferred_language)
+
+    def read_transcript(session_id):
+        return list(messages_collection.find({"session_id": session_id}, TRANSCRIPT_FIELDS).sort("sequence", 1))
+
+    def load_transcript(session_id, session_data):
+        """Full transcript of a session, served from the transcript cache when it is fresh"""
+        messages = cached_transcript(session_id, session_data)
+        if messages is None:
+            messages = read_transcript(session_id)
+            keep_transcript(session_id, session_data, messages)
+        return messages
+
+    def load_transcript_page(session_id, session_data, limit, before_sequence):
+        """One history page: cut from a fresh cached transcript, else one keyset query (newest first)"""
+        messages = cached_transcript(session_id, session_data)
+        if messages is not None:
+            return page_of_transcript(messages, limit, before_sequence)
+        newest = list(messages_collection.find(
+            history_page_filter(session_id, before_sequence), TRANSCRIPT_FIELDS
+        ).sort("sequence", -1).limit(limit + 1))
+        return page_from_newest(newest, limit)
+
+    def prepare_chat_turn(user_id, session_id, user_input, preferred_language):
+        """Validate the session, save the user message and build the first API call.
+
+        Returns (turn, None) on success or (None, error_response) on failure.
+        """
+        # Validate user input
+        if not user_input:
+            logger.warning("Received empty message")
+            return None, (jsonify({"error": "Message cannot be empty"}), 400)
+
+        # The previous turn's background writes must land before the session is read
+        work_queue.flush(session_id, user_id)
+
+        # Refuse the turn before any LLM call once today's token quota is used up
+        if quota_exceeded(token_usage_collection, user_id):
+            return None, quota_exceeded_response()
+
+        # Read the session and reserve the sequences of this turn's two messages in one atomic update
+        session_data, next_sequence = reserve_sequences(sessions_collection, messages_collection, session_id, user_id)
+        if not session_data:
+            if sessions_collection.find_one({"session_id": session_id}, {"_id": 1}):
+                logger.error(f"Session {session_id} does not belong to user {user_id}")
+                return None, (jsonify({"error": "Unauthorized access to this session"}), 403)
+            logger.error(f"Session not found: {session_id}")
+            return None, (jsonify({"error": "Session not found"}), 404)
+
+        turn = None
+        try:
+            turn, error_response = start_turn(user_id, session_id, user_input, preferred_language, session_data, next_sequence)
+            return turn, error_response
+        finally:
+            if turn is None:
+                # Whatever stopped the turn, its reservation is settled; otherwise the session stays in flight for good
+                release_reservation(session_id, next_sequence)
+
+    def start_turn(user_id, session_id, user_input, preferred_language, session_data, next_sequence):
+        """Second half of prepare_chat_turn, once the session is read and the sequences reserved"""
+        # Get history messages (older turns are replaced by the session summary)
+        transcript = load_transcript(session_id, session_data)
+        history = turn_history(transcript, session_data, prompt_registry.system_message(session_data))
+        logger.info(f"Found {len(history)} history messages")
+
+        # Check if session has topic set and build progression context
+        current_topic = session_data.get("topic_id")
+        # A first message that clearly names the topic sets it here, without the set_current_topic round trip
+        classified_topic, topic_set_locally = classify_turn_topic(current_topic, user_input)
+        if topic_set_locally:
+            sessions_collection.update_one({"session_id": session_id}, {"$set": {"topic_id": classified_topic}})
+            logger.info(f"Topic classifier set session {session_id} topic: {classified_topic}")
+            current_topic = classified_topic
+        from database import users_collection
+        progression_context = get_progression_context(user_id, current_topic, preferred_language, users_collection)
+
+        # Cold-start turns without per-user context may be answered from the response cache
+        response_cache_key = turn_response_cache_key(
+            session_data, preferred_language, current_topic, user_input, transcript,
+            get_user_loader(users_collection).get(user_id)
+        )
+
+        logger.info(f"Reserved sequences {next_sequence} and {next_sequence + 1}")
+
+        # Save user message first (its ID is kept for rollback on error)
+        user_message = user_message_doc(session_id, next_sequence, user_input, datetime.now(gmt8))
+        try:
+            messages_collection.insert_one(user_message)
+            transcript_cache.append(session_id, transcript_entry(user_message))
+            logger.info(f"User message saved, ID: {user_message['message_id']}")
+        except Exception as save_error:
+            logger.error(f"Failed to save user message: {str(save_error)}")
+            return None, (jsonify({"error": "Failed to save your message"}), 500)
+
+        turn = build_turn(
+            tools, user_id, session_data, user_message, history, preferred_language, current_topic,
+            progression_context, classified_topic, topic_set_locally, response_cache_key
+        )
+        return turn, None
+
+    def set_current_topic(turn, args):
+        function_call_topic = args.get("topic_id")
+        logger.info(f"AI detected topic: {function_call_topic}")
+
+        # 更新 session 中的 topic
+        sessions_collection.update_one(
+            {"session_id": turn["session_id"]},
+            {"$set": {"topic_id": function_call_topic}}
+        )
+        logger.info(f"Updated session {turn['session_id']} with topic: {function_call_topic}")
+
+        # 🔥 重要：更新当前 turn 中的 current_topic
+        turn["current_topic"] = function_call_topic
+        log_agreement(turn.get("classified_topic"), function_call_topic)
+
+        topic_name = get_topic_name(function_call_topic, turn["preferred_language"])
+        return f"Topic successfully set to '{topic_name}' for this session."
+
+    def update_user_progression(turn, args):
+        user_id = turn["user_id"]
+        topic_id = args.get("topic_id")
+        progress = args.get("progress")
+        notes = args.get("notes", "")
+
+        logger.info(f"AI updating progression for topic {topic_id}: {progress}%")
+        if turn["current_topic"] != topic_id:
+            logger.warning(f"Topic mismatch: session topic {turn['current_topic']}, tool topic {topic_id}")
+            return "Error: Topic mismatch. Could not update progression."
+
+        # Written after the reply is sent; the next read of this user flushes it first
+        work_queue.submit("progression", {
+            "user_id": user_id, "topic_id": topic_id, "progress": progress, "notes": notes
+        }, keys=[user_id])
+        from database import users_collection
+        get_user_loader(users_collection).invalidate(user_id)
+        logger.info(f"Queued progression update for user {user_id}, topic {topic_id}")
+        return f"User progression updated successfully: {progress}% completion for topic '{topic_id}'."
+
+    def suggest_new_topic_session(turn, args):
+        suggested_topic_id = args.get("suggested_topic_id")
+        logger.info(f"AI suggesting new topic session: {suggested_topic_id}")
+
+        logger.info("Generated new topic suggestion message, will not store in MongoDB")
+        rollback_user_message(turn)
+        return get_new_topic_suggestion_message(suggested_topic_id, turn["preferred_language"])
+
+    tools = create_tool_registry({
+        "set_current_topic": set_current_topic,
+        "update_user_progression": update_user_progression,
+        "suggest_new_topic_session": suggest_new_topic_session,
+    })
+
+    def complete(turn, api_params, label):
+        """One completion without streaming"""
+        completion = client.chat.completions.create(**api_params)
+        record_prompt_cache_usage(completion.usage, label, turn["prompt_version"])
+        message = completion.choices[0].message
+        return completion_result(
+            message.content, [tool_call_to_dict(tc) for tc in message.tool_calls or []], completion.usage
+        )
+
+    def perform_step(turn, step, *args):
+        """Perform a turn step for /api/chat (see turn_steps); nothing is streamed, so RESET is a no-op"""
+        if step == COMPLETE:
+            return complete(turn, *args)
+        if step == RUN_TOOLS:
+            # Independent tool calls run concurrently (see tool_registry)
+            return tools.run(turn, *args)
+        return None
+
+    def save_assistant_reply(turn, assistant_message):
+        """Cache the assistant reply and queue its message insert and session update. Raises on failure."""
+        queue_assistant_reply(turn, assistant_message, datetime.now(gmt8), summarizer)
+
+    def release_reservation(session_id, sequence):
+        """Give up the sequences reserved for a turn, deleting its user message if it was saved"""
+        messages_collection.delete_one({"session_id": session_id, "sequence": sequence})
+        transcript_cache.remove_message(session_id, sequence)
+        # Neither this message's sequence nor the reply's will be written
+        settle_sequences(sessions_collection, session_id, sequence + 1)
+
+    def rollback_user_message(turn):
+        """Delete the user message saved at the start of the turn"""
+        logger.info(f"Rolling back: deleting user message {turn['user_message_id']}")
+        release_reservation(turn["session_id"], turn["next_sequence"])
 
     @chat_bp.route('/api/chat', methods=['POST'])
     @auth_required
+    @admission_required
     def chat():
         try:
             # Get necessary parameters
@@ -146,289 +358,40 @@ def create_chat_routes(sessions_collection, messages_collection, client, gmt8, l
             session_id = request.json.get("session_id")
             user_input = request.json.get("message", "").strip()
             user_preferences = request.json.get("user_preferences", {})
-            
+
             # Extract user preferences
             preferred_language = user_preferences.get('language', 'en')
-            
-            logger.info(f"Processing chat request, session ID: {session_id}, preferred language: {preferred_language}")
-            
-            # Validate user input  
-            if not user_input:
-                logger.warning("Received empty message")
-                return jsonify({"error": "Message cannot be empty"}), 400
-            
-            # Validate session existence
-            session_data = sessions_collection.find_one({"session_id": session_id})
-            if not session_data:
-                logger.error(f"Session not found: {session_id}")
-                return jsonify({"error": "Session not found"}), 404
 
-            # Ensure session belongs to current user
-            if session_data.get("user_id") != user_id:
-                logger.error(f"Session {session_id} does not belong to user {user_id}")
-                return jsonify({"error": "Unauthorized access to this session"}), 403
-                
-            # Get history messages
-            messages = list(messages_collection.find(
-                {"session_id": session_id},
-                {"_id": 0, "role": 1, "content": 1}
-            ).sort("sequence", 1))
-            logger.info(f"Found {len(messages)} history messages")
-            
-            # Check if session has topic set and add progression context
-            current_topic = session_data.get("topic_id")
-            from database import users_collection
-            add_progression_context(messages, user_id, current_topic, preferred_language, users_collection)
-            
-            # Get current message sequence number
-            current_sequence = session_data.get("message_count", 0)
-            next_sequence = current_sequence + 1
-            logger.info(f"Current sequence: {current_sequence}, Next sequence: {next_sequence}")
+            logger.info(f"Processing chat request, session ID: {session_id}, preferred language: {preferred_language}")
 
-            # Save user message ID for rollback on error
-            user_message_id = f"{session_id}_{next_sequence}"
-            
-            # Add user message to database
-            current_time = datetime.now(gmt8)
-            user_message = {
-                "message_id": user_message_id,
-                "session_id": session_id,
-                "role": "user",
-                "content": user_input,
-                "created_at": current_time,
-                "sequence": next_sequence
-            }
-            
-            # Try to save user message first
-            try:
-                messages_collection.insert_one(user_message)
-                logger.info(f"User message saved, ID: {user_message_id}")
-                # Add to messages list to send to AI
-                messages.append({"role": "user", "content": user_input})
-            except Exception as save_error:
-                logger.error(f"Failed to save user message: {str(save_error)}")
-                return jsonify({"error": "Failed to save your message"}), 500
+            turn, error_response = prepare_chat_turn(user_id, session_id, user_input, preferred_language)
+            if error_response:
+                return error_response
 
-            # Call OpenAI API
+            # Call OpenAI API, with the tool calls and follow-up call the reply needs
             try:
                 logger.info("Calling GPT API...")
-                
-                # Prepare function calling if no topic is set
-                api_params = {
-                    "model": "gpt-4o",
-                    "messages": messages,
-                    "temperature": 0.7,
-                }
-                 # Check if session has topic set
-                if not current_topic:
-                    api_params["tools"] = tools_schema
-                    api_params["tool_choice"] = "auto"
-                    logger.info("Using topic detection and new topic suggestion tools.") 
-                elif current_topic:
-                    # Add progression tools and new topic suggestion tools for existing topic
-                    progression_tools = get_progression_tools_schema(current_topic)
-                    all_tools = progression_tools + new_topic_tools
-                    api_params["tools"] = all_tools
-                    api_params["tool_choice"] = "auto"
-                    logger.info(f"Using progression and new topic tools for topic: {current_topic}")
-                    
-                    # Add explicit tool instruction to messages
-                    tool_instruction = {
-                        "role": "system",
-                        "content": (
-                            f"You are currently teaching topic '{current_topic}'.\n\n"
-                            "🧠 Throughout the conversation, closely observe the user's learning signals. After any meaningful learning interaction, "
-                            "you must use the `update_user_progression` tool to track their progress.\n\n"
-
-                            "✅ Meaningful learning interactions include (but are not limited to):\n"
-                            "- The user correctly solves a problem or completes a calculation\n"
-                            "- The user demonstrates understanding of a concept, even partially\n"
-                            "- The user applies a method you previously explained\n"
-                            "- The user asks a thoughtful question or makes a relevant connection\n"
-                            "- The user attempts to explain, reason, or paraphrase an idea\n"
-                            "- The user moves from confusion to clarity after your guidance\n\n"
-                            "🏆 If the user answers a question correctly, always treat this as progress and award at least 1 point using the `update_user_progression` tool.\n\n"
-                            "⚠️ Do NOT wait for perfect answers. Even small improvements or signs of engagement count as progress.\n"
-                            "You are expected to proactively track and log progression after any such interaction, so the system can adapt to the user's evolving understanding."
-                            "\n\n"
-                            "If the user expresses a desire to switch to a completely different topic — e.g. by saying things like "
-                            "'I want to learn something new', 'Can we switch topics?', 'I don't want to continue this topic', "
-                            "'Let's try geometry', or similar expressions — do NOT continue with the current topic. "
-                            "Instead, call the `suggest_new_topic_session` tool with a suitable suggested topic "
-                            "based on their message or learning history. Do not teach the new topic directly in the current session. "
-                            "Only when the user's intent is to fully switch to a new **main topic** (not just a sub-area) should you "
-                            "call the `suggest_new_topic_session` tool with a suitable suggested topic based on their message or "
-                            "learning history. "
-                            "Let the frontend handle topic transition via a new session link."
-                        )
-                    }
-                    messages.append(tool_instruction)
-                
-                
-                completion = client.chat.completions.create(**api_params)
-                
-                # Handle function call response
-                tool_calls = completion.choices[0].message.tool_calls
-                if tool_calls:
-                    messages.append({
-                        "role": "assistant",
-                        "content": completion.choices[0].message.content,
-                        "tool_calls": tool_calls
-                    })
-
-                    import json
-                    for tool_call in tool_calls:
-                        function_args = json.loads(tool_call.function.arguments)
-
-                        if tool_call.function.name == "set_current_topic":
-                            function_call_topic = function_args.get("topic_id")
-                            logger.info(f"AI detected topic: {function_call_topic}")
-
-                            # 更新 session 中的 topic
-                            sessions_collection.update_one(
-                                {"session_id": session_id},
-                                {"$set": {"topic_id": function_call_topic}}
-                            )
-                            logger.info(f"Updated session {session_id} with topic: {function_call_topic}")
-                            
-                            # 🔥 重要：更新当前代码中的 current_topic 变量
-                            current_topic = function_call_topic
-                            logger.info(f"Updated current_topic variable to: {current_topic}")
-
-                            topic_name = get_topic_name(function_call_topic, preferred_language)
-                            tool_response = f"Topic successfully set to '{topic_name}' for this session."
-
-                        elif tool_call.function.name == "update_user_progression":
-                            topic_id = function_args.get("topic_id")
-                            progress = function_args.get("progress")
-                            notes = function_args.get("notes", "")
-
-                            logger.info(f"AI updating progression for topic {topic_id}: {progress}%")
-                            if current_topic != topic_id:
-                                logger.warning(f"Topic mismatch: session topic {current_topic}, tool topic {topic_id}")
-                                tool_response = "Error: Topic mismatch. Could not update progression."
-                            else:
-                                from database import users_collection
-                                success = update_user_topic_progression(user_id, topic_id, progress, notes, users_collection)
-
-                                if success:
-                                    logger.info(f"Successfully updated progression for user {user_id}, topic {topic_id}")
-                                    tool_response = f"User progression updated successfully: {progress}% completion for topic '{topic_id}'."
-                                else:
-                                    logger.error(f"Failed to update progression for user {user_id}, topic {topic_id}")
-                                    tool_response = "Error: Failed to update user progression."
-
-                        elif tool_call.function.name == "suggest_new_topic_session":
-                            suggested_topic_id = function_args.get("suggested_topic_id")
-                            suggested_topic_name = get_topic_name(suggested_topic_id, preferred_language)
-                            logger.info(f"AI suggesting new topic session: {suggested_topic_id}")
-
-                            assistant_message = get_new_topic_suggestion_message(
-                                suggested_topic_id,
-                                preferred_language
-                            )
-
-                            logger.info("Generated new topic suggestion message, will not store in MongoDB")
-                            messages_collection.delete_one({"message_id": user_message_id})
-                            logger.info(f"Deleted user message {user_message_id} for new topic suggestion")
-
-                            return jsonify({
-                                "response": assistant_message,
-                                "session_id": session_id
-                            })
-
-                        else:
-                            logger.warning(f"Unknown tool call function: {tool_call.function.name}")
-                            tool_response = "Error: Unknown function called."
-
-                        # which tool_call, must append the corresponding "tool" message, ensure the next call is legal
-                        messages.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call.id,
-                            "content": tool_response
-                        })
-                    
-                    # Make second API call to get GPT's response based on tool results
-                    try:
-                        # Add guidance message based on which tools were called
-                        tool_names = [tc.function.name for tc in tool_calls]
-                        
-                        if "update_user_progression" in tool_names:
-                            # Add guidance for progression tool response
-                            messages.append({
-                                "role": "system",
-                                "content": (
-                                    "Based on the user's progress, now continue the lesson by: "
-                                    "1. Introducing the next logical concept in this topic. "
-                                    "2. Asking a follow-up question related to what they just learned to reinforce their understanding. "
-                                    "Do not mention tools or progression explicitly."
-                                )
-                            })
-                        elif "set_current_topic" in tool_names:
-                            # Add guidance for topic setting response with updated topic
-                            topic_name = get_topic_name(current_topic, preferred_language)
-                            messages.append({
-                                "role": "system", 
-                                "content": (
-                                    f"You have set the session topic to '{topic_name}' (ID: {current_topic}). Now begin teaching this topic by: "
-                                    "1. Briefly introducing a basic concept or question to assess the user's familiarity. "
-                                    "2. Avoid listing subtopics; instead, choose one simple example to engage the user. "
-                                    "3. Ask the user to try something or share what they find confusing about the topic. "
-                                    "Do not mention tools or topic-setting."
-                                )
-                            })
-                        second_completion = client.chat.completions.create(
-                            model="gpt-4o",
-                            messages=messages,
-                            temperature=0.7,
-                        )
-                        assistant_message = second_completion.choices[0].message.content or "I've processed your request. How can I help you further?"
-                        logger.info("Second GPT call successful - got text response after tool execution")
-                    except Exception as second_api_error:
-                        logger.error(f"Failed second GPT API call: {str(second_api_error)}")
-                        assistant_message = "I've processed your request"
-                        
-                else:
-                    # No tool calls, use the original response
-                    assistant_message = completion.choices[0].message.content or "I'm sorry, I didn't understand your request. Please try again."
-                
-                next_sequence += 1
+                outcome = TurnMachine(turn, tools).run(perform_step)
                 logger.info("GPT API call successful")
             except Exception as api_error:
                 logger.error(f"Failed to call GPT API: {str(api_error)}")
                 # Rollback on error, delete previously saved user message
-                logger.info(f"Rolling back: deleting user message {user_message_id}")
-                messages_collection.delete_one({"message_id": user_message_id})
+                rollback_user_message(turn)
+                submit_turn_usage(turn)
                 return jsonify({"error": f"Failed to get reply: {str(api_error)}"}), 500
 
+            assistant_message = outcome["reply"]
+            if outcome["suggestion"]:
+                # The user message was rolled back; the suggestion is not stored
+                submit_turn_usage(turn)
+                return jsonify({
+                    "response": assistant_message,
+                    "session_id": session_id
+                })
+
             # Save AI reply
             try:
-                # Save assistant reply
-                assistant_message_id = f"{session_id}_{next_sequence}"
-                assistant_message_doc = {
-                    "message_id": assistant_message_id,
-                    "session_id": session_id,
-                    "role": "assistant",
-                    "content": assistant_message,
-                    "created_at": datetime.now(gmt8),
-                    "sequence": next_sequence
-                }
-                messages_collection.insert_one(assistant_message_doc)
-                logger.info(f"Assistant message saved, ID: {assistant_message_id}")
-
-                # Update session info
-                sessions_collection.update_one(
-                    {"session_id": session_id},
-                    {
-                        "$set": {
-                            "updated_at": datetime.now(gmt8),
-                            "message_count": next_sequence,
-                            "last_message": user_input[:50] + "..." if len(user_input) > 50 else user_input
-                        }
-                    }
-                )
-                logger.info("Session info updated")
-                
+                save_assistant_reply(turn, assistant_message)
                 return jsonify({
                     "response": assistant_message,
                     "session_id": session_id
@@ -436,14 +399,137 @@ def create_chat_routes(sessions_collection, messages_collection, client, gmt8, l
             except Exception as save_error:
                 logger.error(f"Failed to save assistant message or update session: {str(save_error)}")
                 # Delete previously saved user message
-                logger.info(f"Rolling back: deleting user message {user_message_id}")
-                messages_collection.delete_one({"message_id": user_message_id})
+                rollback_user_message(turn)
+                submit_turn_usage(turn)
                 return jsonify({"error": "Failed to save assistant reply"}), 500
 
         except Exception as e:
             logger.error(f"Chat route server error: {str(e)}")
             return jsonify({"error": f"Server error: {str(e)}"}), 500
 
+    @chat_bp.route('/api/chat/stream', methods=['POST'])
+    @auth_required
+    @admission_required
+    def chat_stream():
+        """Same turn as /api/chat, but tokens are pushed as Server-Sent Events.
+
+        Events are JSON objects with a "type" field:
+        token (incremental text), reset (discard text streamed so far),
+        message (complete replacement text), done (final reply) and error.
+        """
+        try:
+            user_id = session.get('user_id')
+            session_id = request.json.get("session_id")
+            user_input = request.json.get("message", "").strip()
+            user_preferences = request.json.get("user_preferences", {})
+            preferred_language = user_preferences.get('language', 'en')
+
+            logger.info(f"Processing streaming chat request, session ID: {session_id}, preferred language: {preferred_language}")
+
+            turn, error_response = prepare_chat_turn(user_id, session_id, user_input, preferred_language)
+            if error_response:
+                return error_response
+        except Exception as e:
+            logger.error(f"Chat stream route server error: {str(e)}")
+            return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+        # The admission slot is held until the stream ends
+        ticket = g.pop("admission_ticket")
+
+        def generate():
+            machine = TurnMachine(turn, tools)
+            streamed_tokens = False
+            try:
+                logger.info("Calling GPT API (stream)...")
+                step = machine.advance()
+                while step is not None:
+                    result, error = None, None
+                    try:
+                        if step[0] == COMPLETE:
+                            content, tool_calls, usage = "", [], None
+                            for event_type, value in stream_completion(step[1], turn["prompt_version"]):
+                                if event_type == "token":
+                                    content += value
+                                    streamed_tokens = True
+                                    yield sse_event("token", content=value)
+                                elif event_type == "usage":
+                                    usage = value
+                                else:
+                                    tool_calls = value
+                            result = completion_result(content, tool_calls, usage)
+                        elif step[0] == RUN_TOOLS:
+                            result = tools.run(turn, step[1])
+                        elif streamed_tokens:
+                            yield sse_event("reset")
+                            streamed_tokens = False
+                    except Exception as e:
+                        error = e
+                    step = machine.advance(result, error)
+            except Exception as api_error:
+                logger.error(f"Failed to stream GPT API reply: {str(api_error)}")
+                rollback_user_message(turn)
+                submit_turn_usage(turn)
+                yield sse_event("error", error=f"Failed to get reply: {str(api_error)}")
+                return
+
+            assistant_message = machine.outcome["reply"]
+            if not streamed_tokens or machine.outcome["suggestion"]:
+                yield sse_event("message", content=assistant_message)
+            if machine.outcome["suggestion"]:
+                submit_turn_usage(turn)
+                yield sse_event("done", response=assistant_message, session_id=session_id)
+                return
+
+            try:
+                save_assistant_reply(turn, assistant_message)
+            except Exception as save_error:
+                logger.error(f"Failed to save assistant message or update session: {str(save_error)}")
+                rollback_user_message(turn)
+                submit_turn_usage(turn)
+                yield sse_event("error", error="Failed to save assistant reply")
+                return
+
+            yield sse_event("done", response=assistant_message, session_id=session_id)
+
+        return streamed_reply(generate(), ticket)
+
+    def stream_completion(api_params, prompt_version=None):
+        """Call the API with stream=True.
+
+        Yields ("token", text) for every content delta, ("usage", usage) from
+        the final chunk and, once the stream ends, ("tool_calls", [...])
+        with the tool call deltas merged by index.
+        """
+        stream = client.chat.completions.create(
+            **api_params, stream=True, stream_options={"include_usage": True}
+        )
+        tool_calls = {}
+        for chunk in stream:
+            if not chunk.choices:
+                # The final chunk carries only the usage
+                usage = getattr(chunk, "usage", None)
+                record_prompt_cache_usage(usage, "stream", prompt_version)
+                if usage:
+                    yield "usage", usage
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                yield "token", delta.content
+            for tc_delta in delta.tool_calls or []:
+                tool_call = tool_calls.setdefault(tc_delta.index, {
+                    "id": None,
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""}
+                })
+                if tc_delta.id:
+                    tool_call["id"] = tc_delta.id
+                if tc_delta.function:
+                    if tc_delta.function.name:
+                        tool_call["function"]["name"] += tc_delta.function.name
+                    if tc_delta.function.arguments:
+                        tool_call["function"]["arguments"] += tc_delta.function.arguments
+        yield "tool_calls", [tool_calls[index] for index in sorted(tool_calls)]
+
     @chat_bp.route('/api/history', methods=['GET'])
     @login_required
     def get_history():
@@ -451,33 +537,36 @@ def create_chat_routes(sessions_collection, messages_collection, client, gmt8, l
             session_id = request.args.get('session_id')
             if not session_id:
                 return jsonify({"error": "Session ID is required"}), 400
+            try:
+                page = parse_history_page(request.args)
+            except ValueError:
+                return jsonify({"error": HISTORY_PAGE_ERROR}), 400
                 
             logger.info(f"Fetching history for session: {session_id}")
             
             # Get session data to determine topic and user preferences
             user_id = session.get('user_id')
+            work_queue.flush(session_id, user_id)
             session_data = sessions_collection.find_one({"session_id": session_id})
             if not session_data:
                 return jsonify({"error": "Session not found"}), 404
-                
-            # Get user preferences for language
-            from database import users_collection
-            user_data = users_collection.find_one({"_id": ObjectId(user_id)})
-            preferred_language = user_data.get("preferences", {}).get("language", "en") if user_data else "en"
             
-            messages = list(messages_collection.find(
-                {"session_id": session_id},
-                {
-                    "_id": 0,  # Do not return MongoDB's _id field
-                    "role": 1, 
-                    "content": 1,
-                    "created_at": 1 
-                }
-            ).sort("sequence", 1))
+            if page is None:
+                transcript, has_more = load_transcript(session_id, session_data), False
+            else:
+                transcript, has_more = load_transcript_page(session_id, session_data, *page)
+            messages = [
+                {"role": m["role"], "content": m["content"], "created_at": m.get("created_at"), "sequence": m.get("sequence")}
+                for m in transcript
+            ]
             
-            # Add progression context as sequence 0 (dynamic, not saved)
-            current_topic = session_data.get("topic_id")
-            add_progression_context(messages, user_id, current_topic, preferred_language, users_collection)
+            if not has_more:
+                # Add progression context as sequence 0 (dynamic, not saved) to the page that starts the transcript
+                from database import users_collection
+                user_data = get_user_loader(users_collection).get(user_id)
+                preferred_language = user_data.get("preferences", {}).get("language", "en") if user_data else "en"
+                current_topic = session_data.get("topic_id")
+                messages.insert(0, get_progression_context(user_id, current_topic, preferred_language, users_collection))
             
             # Convert date format to ISO string to solve JSON serialization problem
             for msg in messages:
@@ -485,7 +574,9 @@ def create_chat_routes(sessions_collection, messages_collection, client, gmt8, l
                     msg["created_at"] = msg["created_at"].isoformat()
             
             logger.info(f"Found {len(messages)} messages for session {session_id}")
-            return jsonify(messages)
+            if page is None:
+                return jsonify(messages)
+            return jsonify(history_page_body(messages, has_more))
             
         except Exception as e:  
             logger.error(f"Error in get_history: {str(e)}")
@@ -501,6 +592,7 @@ def create_chat_routes(sessions_collection, messages_collection, client, gmt8, l
                 return jsonify({"error": "User not logged in"}), 401
                 
             logger.info(f"Fetching sessions for user: {user_id}")
+            work_queue.flush(user_id)
             
             # Use simple query, do not use transaction
             sessions = list(sessions_collection.find(
@@ -544,7 +636,7 @@ def create_chat_routes(sessions_collection, messages_collection, client, gmt8, l
             
             # Get user preferences
             from database import users_collection
-            user_data = users_collection.find_one({"_id": ObjectId(user_id)})
+            user_data = get_user_loader(users_collection).get(user_id)
             user_preferences = user_data.get("preferences", {}) if user_data else {}
             preferred_language = user_preferences.get("language", "en")
             math_topics = user_preferences.get("math_topics", [])
@@ -563,48 +655,33 @@ def create_chat_routes(sessions_collection, messages_collection, client, gmt8, l
                 "user_id": user_id,
                 "title": default_title,
                 "topic_id": topic_id,  # Add topic field, can be None initially
+                # System prompt by reference, rendered with language and topic at request time
+                "prompt_version": prompt_registry.current_version(),
+                "language": preferred_language,
                 "created_at": current_time,
                 "updated_at": current_time,
-                "message_count": 0  # Will be updated after adding messages
+                "message_count": 0,  # Will be updated after adding messages
+                "settled_sequence": 2,
+                "last_sequence": 2  # System prompt and welcome message
             }
             
             sessions_collection.insert_one(session_data)
             logger.info(f"Created new session: {session_id}")
             
-            # Add system message with language and topic preferences
-            system_message = load_system_message()
-            
-            # Add language preference to system message
-            system_message["content"] += f"\n\n{get_language_name(preferred_language)}."
-            
-            # Add topic-specific instructions if topic is provided
-            if topic_id:
-                topic_name = get_topic_name(topic_id, preferred_language)
-                system_message["content"] += f"\nThe user has selected the topic: {topic_name}. Focus your assistance on this mathematical area."
- 
-            messages_collection.insert_one({
-                "message_id": f"{session_id}_1",
-                "session_id": session_id,
-                "role": "system",
-                "content": system_message["content"],
-                "created_at": current_time,
-                "sequence": 1
-            })
-            logger.info("Added system message to new session")
-            
             # Note: Progression context will be handled in chat function when needed
-            # This keeps the session creation simple with only system and welcome messages
+            # This keeps the session creation simple with only the welcome message
             
-            # Add welcome message based on language preference
+            # Add welcome message based on language preference (sequence 1 is the system prompt)
             welcome_message = get_welcome_message(preferred_language)
-            messages_collection.insert_one({
+            welcome_message_doc = {
                 "message_id": f"{session_id}_2",
                 "session_id": session_id,
                 "role": "assistant",
                 "content": welcome_message,
                 "created_at": current_time,
                 "sequence": 2
-            })
+            }
+            messages_collection.insert_one(welcome_message_doc)
             logger.info("Added welcome message to new session")
             
             # Set final message count
@@ -612,6 +689,7 @@ def create_chat_routes(sessions_collection, messages_collection, client, gmt8, l
                 {"session_id": session_id},
                 {"$set": {"message_count": 2}}
             )
+            transcript_cache.set(session_id, [transcript_entry(welcome_message_doc)])
             
             return jsonify({"success": True, "session_id": session_id})
         except Exception as e:
@@ -628,9 +706,13 @@ def create_chat_routes(sessions_collection, messages_collection, client, gmt8, l
                 
             logger.info(f"Deleting session: {session_id}")
             
+            # Queued writes would recreate the messages after the delete
+            work_queue.flush(session_id)
+
             # Delete session and related messages
             sessions_collection.delete_one({"session_id": session_id})
             messages_collection.delete_many({"session_id": session_id})
+            transcript_cache.invalidate(session_id)
             
             logger.info(f"Session {session_id} deleted successfully")
             return jsonify({"success": True})
@@ -665,48 +747,102 @@ def create_chat_routes(sessions_collection, messages_collection, client, gmt8, l
         except Exception as e:
             logger.error(f"Error updating title: {str(e)}")
             return jsonify({"error": f"Failed to update title: {str(e)}"}), 500
-            
-    def set_current_topic(session_id, topic_id):
-        """Helper function to set topic for a session"""
-        try:
-            sessions_collection.update_one(
-                {"session_id": session_id},
-                {"$set": {"topic_id": topic_id}}
-            )
-            logger.info(f"Set topic {topic_id} for session {session_id}")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to set topic: {str(e)}")
-            return False
-            
+
     return chat_bp
     
-def get_user_topic_progression(user_id, topic_id, users_collection):
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
-    if not user or "progression" not in user or "topics" not in user["progression"]:
-        return None
+def build_progression_context(topic_id, preferred_language, user_preferences, topic_progression=None, all_progressions=None):
+    """Build the dynamic progression system message from already loaded user data"""
+    if topic_id:
+        progression_data = topic_progression
+        if progression_data:
+            logger.info(f"Added progression context for topic {topic_id}")
+            return {
+                "role": "system", 
+                "content": (
+                    f"User has previously studied topic '{topic_id}' with progress {progression_data['progress']}%. "
+                    f"{'They have completed this topic. So can focus on revision.' if progression_data.get('revision', False) else 'The topic is not yet complete.'} "
+                    f"Last studied at {progression_data['last_study_time']}. "
+                    f"Notes: {progression_data.get('notes', 'None')}."
+                )
+            }
+        # User has no previous progression for this topic - first time learning
+        topic_name = get_topic_name(topic_id, preferred_language)
+        logger.info(f"Added first-time learning context for topic {topic_id}")
+        return {
+            "role": "system",
+            "content": (
+                f"This is the user's first time studying the topic '{topic_name}' (ID: {topic_id}). "
+                f"Start with fundamental concepts and build up gradually. "
+                f"Assess their current understanding before diving into advanced topics."
+            )
+        }
+
+    # No topic - provide both progression history and preferences for comprehensive context
+    all_progressions = all_progressions or []
+    math_topics = user_preferences.get("math_topics", [])
+
+    context_parts = []
+
+    if all_progressions:
+        progression_summary = "User's mathematics learning history:\n"
+        for prog in all_progressions:
+            topic_name = get_topic_name(prog.get('id'), preferred_language)
+            if prog.get('revision', False):
+                status = "Mastered (excellent for revision!)"
+            else:
+                status = f"{prog.get('progress', 0)}% progress"
+            progression_summary += f"• {topic_name}: {status}\n"
+        context_parts.append(progression_summary)
+
+    if math_topics:
+        preferences_summary = "User's selected mathematical interests:\n"
+        for math_topic in math_topics:
+            topic_name = get_topic_name(math_topic, preferred_language)
+            preferences_summary += f"• {topic_name}\n"
+        context_parts.append(preferences_summary)
+
+    if context_parts:
+        # User has progression history and/or preferences
+        combined_context = "\n".join(context_parts)
+        combined_context += "\nWhen the user asks for topic recommendations, provide them with MULTIPLE options (at least 3-5 choices) rather than just one. "
+        combined_context += "Based on their learning history and interests, suggest several logical next topics, review areas, or related topics they might find interesting. "
+        combined_context += "Present the options in a clear, organized way so they can choose what appeals to them most. "
+        combined_context += "\n🔄 IMPORTANT FOR REVISION REQUESTS: If the user specifically asks about revision, review, or revisiting previous topics, "
+        combined_context += "prioritize and prominently suggest topics marked as 'Mastered' - these are completed topics perfect for revision! "
+        combined_context += "Include these mastered topics in your recommendations alongside other options. "
+        combined_context += "Consider prerequisite relationships between topics and identify knowledge gaps. "
+        combined_context += "Remember: Guidelines contain template examples (like quadratic equations) - adapt all teaching to the recommended topic."
+
+        logger.info(f"Added combined progression and preferences context (progressions: {len(all_progressions)}, preferences: {len(math_topics)})")
+        return {
+            "role": "system",
+            "content": combined_context
+        }
+
+    # No history or preferences - provide all available topics for reference
+    all_topics = get_available_topics()
+    topics_summary = "Available mathematics topics for new learner (no history or preferences):\n"
+    for available_topic in all_topics:
+        topic_name = get_topic_name(available_topic, preferred_language)
+        topics_summary += f"• {topic_name}\n"
+
+    logger.info("Added all available topics for recommendation")
+    return {
+        "role": "system",
+        "content": (
+            topics_summary + 
+            "When the user asks for topic recommendations, provide them with MULTIPLE options (at least 3-5 choices) from the available topics. "
+            "Assess user's mathematical background and suggest several appropriate starting topics based on their goals and current knowledge. "
+            "Present the options in a clear, organized way (such as by difficulty level or subject area) so they can choose what interests them most. "
+            "Key reminder: All teaching examples in guidelines (like quadratic equations) are templates only - "
+            "create topic-specific examples and explanations relevant to whatever subject you're teaching."
+        )
+    }
 
-    for topic in user["progression"]["topics"]:
-        if topic.get("id") == topic_id:
-            return topic
-    return None  # not found
-
-def get_all_user_progressions(user_id, users_collection):
-    """Get all topic progressions for a user"""
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
-    if not user or "progression" not in user or "topics" not in user["progression"]:
-        return []
-    return user["progression"]["topics"]
-
-def update_user_topic_progression(user_id, topic_id, progress, notes, users_collection):
-    # find user first
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
-    if not user:
-        return False
-
-    # construct new record
+def build_topic_progression(topic_id, progress, notes):
+    """Progression record stored for one topic in progression.topics"""
     current_time = datetime.now(pytz.timezone('Asia/Singapore'))
-    new_topic = {
+    return {
         "id": topic_id,
         "progress": progress,
         "revision": progress >= 100,
@@ -714,27 +850,40 @@ def update_user_topic_progression(user_id, topic_id, progress, notes, users_coll
         "notes": notes
     }
 
-    # check if topic already exists
-    found = False
-    if "progression" in user and "topics" in user["progression"]:
-        for i, topic in enumerate(user["progression"]["topics"]):
-            if topic.get("id") == topic_id:
-                user["progression"]["topics"][i] = new_topic
-                found = True
-                break
-    else:
-        # initialize empty structure
-        user["progression"] = {"topics": []}
+def update_user_topic_progression(user_id, topic_id, progress, notes, users_collection, job_id=None):
+    """Upsert one topic's progression with atomic server-side updates, without reading the user first.
 
-    if not found:
-        user["progression"]["topics"].append(new_topic)
+    With a job_id (background job) each update only matches if the job has not
+    been applied yet and records it, so a retried or replayed job changes nothing.
+    """
+    new_topic = build_topic_progression(topic_id, progress, notes)
+    guard = applied_job_filter(job_id) if job_id else {}
+    record = {"$push": applied_job_push(job_id)} if job_id else {}
 
-    # update back to database
-    users_collection.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"progression.topics": user["progression"]["topics"]}}
+    # Topic already tracked: replace that array element in place
+    result = users_collection.update_one(
+        {"_id": ObjectId(user_id), "progression.topics.id": topic_id, **guard},
+        {"$set": {"progression.topics.$": new_topic}, **record}
     )
-    return True
+    if result.matched_count == 0:
+        # First progress on this topic: append, guarded so concurrent requests cannot add it twice
+        result = users_collection.update_one(
+            {"_id": ObjectId(user_id), "progression.topics.id": {"$ne": topic_id}, **guard},
+            {"$push": {"progression.topics": new_topic, **record.get("$push", {})}}
+        )
+    if result.matched_count == 0:
+        # Another request appended the topic between the two updates
+        result = users_collection.update_one(
+            {"_id": ObjectId(user_id), "progression.topics.id": topic_id, **guard},
+            {"$set": {"progression.topics.$": new_topic}, **record}
+        )
+    if result.matched_count == 0 and job_id:
+        # Nothing matched because an earlier run of this job already wrote it
+        return users_collection.count_documents({"_id": ObjectId(user_id), "applied_jobs": job_id}, limit=1) > 0
+
+    # The request-scoped copy no longer matches the database
+    get_user_loader(users_collection).invalidate(user_id)
+    return result.matched_count > 0
 
 
 # topic tools schema
@@ -789,6 +938,19 @@ new_topic_tools = [
 ]
 
 def get_progression_tools_schema(topic_id):
+    """Progression tool schema, pinned to topic_id or (topic_id=None) accepting any topic"""
+    if topic_id:
+        topic_id_schema = {
+            "type": "string",
+            "const": topic_id,
+            "description": f"Always use this exact topic ID: {topic_id}"
+        }
+    else:
+        topic_id_schema = {
+            "type": "string",
+            "enum": get_available_topics(),
+            "description": "Always use the ID of the topic you are currently teaching."
+        }
     return [
         {
             "type": "function",
@@ -802,11 +964,7 @@ def get_progression_tools_schema(topic_id):
                 "parameters": {
                     "type": "object",
                     "properties": {
-                        "topic_id": {
-                            "type": "string",
-                            "const": topic_id,
-                            "description": f"Always use this exact topic ID: {topic_id}"
-                        },
+                        "topic_id": topic_id_schema,
                         "progress": {
                             "type": "integer",
                             "minimum": 0,
@@ -837,3 +995,464 @@ def get_progression_tools_schema(topic_id):
     ]
 
 
+def has_personal_context(user_data, topic_id):
+    """Whether the progression context of a turn depends on the user's own history or interests"""
+    user_data = user_data or {}
+    topics = user_data.get("progression", {}).get("topics", [])
+    if topic_id:
+        return any(t.get("id") == topic_id for t in topics)
+    return bool(topics or user_data.get("preferences", {}).get("math_topics"))
+
+def progression_tool_schema(current_topic):
+    """update_user_progression schema for the session topic"""
+    if is_cache_friendly():
+        # Keep the schemas identical across topics so they stay in the cached prefix
+        return get_progression_tools_schema(None)[0]
+    return get_progression_tools_schema(current_topic)[0]
+
+def create_tool_registry(handlers):
+    """Chat tools: topic detection without a topic, progression and new topic suggestion with one.
+
+    handlers maps each tool name to its handler (sync or async, see tool_registry).
+    """
+    registry = ToolRegistry()
+    registry.register(
+        "set_current_topic", tools_schema[0], handlers["set_current_topic"],
+        offered=lambda current_topic: not current_topic
+    )
+    # Runs after set_current_topic, which changes the topic it is checked against
+    registry.register(
+        "update_user_progression", progression_tool_schema, handlers["update_user_progression"],
+        offered=lambda current_topic: bool(current_topic), phase=1
+    )
+    # Ends the turn with a link to a new session
+    registry.register(
+        "suggest_new_topic_session", new_topic_tools[0], handlers["suggest_new_topic_session"],
+        offered=lambda current_topic: bool(current_topic), terminal=True
+    )
+    return registry
+
+def get_tool_guidance(tool_names, current_topic, preferred_language):
+    """Guidance system message for the follow-up call after tools ran"""
+    if "update_user_progression" in tool_names:
+        # Add guidance for progression tool response
+        return {
+            "role": "system",
+            "content": (
+                "Based on the user's progress, now continue the lesson by: "
+                "1. Introducing the next logical concept in this topic. "
+                "2. Asking a follow-up question related to what they just learned to reinforce their understanding. "
+                "Do not mention tools or progression explicitly."
+            )
+        }
+    if "set_current_topic" in tool_names:
+        # Add guidance for topic setting response with updated topic
+        topic_name = get_topic_name(current_topic, preferred_language)
+        return {
+            "role": "system",
+            "content": (
+                f"You have set the session topic to '{topic_name}' (ID: {current_topic}). Now begin teaching this topic by: "
+                "1. Briefly introducing a basic concept or question to assess the user's familiarity. "
+                "2. Avoid listing subtopics; instead, choose one simple example to engage the user. "
+                "3. Ask the user to try something or share what they find confusing about the topic. "
+                "Do not mention tools or topic-setting."
+            )
+        }
+    return None
+
+def get_tool_instruction(topic_id):
+    """Explicit tool usage instruction for a session with a topic"""
+    return {
+        "role": "system",
+        "content": (
+            f"You are currently teaching topic '{topic_id}'.\n\n"
+            "🧠 Throughout the conversation, closely observe the user's learning signals. After any meaningful learning interaction, "
+            "you must use the `update_user_progression` tool to track their progress.\n\n"
+
+            "✅ Meaningful learning interactions include (but are not limited to):\n"
+            "- The user correctly solves a problem or completes a calculation\n"
+            "- The user demonstrates understanding of a concept, even partially\n"
+            "- The user applies a method you previously explained\n"
+            "- The user asks a thoughtful question or makes a relevant connection\n"
+            "- The user attempts to explain, reason, or paraphrase an idea\n"
+            "- The user moves from confusion to clarity after your guidance\n\n"
+            "🏆 If the user answers a question correctly, always treat this as progress and award at least 1 point using the `update_user_progression` tool.\n\n"
+            "⚠️ Do NOT wait for perfect answers. Even small improvements or signs of engagement count as progress.\n"
+            "You are expected to proactively track and log progression after any such interaction, so the system can adapt to the user's evolving understanding."
+            "\n\n"
+            "If the user expresses a desire to switch to a completely different topic — e.g. by saying things like "
+            "'I want to learn something new', 'Can we switch topics?', 'I don't want to continue this topic', "
+            "'Let's try geometry', or similar expressions — do NOT continue with the current topic. "
+            "Instead, call the `suggest_new_topic_session` tool with a suitable suggested topic "
+            "based on their message or learning history. Do not teach the new topic directly in the current session. "
+            "Only when the user's intent is to fully switch to a new **main topic** (not just a sub-area) should you "
+            "call the `suggest_new_topic_session` tool with a suitable suggested topic based on their message or "
+            "learning history. "
+            "Let the frontend handle topic transition via a new session link."
+        )
+    }
+
+def tool_call_to_dict(tool_call):
+    """Convert an SDK tool call object into the plain dict sent back in messages"""
+    return {
+        "id": tool_call.id,
+        "type": "function",
+        "function": {
+            "name": tool_call.function.name,
+            "arguments": tool_call.function.arguments
+        }
+    }
+
+# Turn pipeline shared by these routes and the async ones (routes/chat_async.py).
+# Each step works on data the caller already loaded; the routes do the I/O around them.
+
+def user_progression_context(user_data, topic_id, preferred_language):
+    """Progression context system message of a loaded user document (dynamic, not saved to DB)"""
+    user_preferences = user_data.get("preferences", {}) if user_data else {}
+    topics = (user_data or {}).get("progression", {}).get("topics", [])
+    if topic_id:
+        # Specific topic - provide progression for this topic
+        topic_progression = next((t for t in topics if t.get("id") == topic_id), None)
+        return build_progression_context(
+            topic_id, preferred_language, user_preferences, topic_progression=topic_progression
+        )
+    # No topic - provide both progression history and preferences for comprehensive context
+    return build_progression_context(topic_id, preferred_language, user_preferences, all_progressions=topics)
+
+def cached_transcript(session_id, session_data):
+    """Fresh cached transcript of a session, or None when it has to be read from MongoDB"""
+    if turn_in_flight(session_data):
+        # Another turn is writing to this session, maybe in another worker: stop caching until it settles
+        transcript_cache.invalidate(session_id)
+        return None
+    return transcript_cache.get(session_id, expected_sequence=settled_sequence(session_data))
+
+def keep_transcript(session_id, session_data, messages):
+    """Cache a transcript read from MongoDB, unless a turn in flight may still change it"""
+    if not turn_in_flight(session_data):
+        transcript_cache.set(session_id, messages)
+
+def classify_turn_topic(current_topic, user_input):
+    """(classified topic, whether to set it now); only a session without a topic is classified"""
+    classified_topic = detect_topic(user_input) if not current_topic else None
+    return classified_topic, should_apply(classified_topic)
+
+def turn_history(transcript, session_data, system_message):
+    """Prompt history: the system prompt, the session summary and the messages it does not cover"""
+    messages = [
+        {"role": m["role"], "content": m["content"]}
+        for m in select_unsummarized(transcript, session_data)
+    ]
+    # System prompt is stored by reference (older sessions keep it in the transcript)
+    if system_message:
+        messages.insert(0, system_message)
+    add_summary_context(messages, session_data)
+    return messages
+
+def turn_response_cache_key(session_data, preferred_language, current_topic, user_input, transcript, user_data):
+    """Response cache key of a turn; the history length counts the stored transcript, not the prompt"""
+    return response_cache.make_key(
+        session_data.get("prompt_version"),
+        [session_data.get("language"), preferred_language],
+        current_topic,
+        user_input,
+        sum(1 for m in transcript if m["role"] != "system"),
+        has_personal_context(user_data, current_topic)
+    )
+
+def user_message_doc(session_id, sequence, user_input, created_at):
+    """Stored user message of a turn"""
+    return {
+        "message_id": f"{session_id}_{sequence}",
+        "session_id": session_id,
+        "role": "user",
+        "content": user_input,
+        "created_at": created_at,
+        "sequence": sequence
+    }
+
+def build_turn(tools, user_id, session_data, user_message, history, preferred_language, current_topic,
+               progression_context, classified_topic, topic_set_locally, response_cache_key):
+    """State of a turn whose user message is saved, with the first API call.
+
+    history is the turn_history() of the transcript before user_message.
+    """
+    messages = history + [{"role": "user", "content": user_message["content"]}]
+
+    # Add per-turn context (progression, topic, explicit tool instruction) in the configured prompt layout
+    tool_instruction = get_tool_instruction(current_topic) if current_topic else None
+    topic_context = topic_message(current_topic, session_data.get("language", "en")) if current_topic else None
+    messages = assemble_messages(messages, progression_context, tool_instruction, topic_context=topic_context)
+    if topic_set_locally:
+        messages.append(get_tool_guidance(["set_current_topic"], current_topic, preferred_language))
+    if is_single_pass():
+        # Ask for the reply alongside the tool calls so no follow-up call is needed
+        messages.append(SINGLE_PASS_INSTRUCTION)
+
+    # Keep the prompt inside the model's token budget
+    messages, _ = fit_to_budget(messages, "gpt-4o")
+
+    # Prepare function calling based on whether the session has a topic
+    api_params = {
+        "model": "gpt-4o",
+        "messages": messages,
+        "temperature": 0.7,
+        "tools": tools.schemas(current_topic),
+        "tool_choice": "auto",
+    }
+
+    return {
+        "user_id": user_id,
+        "session_id": user_message["session_id"],
+        "user_input": user_message["content"],
+        "preferred_language": preferred_language,
+        "current_topic": current_topic,
+        "messages": messages,
+        "api_params": api_params,
+        "user_message_id": user_message["message_id"],
+        "next_sequence": user_message["sequence"],
+        "summary_upto": session_data.get("summary_upto"),
+        "prompt_version": session_data.get("prompt_version"),
+        "response_cache_key": response_cache_key,
+        "classified_topic": classified_topic
+    }
+
+def add_tool_results(turn, content, tool_calls, results):
+    """Add the model's tool calls, their results and the follow-up guidance to the turn's prompt"""
+    messages = turn["messages"]
+    messages.append({
+        "role": "assistant",
+        "content": content,
+        "tool_calls": tool_calls
+    })
+    for tool_call, tool_response in results:
+        # which tool_call, must append the corresponding "tool" message, ensure the next call is legal
+        messages.append({
+            "role": "tool",
+            "tool_call_id": tool_call["id"],
+            "content": tool_response
+        })
+
+    # Add guidance message based on which tools were called
+    guidance = get_tool_guidance(
+        [tc["function"]["name"] for tc in tool_calls], turn["current_topic"], turn["preferred_language"]
+    )
+    if guidance:
+        messages.append(guidance)
+
+def queue_assistant_reply(turn, assistant_message, created_at, summarizer=None):
+    """Cache the assistant reply and queue its message insert, session update and usage. Raises on failure."""
+    session_id = turn["session_id"]
+    job_args = assistant_reply_job(turn, assistant_message, created_at)
+    transcript_cache.append(session_id, transcript_entry(job_args["message"]))
+    work_queue.submit("assistant_reply", job_args, keys=[session_id, turn["user_id"]])
+    logger.info(f"Assistant message queued, ID: {job_args['message']['message_id']}")
+    submit_turn_usage(turn)
+
+    # Compact older turns into the session summary in the background
+    if summarizer:
+        summarizer.maybe_schedule(session_id, job_args["message"]["sequence"], turn["summary_upto"])
+
+# Steps a transport performs for turn_steps()
+COMPLETE = "complete"    # (COMPLETE, api_params, label) -> completion_result()
+RUN_TOOLS = "run_tools"  # (RUN_TOOLS, tool_calls) -> (results, suggestion) as returned by ToolRegistry.run
+RESET = "reset"          # (RESET,) -> None; the text streamed so far is not part of the reply
+
+def completion_result(content, tool_calls, usage):
+    """Result of a COMPLETE step; tool_calls as plain dicts (see tool_call_to_dict)"""
+    return {"content": content, "tool_calls": tool_calls or [], "usage": usage}
+
+def turn_steps(turn, tools):
+    """Decisions of a prepared chat turn, shared by the sync, async and streaming routes.
+
+    A generator of the I/O steps above; the transport performs each one and
+    sends its result back in, or throws its exception in. Returns the
+    outcome ({"reply", "suggestion"}); an exception escaping it fails the turn.
+    """
+    entry = response_cache.get(turn["response_cache_key"])
+    if entry is not None:
+        # Repeated cold-start requests are answered from the response cache, with their tool calls applied again
+        if entry["tool_calls"]:
+            yield RUN_TOOLS, entry["tool_calls"]
+        return {"reply": entry["reply"], "suggestion": False}
+
+    first = yield COMPLETE, turn["api_params"], "first call"
+    add_usage(turn, first["usage"])
+    content, tool_calls = first["content"], first["tool_calls"]
+    two_calls = False
+    cacheable = False
+    if tool_calls:
+        # Single-pass mode: the reply came with the tool calls
+        reply = single_pass_reply(content, tool_calls, tools)
+        if reply is None:
+            # Text before a tool call is replaced by the follow-up reply
+            yield RESET,
+        results, suggestion = yield RUN_TOOLS, tool_calls
+        if suggestion is not None:
+            record_turn(two_calls)
+            return {"reply": suggestion, "suggestion": True}
+        add_tool_results(turn, content or None, tool_calls, results)
+
+        if reply is not None:
+            cacheable = True
+        else:
+            # Make second API call to get GPT's response based on tool results
+            two_calls = True
+            second_params = {"model": "gpt-4o", "messages": turn["messages"], "temperature": 0.7}
+            try:
+                second = yield COMPLETE, second_params, "second call"
+                add_usage(turn, second["usage"])
+                reply = second["content"]
+                cacheable = bool(reply)
+                logger.info("Second GPT call successful - got text response after tool execution")
+            except Exception as second_api_error:
+                logger.error(f"Failed second GPT API call: {str(second_api_error)}")
+                yield RESET,
+            reply = reply or "I've processed your request. How can I help you further?"
+    else:
+        # No tool calls, use the original response
+        reply = content or "I'm sorry, I didn't understand your request. Please try again."
+        cacheable = bool(content)
+
+    record_turn(two_calls)
+    if cacheable:
+        response_cache.put(turn["response_cache_key"], reply, tool_calls, turn_total_tokens(turn))
+    return {"reply": reply, "suggestion": False}
+
+class TurnMachine:
+    """Runs turn_steps() for one turn; outcome is set once the turn is decided"""
+
+    def __init__(self, turn, tools):
+        self.turn = turn
+        self.outcome = None
+        self._steps = turn_steps(turn, tools)
+
+    def advance(self, result=None, error=None):
+        """Hand back the last step's result (or error) and get the next step, None when decided"""
+        try:
+            if error is not None:
+                return self._steps.throw(error)
+            return self._steps.send(result)
+        except StopIteration as stop:
+            self.outcome = stop.value
+            return None
+
+    def run(self, perform):
+        """Perform every step with perform(turn, step, *args); returns the outcome"""
+        step = self.advance()
+        while step is not None:
+            try:
+                result, error = perform(self.turn, *step), None
+            except Exception as e:
+                result, error = None, e
+            step = self.advance(result, error)
+        return self.outcome
+
+    async def run_async(self, perform):
+        """Same with a coroutine perform"""
+        step = self.advance()
+        while step is not None:
+            try:
+                result, error = await perform(self.turn, *step), None
+            except Exception as e:
+                result, error = None, e
+            step = self.advance(result, error)
+        return self.outcome
+
+def assistant_reply_job(turn, assistant_message, created_at):
+    """Args of the assistant_reply background job for a finished turn"""
+    session_id = turn["session_id"]
+    user_input = turn["user_input"]
+    assistant_sequence = turn["next_sequence"] + 1
+    message = {
+        "message_id": f"{session_id}_{assistant_sequence}",
+        "session_id": session_id,
+        "role": "assistant",
+        "content": assistant_message,
+        "created_at": created_at,
+        "sequence": assistant_sequence
+    }
+    usage = message_usage(turn)
+    if usage:
+        message["usage"] = usage
+    return {
+        "message": message,
+        "last_message": user_input[:50] + "..." if len(user_input) > 50 else user_input
+    }
+
+def submit_turn_usage(turn):
+    """Queue the session and daily token counters of a turn, once (no-op when no completion ran)"""
+    totals = turn.get("usage")
+    if not totals or turn.get("usage_submitted"):
+        return
+    turn["usage_submitted"] = True
+    record_usage_stats(totals)
+    work_queue.submit("session_usage", {
+        "session_id": turn["session_id"], "totals": totals
+    }, keys=[turn["session_id"]])
+    work_queue.submit("daily_usage", {
+        "user_id": turn["user_id"], "day": usage_day(), "totals": totals, "topic_id": turn["current_topic"]
+    }, keys=[turn["user_id"]])
+
+def register_background_jobs(sessions_collection, messages_collection, users_collection, token_usage_collection):
+    """Handlers of the chat turn's background writes.
+
+    A job can run again with the same job_id (retry, spool replay): the reply
+    message is an upsert keyed by (session_id, sequence), every other write
+    is guarded by the job_id.
+    """
+    def write_assistant_reply(args, job_id):
+        message = args["message"]
+        # Keyed like the unique (session_id, sequence) index, so a replayed job cannot add a duplicate
+        messages_collection.update_one(
+            {"session_id": message["session_id"], "sequence": message["sequence"]},
+            {"$setOnInsert": {k: v for k, v in message.items() if k not in ("session_id", "sequence")}},
+            upsert=True
+        )
+        # The turn's two messages are counted once per job; $max keeps a late job from moving the session backwards
+        sessions_collection.update_one(
+            {"session_id": message["session_id"], **applied_job_filter(job_id)},
+            {
+                "$inc": {"message_count": 2},
+                "$max": {"settled_sequence": message["sequence"], "updated_at": message["created_at"]},
+                "$set": {"last_message": args["last_message"]},
+                "$push": applied_job_push(job_id)
+            }
+        )
+
+    def write_progression(args, job_id):
+        if not update_user_topic_progression(args["user_id"], args["topic_id"], args["progress"], args["notes"], users_collection, job_id):
+            logger.error(f"Failed to update progression for user {args['user_id']}, topic {args['topic_id']}")
+
+    # Token counters: each $inc is guarded by the job id, so a job that runs again is not counted twice
+    def write_session_usage(args, job_id):
+        sessions_collection.update_one(
+            session_usage_filter(args["session_id"], job_id), session_usage_update(args["totals"], job_id)
+        )
+
+    def write_daily_usage(args, job_id):
+        query = daily_usage_filter(args["user_id"], args["day"], job_id)
+        update = daily_usage_update(args["user_id"], args["day"], args["totals"], args["topic_id"], job_id)
+        try:
+            token_usage_collection.update_one(query, update, upsert=True)
+        except DuplicateKeyError:
+            # The day's document exists: this job was counted already, or another job created it meanwhile
+            token_usage_collection.update_one(query, update)
+
+    work_queue.register("assistant_reply", write_assistant_reply)
+    work_queue.register("progression", write_progression)
+    work_queue.register("session_usage", write_session_usage)
+    work_queue.register("daily_usage", write_daily_usage)
+
+def transcript_entry(message_doc):
+    """Fields of a stored message kept in the transcript cache"""
+    return {
+        "role": message_doc["role"],
+        "content": message_doc["content"],
+        "created_at": message_doc["created_at"],
+        "sequence": message_doc["sequence"]
+    }
+
+def sse_event(event_type, **data):
+    """Format one Server-Sent Event carrying a JSON payload"""
+    return f"data: {json.dumps({'type': event_type, **data}, ensure_ascii=False)}\n\n"
@@ -0,0 +1,611 @@
+"""
+Async versions of the chat routes, served on an ASGI stack (see asgi.py).
+
+They mirror create_chat_routes in routes/chat.py but use the async OpenAI
+client and motor collections, so a turn waiting on the LLM does not hold a
+worker thread. Only the I/O lives here: the turn pipeline (history, prompt,
+response cache key, stored documents, reply persistence) and the tool
+schemas are the helpers in routes/chat.py, shared with the sync routes.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from functools import wraps
+
+from bson import ObjectId
+from quart import Blueprint, Response, g, jsonify, request
+
+from history_cache import transcript_cache
+from user_loader import USER_PROJECTION
+from topic_classifier import log_agreement
+from admission import admission, AdmissionRejected
+from work_queue import work_queue
+from sequence_allocator import reserve_sequences_async, settle_sequences_async
+from prompt_layout import record_prompt_cache_usage
+from token_usage import quota_exceeded_async
+from utils import get_topic_name, get_welcome_message, get_new_topic_suggestion_message
+from routes.chat import (
+    create_tool_registry,
+    tool_call_to_dict,
+    submit_turn_usage,
+    transcript_entry,
+    user_progression_context,
+    cached_transcript,
+    keep_transcript,
+    classify_turn_topic,
+    turn_history,
+    turn_response_cache_key,
+    user_message_doc,
+    build_turn,
+    queue_assistant_reply,
+    completion_result,
+    TurnMachine,
+    COMPLETE,
+    RUN_TOOLS,
+    sse_event,
+    parse_history_page,
+    history_page_filter,
+    page_from_newest,
+    page_of_transcript,
+    history_page_body,
+    QUOTA_EXCEEDED_ERROR,
+    HISTORY_PAGE_ERROR,
+    TRANSCRIPT_FIELDS,
+)
+
+logger = logging.getLogger(__name__)
+
+class ReleasingStream:
+    """Async reply stream that frees its admission slot when it ends or is closed.
+
+    Quart closes the response body it opened with aclose(), also when the
+    client went away before the first event was read; an unstarted async
+    generator's finally would not run then. release() is idempotent.
+    """
+
+    def __init__(self, events, ticket):
+        self.events = events
+        self.ticket = ticket
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.events.__anext__()
+        except StopAsyncIteration:
+            admission.release(self.ticket)
+            raise
+
+    async def aclose(self):
+        try:
+            await self.events.aclose()
+        finally:
+            admission.release(self.ticket)
+
+def create_async_chat_routes(sessions_collection, messages_collection, users_collection, client, gmt8,
+                             prompt_registry, get_session_user_id, summarizer=None):
+    """Create the async chat blueprint.
+
+    get_session_user_id(cookie_header) reads the user id from the Flask
+    server-side session, so both stacks share one login.
+    """
+    chat_bp = Blueprint('chat_async', __name__)
+
+    # Daily token counters, in the same database (written by the sync background jobs)
+    from database import token_usage_collection
+    async_token_usage_collection = sessions_collection.database[token_usage_collection.name]
+
+    def login_required(f):
+        """Check if user is logged in"""
+        @wraps(f)
+        async def decorated_function(*args, **kwargs):
+            user_id = await asyncio.to_thread(get_session_user_id, request.headers.get("Cookie", ""))
+            if not user_id:
+                return jsonify({"error": "Please login first"}), 401
+            g.user_id = user_id
+            return await f(*args, **kwargs)
+        return decorated_function
+
+    def auth_required(f):
+        """Check if user is logged in and provide session_id"""
+        @wraps(f)
+        @login_required
+        async def decorated_function(*args, **kwargs):
+            data = await request.get_json()
+            if not data or not data.get("session_id"):
+                return jsonify({"error": "Session ID is required"}), 400
+            return await f(*args, **kwargs)
+        return decorated_function
+
+    def admission_rejected_response(rejected):
+        response = jsonify({
+            "error": "Too many requests right now, please try again shortly",
+            "retry_after": rejected.retry_after
+        })
+        response.headers["Retry-After"] = str(rejected.retry_after)
+        return response, 429
+
+    def admission_required(f):
+        """Queue the turn behind the LLM admission controller (see admission.py)"""
+        @wraps(f)
+        async def decorated_function(*args, **kwargs):
+            try:
+                ticket = await admission.admit_async(g.user_id)
+            except AdmissionRejected as rejected:
+                return admission_rejected_response(rejected)
+            g.admission_ticket = ticket
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                # A streamed reply takes over the ticket and releases it when the stream ends
+                if g.get("admission_ticket") is ticket:
+                    admission.release(ticket)
+        return decorated_function
+
+    async def transcript_cache_call(method, *args):
+        """Read or update the transcript cache shared with the sync routes (Redis calls block)"""
+        return await asyncio.to_thread(method, *args)
+
+    async def read_transcript(session_id):
+        cursor = messages_collection.find({"session_id": session_id}, TRANSCRIPT_FIELDS).sort("sequence", 1)
+        return await cursor.to_list(length=None)
+
+    async def load_transcript(session_id, session_data):
+        """Async counterpart of load_transcript in routes/chat.py"""
+        messages = await transcript_cache_call(cached_transcript, session_id, session_data)
+        if messages is None:
+            messages = await read_transcript(session_id)
+            await transcript_cache_call(keep_transcript, session_id, session_data, messages)
+        return messages
+
+    async def load_transcript_page(session_id, session_data, limit, before_sequence):
+        """Async counterpart of load_transcript_page in routes/chat.py"""
+        messages = await transcript_cache_call(cached_transcript, session_id, session_data)
+        if messages is not None:
+            return page_of_transcript(messages, limit, before_sequence)
+        cursor = messages_collection.find(
+            history_page_filter(session_id, before_sequence), TRANSCRIPT_FIELDS
+        ).sort("sequence", -1).limit(limit + 1)
+        return page_from_newest(await cursor.to_list(length=None), limit)
+
+    async def find_user(user_id):
+        """User document of a request, with the fields the chat helpers read"""
+        return await users_collection.find_one({"_id": ObjectId(user_id)}, USER_PROJECTION)
+
+    async def resolve_system_message(session_data):
+        """System prompt of a session; a prompt version not yet cached is loaded off the event loop"""
+        if prompt_registry.is_cached(session_data.get("prompt_version")):
+            return prompt_registry.system_message(session_data)
+        return await asyncio.to_thread(prompt_registry.system_message, session_data)
+
+    async def prepare_chat_turn(user_id, session_id, user_input, preferred_language):
+        """Async counterpart of prepare_chat_turn in routes/chat.py"""
+        if not user_input:
+            logger.warning("Received empty message")
+            return None, (jsonify({"error": "Message cannot be empty"}), 400)
+
+        await work_queue.flush_async(session_id, user_id)
+        if await quota_exceeded_async(async_token_usage_collection, user_id):
+            return None, (jsonify({"error": QUOTA_EXCEEDED_ERROR}), 429)
+
+        session_data, next_sequence = await reserve_sequences_async(sessions_collection, messages_collection, session_id, user_id)
+        if not session_data:
+            if await sessions_collection.find_one({"session_id": session_id}, {"_id": 1}):
+                logger.error(f"Session {session_id} does not belong to user {user_id}")
+                return None, (jsonify({"error": "Unauthorized access to this session"}), 403)
+            logger.error(f"Session not found: {session_id}")
+            return None, (jsonify({"error": "Session not found"}), 404)
+
+        turn = None
+        try:
+            turn, error_response = await start_turn(user_id, session_id, user_input, preferred_language, session_data, next_sequence)
+            return turn, error_response
+        finally:
+            if turn is None:
+                await release_reservation(session_id, next_sequence)
+
+    async def start_turn(user_id, session_id, user_input, preferred_language, session_data, next_sequence):
+        """Async counterpart of start_turn in routes/chat.py"""
+        transcript = await load_transcript(session_id, session_data)
+        history = turn_history(transcript, session_data, await resolve_system_message(session_data))
+
+        current_topic = session_data.get("topic_id")
+        classified_topic, topic_set_locally = classify_turn_topic(current_topic, user_input)
+        if topic_set_locally:
+            await sessions_collection.update_one({"session_id": session_id}, {"$set": {"topic_id": classified_topic}})
+            logger.info(f"Topic classifier set session {session_id} topic: {classified_topic}")
+            current_topic = classified_topic
+        user_data = await find_user(user_id)
+        progression_context = user_progression_context(user_data, current_topic, preferred_language)
+        response_cache_key = turn_response_cache_key(
+            session_data, preferred_language, current_topic, user_input, transcript, user_data
+        )
+
+        user_message = user_message_doc(session_id, next_sequence, user_input, datetime.now(gmt8))
+        try:
+            await messages_collection.insert_one(user_message)
+            await transcript_cache_call(transcript_cache.append, session_id, transcript_entry(user_message))
+        except Exception as save_error:
+            logger.error(f"Failed to save user message: {str(save_error)}")
+            return None, (jsonify({"error": "Failed to save your message"}), 500)
+
+        turn = build_turn(
+            tools, user_id, session_data, user_message, history, preferred_language, current_topic,
+            progression_context, classified_topic, topic_set_locally, response_cache_key
+        )
+        return turn, None
+
+    async def set_current_topic(turn, args):
+        function_call_topic = args.get("topic_id")
+        await sessions_collection.update_one(
+            {"session_id": turn["session_id"]},
+            {"$set": {"topic_id": function_call_topic}}
+        )
+        logger.info(f"Updated session {turn['session_id']} with topic: {function_call_topic}")
+        turn["current_topic"] = function_call_topic
+        log_agreement(turn.get("classified_topic"), function_call_topic)
+        topic_name = get_topic_name(function_call_topic, turn["preferred_language"])
+        return f"Topic successfully set to '{topic_name}' for this session."
+
+    async def update_user_progression(turn, args):
+        topic_id = args.get("topic_id")
+        progress = args.get("progress")
+        notes = args.get("notes", "")
+        if turn["current_topic"] != topic_id:
+            logger.warning(f"Topic mismatch: session topic {turn['current_topic']}, tool topic {topic_id}")
+            return "Error: Topic mismatch. Could not update progression."
+        await work_queue.submit_async("progression", {
+            "user_id": turn["user_id"], "topic_id": topic_id, "progress": progress, "notes": notes
+        }, keys=[turn["user_id"]])
+        return f"User progression updated successfully: {progress}% completion for topic '{topic_id}'."
+
+    async def suggest_new_topic_session(turn, args):
+        suggested_topic_id = args.get("suggested_topic_id")
+        logger.info(f"AI suggesting new topic session: {suggested_topic_id}")
+        await rollback_user_message(turn)
+        return get_new_topic_suggestion_message(suggested_topic_id, turn["preferred_language"])
+
+    tools = create_tool_registry({
+        "set_current_topic": set_current_topic,
+        "update_user_progression": update_user_progression,
+        "suggest_new_topic_session": suggest_new_topic_session,
+    })
+
+    async def complete(turn, api_params, label):
+        """Async counterpart of complete in routes/chat.py"""
+        completion = await client.chat.completions.create(**api_params)
+        record_prompt_cache_usage(completion.usage, label, turn["prompt_version"])
+        message = completion.choices[0].message
+        return completion_result(
+            message.content, [tool_call_to_dict(tc) for tc in message.tool_calls or []], completion.usage
+        )
+
+    async def perform_step(turn, step, *args):
+        """Async counterpart of perform_step in routes/chat.py"""
+        if step == COMPLETE:
+            return await complete(turn, *args)
+        if step == RUN_TOOLS:
+            return await tools.run_async(turn, *args)
+        return None
+
+    async def submit_usage(turn):
+        """submit_turn_usage off the event loop (see WorkQueue.submit_async)"""
+        await asyncio.to_thread(submit_turn_usage, turn)
+
+    async def save_assistant_reply(turn, assistant_message):
+        """Async counterpart of save_assistant_reply in routes/chat.py. Raises on failure."""
+        await asyncio.to_thread(queue_assistant_reply, turn, assistant_message, datetime.now(gmt8), summarizer)
+
+    async def release_reservation(session_id, sequence):
+        """Async counterpart of release_reservation in routes/chat.py"""
+        await messages_collection.delete_one({"session_id": session_id, "sequence": sequence})
+        await transcript_cache_call(transcript_cache.remove_message, session_id, sequence)
+        await settle_sequences_async(sessions_collection, session_id, sequence + 1)
+
+    async def rollback_user_message(turn):
+        """Delete the user message saved at the start of the turn"""
+        logger.info(f"Rolling back: deleting user message {turn['user_message_id']}")
+        await release_reservation(turn["session_id"], turn["next_sequence"])
+
+    async def read_chat_request():
+        data = await request.get_json()
+        user_preferences = data.get("user_preferences", {})
+        return data.get("session_id"), data.get("message", "").strip(), user_preferences.get('language', 'en')
+
+    @chat_bp.route('/api/chat', methods=['POST'])
+    @auth_required
+    @admission_required
+    async def chat():
+        try:
+            session_id, user_input, preferred_language = await read_chat_request()
+            turn, error_response = await prepare_chat_turn(g.user_id, session_id, user_input, preferred_language)
+            if error_response:
+                return error_response
+
+            try:
+                outcome = await TurnMachine(turn, tools).run_async(perform_step)
+            except Exception as api_error:
+                logger.error(f"Failed to call GPT API: {str(api_error)}")
+                await rollback_user_message(turn)
+                await submit_usage(turn)
+                return jsonify({"error": f"Failed to get reply: {str(api_error)}"}), 500
+
+            assistant_message = outcome["reply"]
+            if outcome["suggestion"]:
+                await submit_usage(turn)
+                return jsonify({"response": assistant_message, "session_id": session_id})
+
+            try:
+                await save_assistant_reply(turn, assistant_message)
+                return jsonify({"response": assistant_message, "session_id": session_id})
+            except Exception as save_error:
+                logger.error(f"Failed to save assistant message or update session: {str(save_error)}")
+                await rollback_user_message(turn)
+                await submit_usage(turn)
+                return jsonify({"error": "Failed to save assistant reply"}), 500
+
+        except Exception as e:
+            logger.error(f"Chat route server error: {str(e)}")
+            return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+    @chat_bp.route('/api/chat/stream', methods=['POST'])
+    @auth_required
+    @admission_required
+    async def chat_stream():
+        """Async counterpart of /api/chat/stream, same event protocol"""
+        try:
+            session_id, user_input, preferred_language = await read_chat_request()
+            turn, error_response = await prepare_chat_turn(g.user_id, session_id, user_input, preferred_language)
+            if error_response:
+                return error_response
+        except Exception as e:
+            logger.error(f"Chat stream route server error: {str(e)}")
+            return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+        # The admission slot is held until the stream ends
+        ticket = g.pop("admission_ticket")
+
+        async def generate():
+            machine = TurnMachine(turn, tools)
+            streamed_tokens = False
+            try:
+                step = machine.advance()
+                while step is not None:
+                    result, error = None, None
+                    try:
+                        if step[0] == COMPLETE:
+                            content, tool_calls, usage = "", [], None
+                            async for event_type, value in stream_completion(step[1], turn["prompt_version"]):
+                                if event_type == "token":
+                                    content += value
+                                    streamed_tokens = True
+                                    yield sse_event("token", content=value)
+                                elif event_type == "usage":
+                                    usage = value
+                                else:
+                                    tool_calls = value
+                            result = completion_result(content, tool_calls, usage)
+                        elif step[0] == RUN_TOOLS:
+                            result = await tools.run_async(turn, step[1])
+                        elif streamed_tokens:
+                            yield sse_event("reset")
+                            streamed_tokens = False
+                    except Exception as e:
+                        error = e
+                    step = machine.advance(result, error)
+            except Exception as api_error:
+                logger.error(f"Failed to stream GPT API reply: {str(api_error)}")
+                await rollback_user_message(turn)
+                await submit_usage(turn)
+                yield sse_event("error", error=f"Failed to get reply: {str(api_error)}")
+                return
+
+            assistant_message = machine.outcome["reply"]
+            if not streamed_tokens or machine.outcome["suggestion"]:
+                yield sse_event("message", content=assistant_message)
+            if machine.outcome["suggestion"]:
+                await submit_usage(turn)
+                yield sse_event("done", response=assistant_message, session_id=session_id)
+                return
+
+            try:
+                await save_assistant_reply(turn, assistant_message)
+            except Exception as save_error:
+                logger.error(f"Failed to save assistant message or update session: {str(save_error)}")
+                await rollback_user_message(turn)
+                await submit_usage(turn)
+                yield sse_event("error", error="Failed to save assistant reply")
+                return
+
+            yield sse_event("done", response=assistant_message, session_id=session_id)
+
+        return Response(
+            ReleasingStream(generate(), ticket),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    async def stream_completion(api_params, prompt_version=None):
+        """Async counterpart of stream_completion in routes/chat.py"""
+        stream = await client.chat.completions.create(
+            **api_params, stream=True, stream_options={"include_usage": True}
+        )
+        tool_calls = {}
+        async for chunk in stream:
+            if not chunk.choices:
+                usage = getattr(chunk, "usage", None)
+                record_prompt_cache_usage(usage, "stream", prompt_version)
+                if usage:
+                    yield "usage", usage
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                yield "token", delta.content
+            for tc_delta in delta.tool_calls or []:
+                tool_call = tool_calls.setdefault(tc_delta.index, {
+                    "id": None,
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""}
+                })
+                if tc_delta.id:
+                    tool_call["id"] = tc_delta.id
+                if tc_delta.function:
+                    if tc_delta.function.name:
+                        tool_call["function"]["name"] += tc_delta.function.name
+                    if tc_delta.function.arguments:
+                        tool_call["function"]["arguments"] += tc_delta.function.arguments
+        yield "tool_calls", [tool_calls[index] for index in sorted(tool_calls)]
+
+    @chat_bp.route('/api/history', methods=['GET'])
+    @login_required
+    async def get_history():
+        try:
+            session_id = request.args.get('session_id')
+            if not session_id:
+                return jsonify({"error": "Session ID is required"}), 400
+            try:
+                page = parse_history_page(request.args)
+            except ValueError:
+                return jsonify({"error": HISTORY_PAGE_ERROR}), 400
+
+            await work_queue.flush_async(session_id, g.user_id)
+            session_data = await sessions_collection.find_one({"session_id": session_id})
+            if not session_data:
+                return jsonify({"error": "Session not found"}), 404
+
+            if page is None:
+                transcript, has_more = await load_transcript(session_id, session_data), False
+            else:
+                transcript, has_more = await load_transcript_page(session_id, session_data, *page)
+            messages = [
+                {"role": m["role"], "content": m["content"], "created_at": m.get("created_at"), "sequence": m.get("sequence")}
+                for m in transcript
+            ]
+
+            if not has_more:
+                user_data = await find_user(g.user_id)
+                preferred_language = user_data.get("preferences", {}).get("language", "en") if user_data else "en"
+                messages.insert(0, user_progression_context(user_data, session_data.get("topic_id"), preferred_language))
+
+            for msg in messages:
+                if "created_at" in msg and msg["created_at"]:
+                    msg["created_at"] = msg["created_at"].isoformat()
+            if page is None:
+                return jsonify(messages)
+            return jsonify(history_page_body(messages, has_more))
+
+        except Exception as e:
+            logger.error(f"Error in get_history: {str(e)}")
+            return jsonify({"error": f"Failed to get history: {str(e)}"}), 500
+
+    @chat_bp.route('/api/sessions')
+    @login_required
+    async def get_sessions():
+        try:
+            await work_queue.flush_async(g.user_id)
+            cursor = sessions_collection.find(
+                {"user_id": g.user_id},
+                {
+                    "_id": 0,
+                    "session_id": 1,
+                    "title": 1,
+                    "topic_id": 1,
+                    "created_at": 1,
+                    "updated_at": 1,
+                    "message_count": 1
+                }
+            ).sort("updated_at", -1)
+            sessions = await cursor.to_list(length=None)
+
+            for s in sessions:
+                if "created_at" in s and s["created_at"]:
+                    s["created_at"] = s["created_at"].isoformat()
+                if "updated_at" in s and s["updated_at"]:
+                    s["updated_at"] = s["updated_at"].isoformat()
+            return jsonify(sessions)
+
+        except Exception as e:
+            logger.error(f"Error in get_sessions: {str(e)}")
+            return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+    @chat_bp.route('/api/new-session', methods=['POST'])
+    @login_required
+    async def create_session():
+        try:
+            user_id = g.user_id
+            data = await request.get_json(silent=True)
+            topic_id = data.get('topic_id') if data else None
+
+            user_data = await find_user(user_id)
+            user_preferences = user_data.get("preferences", {}) if user_data else {}
+            preferred_language = user_preferences.get("language", "en")
+
+            current_time = datetime.now(gmt8)
+            session_id = f"chat_{current_time.timestamp()}".replace(".", "_")
+            await sessions_collection.insert_one({
+                "session_id": session_id,
+                "user_id": user_id,
+                "title": f"Chat {current_time.strftime('%Y%m%d-%H:%M')}",
+                "topic_id": topic_id,
+                "prompt_version": await asyncio.to_thread(prompt_registry.current_version),
+                "language": preferred_language,
+                "created_at": current_time,
+                "updated_at": current_time,
+                "message_count": 0,
+                "settled_sequence": 2,
+                "last_sequence": 2
+            })
+
+            # Sequence 1 is the system prompt, stored by reference
+            welcome_message_doc = {
+                "message_id": f"{session_id}_2",
+                "session_id": session_id,
+                "role": "assistant",
+                "content": get_welcome_message(preferred_language),
+                "created_at": current_time,
+                "sequence": 2
+            }
+            await messages_collection.insert_one(welcome_message_doc)
+            await sessions_collection.update_one(
+                {"session_id": session_id},
+                {"$set": {"message_count": 2}}
+            )
+            await transcript_cache_call(transcript_cache.set, session_id, [transcript_entry(welcome_message_doc)])
+            return jsonify({"success": True, "session_id": session_id})
+        except Exception as e:
+            logger.error(f"Error creating new session: {str(e)}")
+            return jsonify({"error": f"Failed to create session: {str(e)}"}), 500
+
+    @chat_bp.route('/api/delete-session', methods=['POST'])
+    @auth_required
+    async def delete_session():
+        try:
+            session_id = (await request.get_json()).get('session_id')
+            await work_queue.flush_async(session_id)
+            await sessions_collection.delete_one({"session_id": session_id})
+            await messages_collection.delete_many({"session_id": session_id})
+            await transcript_cache_call(transcript_cache.invalidate, session_id)
+            return jsonify({"success": True})
+        except Exception as e:
+            logger.error(f"Error deleting session: {str(e)}")
+            return jsonify({"error": f"Failed to delete session: {str(e)}"}), 500
+
+    @chat_bp.route('/api/update-title', methods=['POST'])
+    @auth_required
+    async def update_title():
+        try:
+            data = await request.get_json()
+            new_title = data.get('title')
+            if not new_title:
+                return jsonify({"error": "Title is required"}), 400
+            await sessions_collection.update_one(
+                {"session_id": data.get('session_id')},
+                {"$set": {"title": new_title}}
+            )
+            return jsonify({"success": True})
+        except Exception as e:
+            logger.error(f"Error updating title: {str(e)}")
+            return jsonify({"error": f"Failed to update title: {str(e)}"}), 500
+
+    return chat_bp
@@ -0,0 +1,116 @@
+"""
+Atomic allocation of message sequence numbers.
+
+A chat turn used to take message_count + 1 from the session it read and
+only write the new count at the end, so two tabs (or a double submit, or
+two workers) could give two messages the same sequence and message_id.
+Each session now has a last_sequence counter and a turn reserves its two
+sequence numbers (user message, assistant reply) with one
+find_one_and_update $inc, which also reads the session. A unique
+(session_id, sequence) index on messages enforces it.
+
+settled_sequence is the highest sequence that is settled, i.e. written
+(the assistant reply job raises it with $max) or given up (a rolled-back
+turn raises it with settle_sequences). A session whose last_sequence is
+ahead of settled_sequence has a turn in flight, possibly in another
+worker; the transcript cache is not trusted for it. message_count stays
+the number of messages: a rolled-back turn leaves a gap in the sequences
+but does not count.
+
+Sessions created before the counter existed get it on their first turn,
+from the highest sequence already stored.
+"""
+import logging
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# A turn writes the user message and the assistant reply
+TURN_SEQUENCES = 2
+
+def reservation_filter(session_id, user_id):
+    return {"session_id": session_id, "user_id": user_id, "last_sequence": {"$exists": True}}
+
+def seed_value(session_data, highest_message):
+    return max(settled_sequence(session_data), (highest_message or {}).get("sequence", 0))
+
+def settled_sequence(session_data):
+    """Highest settled sequence; sessions from before the field had no gaps, so their message_count"""
+    return session_data.get("settled_sequence", session_data.get("message_count", 0))
+
+def turn_in_flight(session_data):
+    """True when sequences were reserved that are not settled yet"""
+    settled = settled_sequence(session_data)
+    return session_data.get("last_sequence", settled) > settled
+
+def reserve_sequences(sessions_collection, messages_collection, session_id, user_id, count=TURN_SEQUENCES):
+    """Reserve `count` sequence numbers in a session of this user.
+
+    Returns (session_data, first_sequence), session_data as it was before the
+    reservation, or (None, None) when the user has no such session.
+    """
+    for _ in range(2):
+        session_data = sessions_collection.find_one_and_update(
+            reservation_filter(session_id, user_id),
+            {"$inc": {"last_sequence": count}},
+            return_document=ReturnDocument.BEFORE
+        )
+        if session_data is not None:
+            return session_data, session_data["last_sequence"] + 1
+        if not seed_last_sequence(sessions_collection, messages_collection, session_id, user_id):
+            return None, None
+    return None, None
+
+def seed_last_sequence(sessions_collection, messages_collection, session_id, user_id):
+    """Add the counter to an older session; False when the user has no such session"""
+    session_data = sessions_collection.find_one(
+        {"session_id": session_id, "user_id": user_id}, {"message_count": 1, "settled_sequence": 1, "last_sequence": 1}
+    )
+    if session_data is None:
+        return False
+    if "last_sequence" not in session_data:
+        highest = messages_collection.find_one({"session_id": session_id}, {"sequence": 1}, sort=[("sequence", -1)])
+        # Only the first writer seeds; a concurrent one then just reserves
+        sessions_collection.update_one(
+            {"session_id": session_id, "last_sequence": {"$exists": False}},
+            {"$set": {"last_sequence": seed_value(session_data, highest)}}
+        )
+        logger.info(f"Seeded the sequence counter of session {session_id}")
+    return True
+
+def settle_sequences(sessions_collection, session_id, upto):
+    """Mark sequences up to `upto` as settled after a turn gave them up"""
+    sessions_collection.update_one({"session_id": session_id}, {"$max": {"settled_sequence": upto}})
+
+async def reserve_sequences_async(sessions_collection, messages_collection, session_id, user_id, count=TURN_SEQUENCES):
+    """reserve_sequences on motor collections"""
+    for _ in range(2):
+        session_data = await sessions_collection.find_one_and_update(
+            reservation_filter(session_id, user_id),
+            {"$inc": {"last_sequence": count}},
+            return_document=ReturnDocument.BEFORE
+        )
+        if session_data is not None:
+            return session_data, session_data["last_sequence"] + 1
+        if not await seed_last_sequence_async(sessions_collection, messages_collection, session_id, user_id):
+            return None, None
+    return None, None
+
+async def seed_last_sequence_async(sessions_collection, messages_collection, session_id, user_id):
+    session_data = await sessions_collection.find_one(
+        {"session_id": session_id, "user_id": user_id}, {"message_count": 1, "settled_sequence": 1, "last_sequence": 1}
+    )
+    if session_data is None:
+        return False
+    if "last_sequence" not in session_data:
+        highest = await messages_collection.find_one({"session_id": session_id}, {"sequence": 1}, sort=[("sequence", -1)])
+        await sessions_collection.update_one(
+            {"session_id": session_id, "last_sequence": {"$exists": False}},
+            {"$set": {"last_sequence": seed_value(session_data, highest)}}
+        )
+        logger.info(f"Seeded the sequence counter of session {session_id}")
+    return True
+
+async def settle_sequences_async(sessions_collection, session_id, upto):
+    await sessions_collection.update_one({"session_id": session_id}, {"$max": {"settled_sequence": upto}})
@@ -52,9 +52,16 @@ async function loadChatSessions() {
 }
 
 // Load specific chat history
-async function loadChat(sessionId) {
+// page: { limit, beforeSequence } returns { messages, has_more, next_before_sequence },
+// the newest `limit` messages before beforeSequence; without it the whole history is returned
+async function loadChat(sessionId, page = null) {
     try {
-        const response = await fetch(`/api/history?session_id=${sessionId}`);
+        const params = new URLSearchParams({ session_id: sessionId });
+        if (page) {
+            params.set('limit', page.limit);
+            if (page.beforeSequence) params.set('before_sequence', page.beforeSequence);
+        }
+        const response = await fetch(`/api/history?${params}`);
         
         if (response.status === 401) {
             alert('Session expired, please log in again');
@@ -115,6 +122,87 @@ async function sendMessage(sessionId, message, preferences = null) {
     }
 }
 
+// Send message and receive the reply as a token stream (Server-Sent Events)
+// handlers: { onToken(text), onReset(), onMessage(text) }
+async function sendMessageStream(sessionId, message, preferences = null, handlers = {}) {
+    try {
+        // If preferences are not provided, try to get current user preferences
+        if (!preferences) {
+            try {
+                const prefsData = await getUserPreferences();
+                if (prefsData && prefsData.success) {
+                    preferences = prefsData.preferences;
+                }
+            } catch (e) {
+                // If retrieval fails, use default settings
+                console.warn('Unable to get user preferences, using defaults');
+                preferences = { language: 'zh', math_topics: [] };
+            }
+        }
+
+        const response = await fetch('/api/chat/stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                message: message,
+                session_id: sessionId,
+                user_preferences: preferences
+            })
+        });
+
+        if (response.status === 401) {
+            alert('Session expired, please log in again');
+            window.location.href = '/auth';
+            return null;
+        }
+
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.error || 'Failed to send message');
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let result = null;
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // Events are separated by a blank line
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                const dataLine = rawEvent.split('\n').find(line => line.startsWith('data: '));
+                if (!dataLine) continue;
+                const event = JSON.parse(dataLine.slice(6));
+
+                if (event.type === 'token') {
+                    if (handlers.onToken) handlers.onToken(event.content);
+                } else if (event.type === 'reset') {
+                    if (handlers.onReset) handlers.onReset();
+                } else if (event.type === 'message') {
+                    if (handlers.onMessage) handlers.onMessage(event.content);
+                } else if (event.type === 'done') {
+                    result = { response: event.response, session_id: event.session_id };
+                } else if (event.type === 'error') {
+                    throw new Error(event.error || 'Failed to send message');
+                }
+            }
+        }
+
+        if (!result) throw new Error('Connection closed before the reply was complete');
+        return result;
+    } catch (error) {
+        console.error('Failed to send message:', error);
+        throw error;
+    }
+}
+
 // Delete chat session
 async function deleteChat(sessionId) {
     try {
@@ -273,6 +361,7 @@ window.createNewChat = createNewChat;
 window.loadChatSessions = loadChatSessions;
 window.loadChat = loadChat;
 window.sendMessage = sendMessage;
+window.sendMessageStream = sendMessageStream;
 window.deleteChat = deleteChat;
 window.updateProfile = updateProfile;
 window.apiChangePassword = changePassword;
@@ -1,5 +1,10 @@
 let currentSessionId = null;
 
+// History is loaded a page at a time, older pages when scrolling up
+const HISTORY_PAGE_SIZE = 30;
+let historyCursor = null; // { sessionId, beforeSequence } of the next older page, null when all is loaded
+let loadingOlderMessages = false;
+
 // DOM elements
 const chatMessages = document.getElementById('chatMessages');
 const messageInput = document.getElementById('messageInput');
@@ -200,6 +205,16 @@ function setupEventListeners() {
             });
         }
     });
+    
+    // Load older messages when scrolled near the top
+    const chatContainer = document.querySelector('.chat-container');
+    if (chatContainer) {
+        chatContainer.addEventListener('scroll', () => {
+            if (chatContainer.scrollTop < 200) {
+                loadOlderMessages();
+            }
+        });
+    }
 }
 
 // Load session list
@@ -323,17 +338,19 @@ async function handleLoadChat(sessionId) {
             activeItem.classList.add('active');
         }
         
-        const messages = await window.loadChat(sessionId);
-        if (!messages) return;
+        historyCursor = null;
+        const page = await window.loadChat(sessionId, { limit: HISTORY_PAGE_SIZE });
+        if (!page) return;
         
-        // Load chat messages
+        // Load the newest chat messages
         chatMessages.innerHTML = '';
         
-        messages.forEach(msg => {
+        page.messages.forEach(msg => {
             if (msg.role !== 'system') {
                 addMessage(msg.content, msg.role === 'user');
             }
         });
+        setHistoryCursor(sessionId, page);
         
         // 滚动到合适的位置，留出底部空间
         const chatContainer = document.querySelector('.chat-container');
@@ -341,6 +358,11 @@ async function handleLoadChat(sessionId) {
             // 计算一个合适的滚动位置，留出一些底部空间
             const scrollTarget = chatContainer.scrollHeight - chatContainer.clientHeight * 0.95;
             chatContainer.scrollTop = scrollTarget;
+            
+            // A short first page leaves nothing to scroll: load older pages until there is
+            if (chatContainer.scrollHeight <= chatContainer.clientHeight) {
+                await loadOlderMessages();
+            }
         }
     } catch (error) {
         console.error('Failed to load history:', error);
@@ -348,6 +370,52 @@ async function handleLoadChat(sessionId) {
     }
 }
 
+function setHistoryCursor(sessionId, page) {
+    historyCursor = page.has_more ? { sessionId: sessionId, beforeSequence: page.next_before_sequence } : null;
+}
+
+// Prepend the next older history page, keeping the visible messages in place
+async function loadOlderMessages() {
+    if (!historyCursor || loadingOlderMessages || historyCursor.sessionId !== currentSessionId) return;
+    
+    const cursor = historyCursor;
+    loadingOlderMessages = true;
+    try {
+        const page = await window.loadChat(cursor.sessionId, {
+            limit: HISTORY_PAGE_SIZE,
+            beforeSequence: cursor.beforeSequence
+        });
+        // The user may have opened another chat in the meantime
+        if (!page || cursor.sessionId !== currentSessionId) return;
+        
+        const fragment = document.createDocumentFragment();
+        page.messages.forEach(msg => {
+            if (msg.role !== 'system') {
+                fragment.appendChild(createMessageElement(msg.content, msg.role === 'user'));
+            }
+        });
+        
+        const chatContainer = document.querySelector('.chat-container');
+        const previousHeight = chatContainer ? chatContainer.scrollHeight : 0;
+        chatMessages.insertBefore(fragment, chatMessages.firstChild);
+        if (chatContainer) {
+            chatContainer.scrollTop += chatContainer.scrollHeight - previousHeight;
+        }
+        setHistoryCursor(cursor.sessionId, page);
+    } catch (error) {
+        console.error('Failed to load older messages:', error);
+        return;
+    } finally {
+        loadingOlderMessages = false;
+    }
+    
+    // Still nothing to scroll: keep going
+    const chatContainer = document.querySelector('.chat-container');
+    if (chatContainer && chatContainer.scrollHeight <= chatContainer.clientHeight && historyCursor) {
+        await loadOlderMessages();
+    }
+}
+
 // Handle sending message
 async function handleSendMessage() {
     const message = messageInput.value.trim();
@@ -428,16 +496,48 @@ async function handleSendMessage() {
             chatContainer.scrollTop = scrollTarget;
         }
         
-        // Send request
-        const response = await window.sendMessage(currentSessionId, message);
-        
-        // 移除加载动画消息
-        if (wrapperDiv.parentNode) {
-            wrapperDiv.parentNode.removeChild(wrapperDiv);
+        // Send request, rendering the reply into the loading bubble as tokens arrive
+        let streamedText = '';
+        let renderPending = false;
+        const loadingHtml = contentDiv.innerHTML;
+        const renderStreamedText = () => {
+            renderPending = false;
+            // Nothing streamed (yet, or since a reset): keep showing the loading animation
+            contentDiv.innerHTML = streamedText ? window.formatMarkdown(streamedText, false) : loadingHtml;
+        };
+        const scheduleRender = () => {
+            if (!renderPending) {
+                renderPending = true;
+                requestAnimationFrame(renderStreamedText);
+            }
+        };
+
+        let response;
+        try {
+            response = await window.sendMessageStream(currentSessionId, message, null, {
+                onToken: (token) => {
+                    streamedText += token;
+                    scheduleRender();
+                },
+                onReset: () => {
+                    // The partial answer is discarded (a tool call follows): take it off the screen now
+                    streamedText = '';
+                    scheduleRender();
+                },
+                onMessage: (text) => {
+                    streamedText = text;
+                    scheduleRender();
+                }
+            });
+        } finally {
+            // 移除流式/加载动画消息，最终回复统一由 addMessage 渲染
+            if (wrapperDiv.parentNode) {
+                wrapperDiv.parentNode.removeChild(wrapperDiv);
+            }
         }
-        
+
         if (!response) return;
-        
+
         // Display assistant reply
         addMessage(response.response, false);
         
@@ -499,7 +599,7 @@ async function handleDeleteChat(sessionId) {
 }
 
 // Add message to chat UI
-function addMessage(content, isUser) {
+function createMessageElement(content, isUser) {
     const wrapperDiv = document.createElement('div');
     wrapperDiv.className = `message-wrapper ${isUser ? 'user-message-wrapper' : 'bot-message-wrapper'}`;
     
@@ -521,9 +621,12 @@ function addMessage(content, isUser) {
     
     messageDiv.appendChild(contentDiv);
     wrapperDiv.appendChild(messageDiv);
-    
+    return wrapperDiv;
+}
+
+function addMessage(content, isUser) {
     const chatMessages = document.getElementById('chatMessages');
-    chatMessages.appendChild(wrapperDiv);
+    chatMessages.appendChild(createMessageElement(content, isUser));
     
     // 滚动到合适的位置，减小偏移量
     const chatContainer = document.querySelector('.chat-container');
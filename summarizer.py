@@ -0,0 +1,157 @@
+"""
+Rolling summary compaction for long chat sessions.
+
+Once a session passes SUMMARY_TRIGGER_MESSAGES messages, the turns older
+than the recent tail are summarized into the session document (`summary`,
+`summary_upto`). Chat turns then send the system prompt + summary + recent
+tail instead of the full transcript. Summaries are refreshed incrementally
+in a background thread, never on the request path.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytz
+
+from sequence_allocator import settled_sequence
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv('SUMMARY_TRIGGER_MESSAGES', '40'))
+SUMMARY_KEEP_RECENT_MESSAGES = int(os.getenv('SUMMARY_KEEP_RECENT_MESSAGES', '12'))
+SUMMARY_REFRESH_MESSAGES = int(os.getenv('SUMMARY_REFRESH_MESSAGES', '10'))
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'gpt-4o-mini')
+
+SUMMARY_INSTRUCTION = (
+    "You maintain a running summary of a math tutoring session between a student and MathMentor. "
+    "Update the existing summary with the new conversation below. Keep: the topic(s) covered, "
+    "concepts the student has understood, mistakes and misconceptions they showed, problems still "
+    "in progress (with the numbers involved), and the student's preferences or goals. "
+    "Write at most 250 words, in the same language as the conversation. Return only the summary."
+)
+
+def get_history_filter(session_id, session_data):
+    """Messages to load for a turn: system prompt plus everything not yet summarized"""
+    summary_upto = session_data.get("summary_upto") if session_data.get("summary") else None
+    if not summary_upto:
+        return {"session_id": session_id}
+    return {
+        "session_id": session_id,
+        "$or": [{"role": "system"}, {"sequence": {"$gt": summary_upto}}]
+    }
+
+def select_unsummarized(messages, session_data):
+    """In-memory equivalent of get_history_filter for an already loaded transcript"""
+    summary_upto = session_data.get("summary_upto") if session_data.get("summary") else None
+    if not summary_upto:
+        return messages
+    return [m for m in messages if m.get("role") == "system" or m.get("sequence", 0) > summary_upto]
+
+def add_summary_context(messages, session_data):
+    """Insert the stored summary right after the leading system messages"""
+    summary = session_data.get("summary")
+    if not summary:
+        return
+    position = 0
+    while position < len(messages) and messages[position].get("role") == "system":
+        position += 1
+    messages.insert(position, {
+        "role": "system",
+        "content": f"Summary of the earlier part of this session:\n{summary}"
+    })
+
+class SessionSummarizer:
+    """Refreshes session summaries off the request path"""
+
+    def __init__(self, client, sessions_collection, messages_collection, max_workers=2):
+        self.client = client
+        self.sessions_collection = sessions_collection
+        self.messages_collection = messages_collection
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def needs_refresh(self, message_count, summary_upto):
+        """Whether enough new messages have left the recent tail to refresh the summary"""
+        if message_count <= SUMMARY_TRIGGER_MESSAGES:
+            return False
+        target_upto = message_count - SUMMARY_KEEP_RECENT_MESSAGES
+        return target_upto - (summary_upto or 0) >= SUMMARY_REFRESH_MESSAGES
+
+    def maybe_schedule(self, session_id, message_count, summary_upto):
+        """Queue a summary refresh for the session if one is due and not already running"""
+        if not self.needs_refresh(message_count, summary_upto):
+            return False
+        with self._lock:
+            if session_id in self._in_flight:
+                return False
+            self._in_flight.add(session_id)
+        self.executor.submit(self._refresh, session_id)
+        return True
+
+    def _refresh(self, session_id):
+        try:
+            self.refresh_summary(session_id)
+        except Exception as e:
+            logger.error(f"Failed to refresh summary for session {session_id}: {str(e)}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(session_id)
+
+    def refresh_summary(self, session_id):
+        """Fold the messages between summary_upto and the recent tail into the summary"""
+        session_data = self.sessions_collection.find_one(
+            {"session_id": session_id},
+            {"message_count": 1, "settled_sequence": 1, "summary": 1, "summary_upto": 1}
+        )
+        if not session_data:
+            return
+
+        summary_upto = session_data.get("summary_upto") or 0
+        target_upto = settled_sequence(session_data) - SUMMARY_KEEP_RECENT_MESSAGES
+        if target_upto <= summary_upto:
+            return
+
+        new_messages = list(self.messages_collection.find(
+            {
+                "session_id": session_id,
+                "role": {"$in": ["user", "assistant"]},
+                "sequence": {"$gt": summary_upto, "$lte": target_upto}
+            },
+            {"_id": 0, "role": 1, "content": 1}
+        ).sort("sequence", 1))
+        if not new_messages:
+            return
+
+        transcript = "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in new_messages)
+        completion = self.client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTION},
+                {"role": "user", "content": (
+                    f"Existing summary:\n{session_data.get('summary') or '(none)'}\n\n"
+                    f"New conversation:\n{transcript}"
+                )}
+            ],
+            temperature=0.2,
+        )
+        summary = (completion.choices[0].message.content or "").strip()
+        if not summary:
+            return
+
+        # Only apply on top of the summary we started from, so a concurrent refresh is never overwritten
+        result = self.sessions_collection.update_one(
+            {"session_id": session_id, "summary_upto": session_data.get("summary_upto")},
+            {"$set": {
+                "summary": summary,
+                "summary_upto": target_upto,
+                "summary_updated_at": datetime.now(pytz.timezone('Asia/Singapore'))
+            }}
+        )
+        if result.modified_count:
+            logger.info(f"Summarized session {session_id} up to sequence {target_upto}")
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,16 @@
+from topic_classifier import TopicClassifier
+
+classifier = TopicClassifier()
+
+def test_keyword_containing_negation_character():
+    assert classifier.classify("我想学不等式") == "equations"
+
+def test_chinese_sentence_with_bu_is_not_negated():
+    assert classifier.classify("我不懂微积分") == "calculus"
+
+def test_negated_topic_abstains():
+    assert classifier.classify("我不想学微积分") is None
+    assert classifier.classify("not algebra, geometry") is None
+
+def test_single_topic():
+    assert classifier.classify("teach me linear algebra") == "linear_algebra"
@@ -0,0 +1,154 @@
+"""
+Token usage accounting and per-user daily quotas.
+
+The usage reported for every completion of a turn (first call, follow-up
+call, streamed or not) is added up on the turn and then:
+
+- stored on the assistant message as "usage" (prompt, completion and cached
+  tokens, number of completions, prompt version and topic);
+- added to the session document ("usage.*" counters);
+- added to the user's counter document for the day in the token_usage
+  collection (_id "<user_id>:<YYYY-MM-DD>", Singapore time), with a total
+  per topic.
+
+The aggregates are kept with $inc by background jobs (see work_queue). A
+job can run again (retry, spool replay), so each $inc only matches a
+document that does not list the job id in applied_jobs yet and adds it in
+the same update: a turn is counted once. Turns that end on a topic
+suggestion or fail after a completion still count.
+
+TOKEN_DAILY_QUOTA caps the total tokens a user may use per day (0, the
+default, means no cap). It is checked before the LLM call by reading that
+one counter document by _id; a turn that starts under the cap may finish
+over it, the next one is refused with a 429.
+"""
+import logging
+import os
+import threading
+from datetime import datetime
+
+import pytz
+
+from metrics import register_stats
+from work_queue import applied_job_filter, applied_job_push
+
+logger = logging.getLogger(__name__)
+
+TOKEN_DAILY_QUOTA = int(os.getenv('TOKEN_DAILY_QUOTA', '0'))
+
+USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "cached_tokens", "total_tokens")
+
+# Quota days follow the app's timezone
+QUOTA_TIMEZONE = pytz.timezone('Asia/Singapore')
+
+_stats_lock = threading.Lock()
+_stats = {"turns": 0, "completions": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "quota_rejections": 0}
+
+def usage_counts(usage):
+    """Token counts of one completion's usage object (SDK or dict)"""
+    def read(obj, name):
+        value = obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+        return value or 0
+
+    details = read(usage, "prompt_tokens_details")
+    counts = {
+        "prompt_tokens": read(usage, "prompt_tokens"),
+        "completion_tokens": read(usage, "completion_tokens"),
+        "cached_tokens": read(details, "cached_tokens") if details else 0,
+    }
+    counts["total_tokens"] = read(usage, "total_tokens") or counts["prompt_tokens"] + counts["completion_tokens"]
+    return counts
+
+def add_usage(turn, usage):
+    """Add one completion's usage to the turn's totals"""
+    if not usage:
+        return
+    totals = turn.setdefault("usage", {**dict.fromkeys(USAGE_FIELDS, 0), "completions": 0})
+    for field, value in usage_counts(usage).items():
+        totals[field] += value
+    totals["completions"] += 1
+
+def message_usage(turn):
+    """The "usage" field of the turn's assistant message, or None when no completion ran"""
+    totals = turn.get("usage")
+    if not totals:
+        return None
+    return {**totals, "prompt_version": turn.get("prompt_version"), "topic_id": turn.get("current_topic")}
+
+def turn_total_tokens(turn):
+    return (turn.get("usage") or {}).get("total_tokens", 0)
+
+def usage_day(now=None):
+    return (now or datetime.now(QUOTA_TIMEZONE)).strftime("%Y-%m-%d")
+
+def daily_usage_id(user_id, day):
+    return f"{user_id}:{day}"
+
+def session_usage_filter(session_id, job_id):
+    return {"session_id": session_id, **applied_job_filter(job_id)}
+
+def session_usage_update(totals, job_id):
+    return {
+        "$inc": {f"usage.{field}": totals[field] for field in (*USAGE_FIELDS, "completions")},
+        "$push": applied_job_push(job_id)
+    }
+
+def daily_usage_filter(user_id, day, job_id):
+    return {"_id": daily_usage_id(user_id, day), **applied_job_filter(job_id)}
+
+def daily_usage_update(user_id, day, totals, topic_id, job_id):
+    increments = {field: totals[field] for field in (*USAGE_FIELDS, "completions")}
+    increments["turns"] = 1
+    increments[f"by_topic.{topic_id or 'none'}"] = totals["total_tokens"]
+    return {"$inc": increments, "$setOnInsert": {"user_id": user_id, "day": day}, "$push": applied_job_push(job_id)}
+
+def record_usage_stats(totals):
+    with _stats_lock:
+        _stats["turns"] += 1
+        _stats["completions"] += totals["completions"]
+        for field in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+            _stats[field] += totals[field]
+
+def quota_remaining(used):
+    """Tokens left today, or None when there is no quota"""
+    if TOKEN_DAILY_QUOTA <= 0:
+        return None
+    return max(0, TOKEN_DAILY_QUOTA - used)
+
+def daily_tokens_used(daily_doc):
+    return (daily_doc or {}).get("total_tokens", 0)
+
+def quota_exceeded(token_usage_collection, user_id):
+    """True when the user has used up today's quota (one lookup by _id, none without a quota)"""
+    if TOKEN_DAILY_QUOTA <= 0:
+        return False
+    daily_doc = token_usage_collection.find_one({"_id": daily_usage_id(user_id, usage_day())}, {"total_tokens": 1})
+    return check_quota(user_id, daily_doc)
+
+async def quota_exceeded_async(token_usage_collection, user_id):
+    """quota_exceeded on a motor collection"""
+    if TOKEN_DAILY_QUOTA <= 0:
+        return False
+    daily_doc = await token_usage_collection.find_one({"_id": daily_usage_id(user_id, usage_day())}, {"total_tokens": 1})
+    return check_quota(user_id, daily_doc)
+
+def check_quota(user_id, daily_doc):
+    if quota_remaining(daily_tokens_used(daily_doc)) > 0:
+        return False
+    record_quota_rejection(user_id)
+    return True
+
+def record_quota_rejection(user_id):
+    with _stats_lock:
+        _stats["quota_rejections"] += 1
+    logger.warning(f"User {user_id} is over the daily token quota ({TOKEN_DAILY_QUOTA})")
+
+def get_token_usage_stats():
+    """Totals since process start"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["daily_quota"] = TOKEN_DAILY_QUOTA or "off"
+    stats["cached_ratio"] = round(stats["cached_tokens"] / stats["prompt_tokens"], 4) if stats["prompt_tokens"] else 0.0
+    return stats
+
+register_stats("token_usage", get_token_usage_stats)
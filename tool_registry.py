@@ -0,0 +1,196 @@
+"""
+Registry of the tools offered to the model during a chat turn.
+
+Each tool registers its schema, its handler and when it is offered (with or
+without a session topic). When the model returns several tool calls, the
+calls run by phase: calls in the same phase are independent and run
+concurrently (in a bounded thread pool for the sync routes, with
+asyncio.gather for the async routes); a later phase starts once the earlier
+one is done, e.g. progression updates run after set_current_topic. A
+terminal tool ends the turn: it runs alone and its return value becomes the
+reply.
+
+Handlers are called as handler(turn, args) and return the tool message
+content (or the reply, for a terminal tool). Per-tool latency is recorded.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import observe_span
+
+logger = logging.getLogger(__name__)
+
+TOOL_MAX_WORKERS = int(os.getenv('TOOL_MAX_WORKERS', '4'))
+
+UNKNOWN_TOOL_RESPONSE = "Error: Unknown function called."
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+def get_tool_executor():
+    """Thread pool shared by all sync tool calls"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tools")
+    return _executor
+
+def record_tool_latency(name, elapsed, failed=False):
+    with _stats_lock:
+        stats = _stats.setdefault(name, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stats["calls"] += 1
+        stats["errors"] += 1 if failed else 0
+        stats["total_ms"] += elapsed * 1000
+        stats["max_ms"] = max(stats["max_ms"], elapsed * 1000)
+    observe_span("tool", name, elapsed)
+    logger.info(f"Tool {name} took {elapsed * 1000:.1f} ms{' (failed)' if failed else ''}")
+
+def get_tool_stats():
+    """Per-tool call counts and latency since process start"""
+    with _stats_lock:
+        return {
+            name: {
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "avg_ms": round(stats["total_ms"] / stats["calls"], 1),
+                "max_ms": round(stats["max_ms"], 1)
+            }
+            for name, stats in _stats.items()
+        }
+
+class Tool:
+    def __init__(self, name, schema, handler, offered, phase=0, terminal=False):
+        self.name = name
+        self.schema = schema
+        self.handler = handler
+        self.offered = offered
+        self.phase = phase
+        self.terminal = terminal
+
+class ToolRegistry:
+    """Tools by name, with their schemas and handlers"""
+
+    def __init__(self):
+        self._tools = {}
+
+    def register(self, name, schema, handler, offered=None, phase=0, terminal=False):
+        """Add a tool.
+
+        schema is the function schema, or a callable taking the session topic.
+        offered(current_topic) decides whether the model sees the tool (default: always).
+        """
+        self._tools[name] = Tool(name, schema, handler, offered or (lambda current_topic: True), phase, terminal)
+
+    def schemas(self, current_topic):
+        """Schemas of the tools offered for a session with (or without) a topic"""
+        schemas = []
+        for tool in self._tools.values():
+            if tool.offered(current_topic):
+                schemas.append(tool.schema(current_topic) if callable(tool.schema) else tool.schema)
+        logger.info(f"Offering tools {[s['function']['name'] for s in schemas]} for topic: {current_topic}")
+        return schemas
+
+    def side_effects_only(self, tool_calls):
+        """Whether every call is a known, non-terminal tool (no reply depends on its result)"""
+        for tool_call in tool_calls:
+            tool = self._tools.get(tool_call["function"]["name"])
+            if not tool or tool.terminal:
+                return False
+        return True
+
+    def plan(self, tool_calls):
+        """Parse tool calls into (tool_call, tool, args) and pick the terminal call, if any"""
+        calls = []
+        for tool_call in tool_calls:
+            function = tool_call["function"]
+            calls.append((tool_call, self._tools.get(function["name"]), json.loads(function["arguments"] or "{}")))
+        terminal = next((call for call in calls if call[1] and call[1].terminal), None)
+        return calls, terminal
+
+    def phases(self, calls):
+        """Group calls by phase, in phase order"""
+        groups = {}
+        for call in calls:
+            groups.setdefault(call[1].phase if call[1] else 0, []).append(call)
+        return [groups[phase] for phase in sorted(groups)]
+
+    def run(self, turn, tool_calls):
+        """Run the tool calls of one model response (sync handlers).
+
+        Returns ([(tool_call, response), ...] in call order, None), or
+        (None, reply) when a terminal tool ended the turn.
+        """
+        calls, terminal = self.plan(tool_calls)
+        if terminal:
+            return None, self._call(terminal, turn)
+
+        responses = {}
+        for group in self.phases(calls):
+            if len(group) == 1:
+                responses[group[0][0]["id"]] = self._call(group[0], turn)
+                continue
+            # Each worker runs in a copy of the request context (flask.g, request loader)
+            futures = [
+                (call[0]["id"], get_tool_executor().submit(contextvars.copy_context().run, self._call, call, turn))
+                for call in group
+            ]
+            for call_id, future in futures:
+                responses[call_id] = future.result()
+        return [(tool_call, responses[tool_call["id"]]) for tool_call, _, _ in calls], None
+
+    async def run_async(self, turn, tool_calls):
+        """Async counterpart of run for coroutine handlers"""
+        calls, terminal = self.plan(tool_calls)
+        if terminal:
+            return None, await self._call_async(terminal, turn)
+
+        responses = {}
+        semaphore = asyncio.Semaphore(TOOL_MAX_WORKERS)
+
+        async def bounded(call):
+            async with semaphore:
+                return await self._call_async(call, turn)
+
+        for group in self.phases(calls):
+            results = await asyncio.gather(*(bounded(call) for call in group))
+            for call, response in zip(group, results):
+                responses[call[0]["id"]] = response
+        return [(tool_call, responses[tool_call["id"]]) for tool_call, _, _ in calls], None
+
+    def _call(self, call, turn):
+        tool_call, tool, args = call
+        if not tool:
+            logger.warning(f"Unknown tool call function: {tool_call['function']['name']}")
+            return UNKNOWN_TOOL_RESPONSE
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = tool.handler(turn, args)
+            failed = False
+            return response
+        finally:
+            record_tool_latency(tool.name, time.perf_counter() - start, failed)
+
+    async def _call_async(self, call, turn):
+        tool_call, tool, args = call
+        if not tool:
+            logger.warning(f"Unknown tool call function: {tool_call['function']['name']}")
+            return UNKNOWN_TOOL_RESPONSE
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = await tool.handler(turn, args)
+            failed = False
+            return response
+        finally:
+            record_tool_latency(tool.name, time.perf_counter() - start, failed)
@@ -0,0 +1,157 @@
+"""
+Local topic detection for sessions that have no topic yet.
+
+Without a topic, the first turn offers set_current_topic to the model,
+which then needs a second completion. Most first messages name the topic
+outright ("teach me algebra", "我想学微积分"), so a keyword match is enough.
+
+Phrases come from the topic ids, the localized names in utils.topics_map,
+the built-in keywords below and, optionally, a JSON file of extra keywords
+per topic (TOPIC_KEYWORDS_FILE). They are compiled into one regex, longest
+phrase first, so "linear algebra" wins over "algebra". The classifier is
+confident only when exactly one topic matches and the rest of the message
+has no negation word; everything else is left to the model.
+
+TOPIC_CLASSIFIER:
+- "off": not used.
+- "shadow" (default): classify every first message, let the model decide
+  and log whether they agree.
+- "on": set the topic directly when confident.
+"""
+import json
+import logging
+import os
+import re
+import threading
+
+from utils import topics_map
+
+logger = logging.getLogger(__name__)
+
+TOPIC_CLASSIFIER = os.getenv('TOPIC_CLASSIFIER', 'shadow')
+TOPIC_KEYWORDS_FILE = os.getenv('TOPIC_KEYWORDS_FILE')
+
+TOPIC_KEYWORDS = {
+    'algebra': ['algebraic', 'polynomial', 'polynomials', 'factorise', 'factorize', 'factorisation', 'factorization',
+                '多项式', '因式分解', 'polinomial', 'pemfaktoran'],
+    'geometry': ['triangle', 'triangles', 'circle', 'circles', 'polygon', 'polygons', 'pythagoras', 'perimeter',
+                 '三角形', '圆形', '多边形', '勾股定理', '周长', 'segi tiga', 'bulatan', 'poligon', 'perimeter'],
+    'calculus': ['derivative', 'derivatives', 'differentiate', 'differentiation', 'integral', 'integrals',
+                 'integration', 'integrate', '导数', '微分', '积分', '极限', 'pembezaan', 'kamiran', 'terbitan'],
+    'statistics': ['median', 'standard deviation', 'variance', 'histogram', 'data set',
+                   '平均数', '中位数', '众数', '方差', '标准差', 'sisihan piawai', 'varians', 'histogram'],
+    'probability': ['chance', 'chances', 'dice', 'coin toss', 'odds',
+                    '概率', '可能性', '骰子', 'peluang', 'dadu'],
+    'linear_algebra': ['eigenvalue', 'eigenvalues', 'eigenvector', 'eigenvectors', 'vector space', 'vector spaces',
+                       '特征值', '特征向量', '向量空间', 'nilai eigen', 'vektor eigen'],
+    'discrete_math': ['graph theory', 'combinatorics', 'permutation', 'permutations', 'combination', 'combinations',
+                      'set theory', 'recursion', '组合数学', '排列组合', '图论', '集合论', 'pilih atur', 'gabungan'],
+    'trigonometry': ['sine', 'cosine', 'tangent', 'sin', 'cos', 'tan', 'trig',
+                     '正弦', '余弦', '正切', 'sinus', 'kosinus', 'tangen'],
+    'number_theory': ['prime number', 'prime numbers', 'primes', 'gcd', 'lcm', 'divisibility', 'modular arithmetic',
+                      '质数', '素数', '最大公约数', '最小公倍数', '整除', 'nombor perdana', 'faktor sepunya'],
+    'functions': ['inverse function', 'composite function', 'domain and range',
+                  '定义域', '值域', '反函数', '复合函数', 'fungsi songsang', 'fungsi gubahan'],
+    'ratios_proportions': ['ratio', 'ratios', 'proportion', 'proportions', '比例', '比率', 'nisbah', 'kadaran'],
+    'percentages': ['percent', 'percentage', 'percentages', '百分比', '百分数', '折扣', 'peratus', 'peratusan'],
+    'equations': ['equation', 'equations', 'inequality', 'inequalities', 'solve for x',
+                  '方程', '不等式', '解方程', 'persamaan', 'ketaksamaan'],
+    'matrices': ['matrix', 'determinant', 'determinants', '矩阵', '行列式', 'matriks', 'penentu'],
+    'vectors': ['vector', 'dot product', 'cross product', '向量', '点积', '叉积', 'vektor'],
+    'logic_thinking': ['logic', 'logical', 'puzzle', 'puzzles', 'truth table', '逻辑', '推理', 'logik', 'teka-teki'],
+    'complex_numbers': ['complex number', 'imaginary number', 'imaginary numbers', 'argand',
+                        '复数', '虚数', 'nombor kompleks', 'nombor khayalan'],
+}
+
+NEGATION = re.compile(r"(?<![a-z])(not|don'?t|no|instead|without|bukan|tidak|jangan)(?![a-z])|不是|不要|不想|别|没有")
+
+def load_keywords():
+    """Phrase -> topic id, from topic ids, localized names and keywords (built-in and TOPIC_KEYWORDS_FILE)"""
+    keywords = {topic_id: list(words) for topic_id, words in TOPIC_KEYWORDS.items()}
+    if TOPIC_KEYWORDS_FILE:
+        with open(TOPIC_KEYWORDS_FILE, "r", encoding="utf-8") as file:
+            for topic_id, words in json.load(file).items():
+                keywords.setdefault(topic_id, []).extend(words)
+
+    phrases = {}
+    for topic_id in topics_map['en']:
+        names = [topic_id.replace("_", " ")] + [topics_map[lang][topic_id] for lang in topics_map]
+        for phrase in names + keywords.get(topic_id, []):
+            phrases.setdefault(phrase.lower(), topic_id)
+    return phrases
+
+def compile_phrases(phrases):
+    """One alternation, longest phrase first; Latin phrases must match whole words"""
+    parts = []
+    for phrase in sorted(phrases, key=len, reverse=True):
+        escaped = re.escape(phrase)
+        if phrase.isascii():
+            parts.append(rf"(?<![a-z0-9]){escaped}(?![a-z0-9])")
+        else:
+            parts.append(escaped)
+    return re.compile("|".join(parts))
+
+class TopicClassifier:
+    """Keyword classifier over the session topics"""
+
+    def __init__(self, phrases=None):
+        self.phrases = phrases or load_keywords()
+        self.pattern = compile_phrases(self.phrases)
+
+    def matches(self, text):
+        """Topic ids named in the text, in order of appearance"""
+        return [self.phrases[m.group(0)] for m in self.pattern.finditer(text.lower())]
+
+    def classify(self, text):
+        """The topic id when exactly one topic is named and nothing is negated, else None"""
+        if not text:
+            return None
+        lowered = text.lower()
+        topics = set(self.matches(lowered))
+        # Negation is looked for outside the matched phrases, so "不等式" does not read as "不"
+        if len(topics) != 1 or NEGATION.search(self.pattern.sub(" ", lowered)):
+            return None
+        return topics.pop()
+
+_stats_lock = threading.Lock()
+_stats = {"classified": 0, "abstained": 0, "applied": 0, "agreed": 0, "disagreed": 0}
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+def detect_topic(user_input):
+    """Classifier result for the first message of a session without a topic (None if off or unsure)"""
+    if TOPIC_CLASSIFIER == "off":
+        return None
+    topic_id = topic_classifier.classify(user_input)
+    _count("classified" if topic_id else "abstained")
+    return topic_id
+
+def should_apply(topic_id):
+    """Whether a detected topic is set directly instead of asking the model"""
+    if topic_id and TOPIC_CLASSIFIER == "on":
+        _count("applied")
+        return True
+    return False
+
+def log_agreement(classified_topic, model_topic):
+    """Compare the classifier (shadow mode) with the topic the model set"""
+    if not classified_topic:
+        return
+    if classified_topic == model_topic:
+        _count("agreed")
+        logger.info(f"Topic classifier agreed with the model: {model_topic}")
+    else:
+        _count("disagreed")
+        logger.warning(f"Topic classifier chose {classified_topic}, the model chose {model_topic}")
+
+def get_classifier_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    compared = stats["agreed"] + stats["disagreed"]
+    stats["mode"] = TOPIC_CLASSIFIER
+    stats["agreement_rate"] = round(stats["agreed"] / compared, 4) if compared else None
+    return stats
+
+topic_classifier = TopicClassifier()
@@ -0,0 +1,66 @@
+"""
+How many completions a tutoring turn takes.
+
+- "two_call" (default): when the model calls a tool, the tool results are
+  sent back in a second completion that writes the reply.
+- "single_pass": the model is asked to write its reply in the same message
+  as its set_current_topic / update_user_progression calls. The server
+  applies those calls as side effects and uses that text as the reply. It
+  falls back to the second call when the reply text is missing or when a
+  call needs a follow-up (unknown or terminal tools).
+
+Select with TURN_MODE. The fraction of turns that needed two calls is
+tracked in both modes.
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+TWO_CALL_MODE = "two_call"
+SINGLE_PASS_MODE = "single_pass"
+
+TURN_MODE = os.getenv('TURN_MODE', TWO_CALL_MODE)
+
+SINGLE_PASS_INSTRUCTION = {
+    "role": "system",
+    "content": (
+        "When you call `set_current_topic` or `update_user_progression`, write your complete reply to the user "
+        "in the same message as the tool call. These tools only record the topic and the user's progress; "
+        "you will not get another chance to answer.\n"
+        "- After setting the topic: briefly introduce a basic concept or question to assess the user's familiarity, "
+        "choose one simple example instead of listing subtopics, and ask the user to try something.\n"
+        "- After updating progression: introduce the next logical concept and ask a follow-up question "
+        "that reinforces what they just learned.\n"
+        "Do not mention tools, topic-setting or progression explicitly."
+    )
+}
+
+_stats_lock = threading.Lock()
+_stats = {"turns": 0, "two_call_turns": 0}
+
+def is_single_pass(mode=None):
+    return (mode or TURN_MODE) == SINGLE_PASS_MODE
+
+def single_pass_reply(content, tool_calls, registry):
+    """Reply text of a first completion that can stand on its own, or None when a second call is needed"""
+    if not is_single_pass() or not content or not content.strip():
+        return None
+    if not registry.side_effects_only(tool_calls):
+        return None
+    logger.info("Single-pass turn: applied tool calls without a second completion")
+    return content
+
+def record_turn(two_calls):
+    """Count a completed turn and whether it needed a second completion"""
+    with _stats_lock:
+        _stats["turns"] += 1
+        _stats["two_call_turns"] += 1 if two_calls else 0
+
+def get_turn_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["mode"] = TURN_MODE
+    stats["two_call_fraction"] = round(stats["two_call_turns"] / stats["turns"], 4) if stats["turns"] else 0.0
+    return stats
@@ -0,0 +1,53 @@
+"""
+Request-scoped user document loader.
+
+One chat turn needs the same user document in several helpers (progression
+context, topic progression lookups, progression updates). The loader is an
+identity map stored on flask.g: each user is fetched at most once per
+request, with a projection limited to the fields those helpers read.
+"""
+import logging
+
+from bson import ObjectId
+from flask import g, has_request_context
+
+logger = logging.getLogger(__name__)
+
+# Fields of the user document used by the chat helpers (never the password hash)
+USER_PROJECTION = {"preferences": 1, "progression": 1}
+
+class UserLoader:
+    """Identity map of user documents for one request"""
+
+    def __init__(self, users_collection):
+        self.users_collection = users_collection
+        self._docs = {}
+        self.query_count = 0
+
+    def get(self, user_id):
+        """Return the user document (or None), querying MongoDB only the first time"""
+        user_id = str(user_id)
+        if user_id not in self._docs:
+            self.query_count += 1
+            self._docs[user_id] = self.users_collection.find_one(
+                {"_id": ObjectId(user_id)}, USER_PROJECTION
+            )
+        return self._docs[user_id]
+
+    def invalidate(self, user_id):
+        """Forget a user after a write so the next get() reads it again"""
+        self._docs.pop(str(user_id), None)
+
+def get_user_loader(users_collection):
+    """Loader bound to the current request, or a throwaway one outside a request"""
+    if not has_request_context():
+        return UserLoader(users_collection)
+    if "user_loader" not in g:
+        g.user_loader = UserLoader(users_collection)
+    return g.user_loader
+
+def get_request_user_query_count():
+    """Number of user documents fetched by the current request's loader"""
+    if has_request_context() and "user_loader" in g:
+        return g.user_loader.query_count
+    return 0
@@ -0,0 +1,261 @@
+"""
+Background queue for the writes of a chat turn that the reply does not wait on.
+
+Once the model has answered, the assistant message insert, the session
+update (updated_at, message_count, last_message) and progression updates
+are submitted here and run by worker threads after the response is sent.
+The transcript cache is still updated synchronously.
+
+- Jobs are named handlers with JSON-serializable args, registered by the
+  routes. Each job is retried up to WORK_QUEUE_MAX_RETRIES times with
+  exponential backoff.
+- A job keeps its id through retries and spool replays, and the handler
+  gets it. A write that is not idempotent by itself ($inc, $push) must be
+  guarded with it: applied_job_filter() in the filter and
+  applied_job_push() in the update, so the write is made and recorded in
+  one atomic update and a second run matches nothing.
+- A job that still fails is appended to a local spool file
+  (WORK_QUEUE_SPOOL), as are jobs still queued when the shutdown drain
+  times out. The spool is replayed at the next start.
+- Read-your-writes: every job carries keys (session id, user id). Readers
+  call flush(key) first, which waits until the jobs for that key have run.
+  This only covers the current process.
+- When the queue is full (WORK_QUEUE_MAX_SIZE), the job runs inline
+  instead. WORK_QUEUE_MODE=inline always runs jobs inline.
+- shutdown() stops accepting jobs and drains the queue for up to
+  WORK_QUEUE_DRAIN_TIMEOUT seconds.
+"""
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import Counter
+
+from bson import json_util
+
+from metrics import register_stats
+
+logger = logging.getLogger(__name__)
+
+WORK_QUEUE_MODE = os.getenv('WORK_QUEUE_MODE', 'background')
+WORK_QUEUE_WORKERS = int(os.getenv('WORK_QUEUE_WORKERS', '2'))
+WORK_QUEUE_MAX_SIZE = int(os.getenv('WORK_QUEUE_MAX_SIZE', '10000'))
+WORK_QUEUE_MAX_RETRIES = int(os.getenv('WORK_QUEUE_MAX_RETRIES', '3'))
+WORK_QUEUE_RETRY_DELAY = float(os.getenv('WORK_QUEUE_RETRY_DELAY', '0.2'))
+WORK_QUEUE_FLUSH_TIMEOUT = float(os.getenv('WORK_QUEUE_FLUSH_TIMEOUT', '5'))
+WORK_QUEUE_DRAIN_TIMEOUT = float(os.getenv('WORK_QUEUE_DRAIN_TIMEOUT', '10'))
+WORK_QUEUE_SPOOL = os.getenv('WORK_QUEUE_SPOOL', 'work_queue_spool.jsonl')
+
+# Job ids remembered per guarded document (its most recent jobs)
+APPLIED_JOBS_KEPT = 100
+
+def applied_job_filter(job_id):
+    """Filter condition: this job has not been applied to the document yet"""
+    return {"applied_jobs": {"$ne": job_id}}
+
+def applied_job_push(job_id):
+    """$push entry recording the job on the document, in the same update as its write"""
+    return {"applied_jobs": {"$each": [job_id], "$slice": -APPLIED_JOBS_KEPT}}
+
+class WorkQueue:
+    """Bounded job queue with retrying worker threads and a durable spool"""
+
+    def __init__(self, mode=WORK_QUEUE_MODE, workers=WORK_QUEUE_WORKERS, max_size=WORK_QUEUE_MAX_SIZE,
+                 spool_path=WORK_QUEUE_SPOOL):
+        self.mode = mode
+        self.workers = workers
+        self.spool_path = spool_path
+        self._handlers = {}
+        self._queue = queue.Queue(maxsize=max_size)
+        self._pending = Counter()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._closed = False
+        self._spool_lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.retries = 0
+        self.ran_inline = 0
+        self.spooled = 0
+        self.replayed = 0
+
+    def register(self, kind, handler):
+        """handler(args, job_id) performs the job; it may run more than once with the same job_id"""
+        self._handlers[kind] = handler
+
+    def submit(self, kind, args, keys=(), job_id=None):
+        """Queue a job (or run it inline in inline mode, after shutdown or when the queue is full)"""
+        job = {"id": job_id or uuid.uuid4().hex, "kind": kind, "args": args, "keys": [str(k) for k in keys]}
+        with self._cond:
+            self.submitted += 1
+            inline = self.mode == "inline" or self._closed
+            if not inline:
+                self._start_workers()
+                self._pending.update(job["keys"])
+        if inline:
+            self._run(job)
+            return
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            logger.warning(f"Work queue full, running {kind} inline")
+            with self._cond:
+                self.ran_inline += 1
+            try:
+                self._run(job)
+            finally:
+                self._done(job)
+
+    async def submit_async(self, kind, args, keys=(), job_id=None):
+        """submit() for the async routes; a job run inline (blocking writes, retry sleeps) stays off the event loop"""
+        await asyncio.to_thread(self.submit, kind, args, keys, job_id)
+
+    def pending(self, *keys):
+        with self._cond:
+            return any(self._pending[str(k)] for k in keys)
+
+    def flush(self, *keys, timeout=WORK_QUEUE_FLUSH_TIMEOUT):
+        """Wait until no job for these keys is queued or running. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while any(self._pending[str(k)] for k in keys):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"Timed out waiting for background writes of {keys}")
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    async def flush_async(self, *keys, timeout=WORK_QUEUE_FLUSH_TIMEOUT):
+        """flush() for the async routes; returns at once when nothing is pending"""
+        if not self.pending(*keys):
+            return True
+        return await asyncio.to_thread(self.flush, *keys, timeout=timeout)
+
+    def shutdown(self, timeout=WORK_QUEUE_DRAIN_TIMEOUT):
+        """Stop accepting jobs, let the workers drain the queue and spool what is left"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+        deadline = time.monotonic() + timeout
+        for _ in threads:
+            try:
+                self._queue.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+        left = 0
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                self._spool(job)
+                self._done(job)
+                left += 1
+        logger.info(f"Work queue drained ({left} jobs spooled for the next start)")
+
+    def replay_spool(self):
+        """Queue the jobs spooled by an earlier run; call once the handlers are registered"""
+        if not os.path.exists(self.spool_path):
+            return 0
+        replaying = f"{self.spool_path}.replaying"
+        with self._spool_lock:
+            os.replace(self.spool_path, replaying)
+        count = 0
+        with open(replaying, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    job = json_util.loads(line)
+                    self.submit(job["kind"], job["args"], job["keys"], job_id=job["id"])
+                    count += 1
+        os.remove(replaying)
+        with self._cond:
+            self.replayed += count
+        if count:
+            logger.info(f"Replayed {count} spooled background jobs")
+        return count
+
+    def _start_workers(self):
+        """Start the worker threads on first use (lock held)"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"work-queue-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self._run(job)
+            finally:
+                self._done(job)
+
+    def _run(self, job):
+        handler = self._handlers.get(job["kind"])
+        if handler is None:
+            logger.error(f"No handler for background job {job['kind']}, spooling it")
+            self._spool(job)
+            return
+        attempt = 0
+        while True:
+            try:
+                handler(job["args"], job["id"])
+                with self._cond:
+                    self.completed += 1
+                return
+            except Exception as e:
+                attempt += 1
+                if attempt > WORK_QUEUE_MAX_RETRIES:
+                    logger.error(f"Background job {job['kind']} failed after {attempt} attempts: {str(e)}")
+                    self._spool(job)
+                    return
+                with self._cond:
+                    self.retries += 1
+                logger.warning(f"Background job {job['kind']} failed ({str(e)}), retry {attempt}/{WORK_QUEUE_MAX_RETRIES}")
+                time.sleep(WORK_QUEUE_RETRY_DELAY * 2 ** (attempt - 1))
+
+    def _done(self, job):
+        with self._cond:
+            self._pending.subtract(job["keys"])
+            self._pending += Counter()  # drop keys that reached zero
+            self._cond.notify_all()
+
+    def _spool(self, job):
+        with self._spool_lock:
+            with open(self.spool_path, "a", encoding="utf-8") as file:
+                file.write(json_util.dumps(job) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+        with self._cond:
+            self.spooled += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                "mode": self.mode,
+                "queued": self._queue.qsize(),
+                "pending_keys": len(self._pending),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "retries": self.retries,
+                "ran_inline": self.ran_inline,
+                "spooled": self.spooled,
+                "replayed": self.replayed,
+                "workers": len(self._threads)
+            }
+
+work_queue = WorkQueue()
+register_stats("work_queue", work_queue.stats)